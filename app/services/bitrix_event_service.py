@@ -0,0 +1,198 @@
+import asyncio
+import hmac
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+import logging
+
+from app.services.bitrix_service import BitrixTransientError, BitrixUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# Событие Bitrix24 -> (сущность, действие)
+BITRIX_EVENTS = {
+    'ONCRMACTIVITYADD': ('activity', 'upsert'),
+    'ONCRMACTIVITYUPDATE': ('activity', 'upsert'),
+    'ONCRMACTIVITYDELETE': ('activity', 'delete'),
+    'ONCRMDEALADD': ('deal', 'upsert'),
+    'ONCRMDEALUPDATE': ('deal', 'upsert'),
+    'ONCRMDEALDELETE': ('deal', 'delete'),
+}
+
+
+class BitrixEventService:
+    """Прием исходящих событий Bitrix24 и точечное обновление warehouse
+
+    Обработчик события только проверяет токен и ставит ID в очередь.
+    Фоновый воркер копит очередь flush_delay секунд, схлопывает повторы
+    (для ID важна только последняя операция), одним-двумя запросами
+    забирает измененные записи и пишет их в activities / deals,
+    после чего пересчитывает снапшоты затронутых дней.
+    """
+
+    def __init__(self, bitrix_service, warehouse_service):
+        self.bitrix_service = bitrix_service
+        self.warehouse_service = warehouse_service
+        self.application_token = os.getenv("BITRIX_APP_TOKEN")
+        self.flush_delay = float(os.getenv("BITRIX_EVENTS_FLUSH_DELAY", "1"))
+        # Сколько раз событие возвращается в очередь после ошибки не со стороны Bitrix
+        self.max_attempts = int(os.getenv("BITRIX_EVENTS_MAX_ATTEMPTS", "5"))
+        self._pending: Dict[str, Dict[str, str]] = {'activity': {}, 'deal': {}}
+        self._attempts: Dict[Tuple[str, str], int] = {}
+        # Пауза перед повтором неудавшегося flush: удваивается до retry_max_delay
+        self.retry_max_delay = float(os.getenv("BITRIX_EVENTS_RETRY_MAX_DELAY", "300"))
+        self._retry_delay = 0.0
+        self._retry_handle: Optional[asyncio.TimerHandle] = None
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._stats = {
+            "received": 0,
+            "rejected": 0,
+            "ignored": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "last_flush_at": None,
+            "last_error": None
+        }
+
+    def verify_token(self, token: Optional[str]) -> bool:
+        """Сверяет auth[application_token] события с BITRIX_APP_TOKEN"""
+        if not self.application_token or not token:
+            return False
+        return hmac.compare_digest(str(token), self.application_token)
+
+    def handle_event(self, payload: Dict) -> bool:
+        """Принимает разобранное событие (плоский словарь полей формы)
+
+        Возвращает False, если токен не прошел проверку.
+        """
+        if not self.verify_token(payload.get('auth[application_token]')):
+            self._stats["rejected"] += 1
+            logger.warning(f"⚠️ Bitrix event rejected: bad application token ({payload.get('event')})")
+            return False
+
+        event = str(payload.get('event', '')).upper()
+        entity_id = payload.get('data[FIELDS][ID]')
+        if event not in BITRIX_EVENTS or not str(entity_id or '').isdigit():
+            self._stats["ignored"] += 1
+            logger.info(f"Bitrix event ignored: {event} {entity_id}")
+            return True
+
+        entity, action = BITRIX_EVENTS[event]
+        self._pending[entity][str(entity_id)] = action
+        self._stats["received"] += 1
+        self._wakeup.set()
+        return True
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._retry_handle:
+            self._retry_handle.cancel()
+            self._retry_handle = None
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Даем событиям накопиться, чтобы обработать их одной пачкой
+            await asyncio.sleep(self.flush_delay)
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Обрабатывает накопленные события"""
+        activities, self._pending['activity'] = self._pending['activity'], {}
+        deals, self._pending['deal'] = self._pending['deal'], {}
+        if not activities and not deals:
+            return
+
+        try:
+            if activities:
+                await self._apply_activities(activities)
+            if deals:
+                await self._apply_deals(deals)
+            self._stats["flushes"] += 1
+            self._stats["last_flush_at"] = datetime.now().isoformat()
+            self._stats["last_error"] = None
+            for entity, changes in (('activity', activities), ('deal', deals)):
+                for entity_id in changes:
+                    self._attempts.pop((entity, entity_id), None)
+            self._retry_delay = 0.0
+        except Exception as e:
+            # Возвращаем в очередь то, что не успели применить (новые события важнее).
+            # Недоступность Bitrix повторяется без ограничений, прочие ошибки (в том
+            # числе ошибки API и авторизации) - не больше max_attempts раз, иначе одно
+            # битое событие блокирует очередь
+            counted = not isinstance(e, (BitrixUnavailableError, BitrixTransientError))
+            dropped = 0
+            for entity, changes in (('activity', activities), ('deal', deals)):
+                for entity_id, action in changes.items():
+                    key = (entity, entity_id)
+                    if counted:
+                        self._attempts[key] = self._attempts.get(key, 0) + 1
+                        if self._attempts[key] >= self.max_attempts:
+                            self._attempts.pop(key)
+                            dropped += 1
+                            continue
+                    self._pending[entity].setdefault(entity_id, action)
+            self._stats["dropped"] += dropped
+            self._stats["last_error"] = str(e)
+            logger.error(f"Error applying Bitrix events: {e}" + (f", dropped {dropped}" if dropped else ""))
+            if self._pending['activity'] or self._pending['deal']:
+                self._schedule_retry()
+
+    def _schedule_retry(self):
+        """Будит воркер для повтора через паузу, растущую после каждой неудачи"""
+        self._retry_delay = min(self.retry_max_delay, max(self.flush_delay, 1.0, self._retry_delay * 2))
+        if self._retry_handle:
+            self._retry_handle.cancel()
+        self._retry_handle = asyncio.get_running_loop().call_later(self._retry_delay, self._wakeup.set)
+        logger.info(f"📨 Retrying Bitrix events in {self._retry_delay:.0f}s")
+
+    async def _apply_activities(self, changes: Dict[str, str]):
+        ids = list(changes.keys())
+        touched_dates = set(await self.warehouse_service.get_activity_dates(ids))
+
+        upsert_ids = [entity_id for entity_id, action in changes.items() if action == 'upsert']
+        fetched = await self.bitrix_service.get_activities_by_ids(upsert_ids) if upsert_ids else []
+        fetched_ids = {str(activity['ID']) for activity in fetched}
+
+        # Удаленные и не найденные на портале активности убираем из кэша
+        gone_ids = [entity_id for entity_id in ids if entity_id not in fetched_ids]
+        if gone_ids:
+            await self.warehouse_service.delete_activities(gone_ids)
+        if fetched:
+            await self.warehouse_service.cache_activities(fetched)
+            touched_dates.update(str(activity.get('CREATED', ''))[:10] for activity in fetched)
+
+        await self.warehouse_service.refresh_snapshots(sorted(d for d in touched_dates if d))
+        logger.info(f"📨 Applied activity events: {len(fetched)} upserted, {len(gone_ids)} deleted")
+
+    async def _apply_deals(self, changes: Dict[str, str]):
+        upsert_ids = [entity_id for entity_id, action in changes.items() if action == 'upsert']
+        fetched = await self.bitrix_service.get_deals_by_ids(upsert_ids) if upsert_ids else []
+        fetched_ids = {str(deal['ID']) for deal in fetched}
+
+        gone_ids = [entity_id for entity_id in changes if entity_id not in fetched_ids]
+        if gone_ids:
+            await self.warehouse_service.delete_deals(gone_ids)
+        if fetched:
+            await self.warehouse_service.upsert_deals(fetched)
+        logger.info(f"📨 Applied deal events: {len(fetched)} upserted, {len(gone_ids)} deleted")
+
+    def get_status(self) -> Dict:
+        return {
+            **self._stats,
+            "token_configured": bool(self.application_token),
+            "pending_activities": len(self._pending['activity']),
+            "pending_deals": len(self._pending['deal'])
+        }
@@ -1,27 +1,425 @@
 import aiohttp
 import os
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
+from urllib.parse import urlencode
 import logging
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import contextvars
+import json
+import random
+import time
 import aiosqlite
 
+from app.services import json_codec, metrics
+from app.services.deal_stage_service import build_stage_index, resolve_stage
+
 logger = logging.getLogger(__name__)
 
+# Сотрудники пресейла, по которым строится дашборд
+PRESALES_USER_IDS = ['8860', '8988', '17087', '17919', '17395', '18065']
+
+# Справочники crm.status.list, из которых собирается словарь стадий сделок
+DEAL_STAGE_ENTITIES = ['DEAL_STAGE', 'DEAL_TYPE', 'STATUS']
+
+# Поля сделок, которые нужны дашборду
+DEAL_SELECT_FIELDS = ['ID', 'TITLE', 'STAGE_ID', 'ASSIGNED_BY_ID', 'DATE_CREATE', 'DATE_MODIFY', 'OPPORTUNITY', 'CURRENCY_ID', 'TYPE_ID', 'STATUS_ID']
+
+# Сделки в одном запросе crm.stagehistory.list (фильтр по массиву OWNER_ID)
+STAGE_HISTORY_OWNER_CHUNK = 50
+
+# Bitrix24 принимает не больше 50 команд в одном batch-запросе
+BATCH_MAX_COMMANDS = 50
+
+# Профили полей crm.activity.list: stats - только то, что нужно для подсчетов,
+# detail - для показа активностей, full - все поля (select[] не передается)
+ACTIVITY_SELECT_PROFILES = {
+    'stats': ['ID', 'AUTHOR_ID', 'TYPE_ID', 'CREATED'],
+    'detail': [
+        'ID', 'AUTHOR_ID', 'RESPONSIBLE_ID', 'TYPE_ID', 'CREATED', 'LAST_UPDATED',
+        'COMPLETED', 'DIRECTION', 'OWNER_ID', 'OWNER_TYPE_ID', 'SUBJECT', 'DESCRIPTION'
+    ],
+    'full': None,
+}
+
+# Пользователи с большим числом активностей за период грузятся отдельными циклами,
+# остальные - одной общей выборкой по списку AUTHOR_ID
+HEAVY_USER_ACTIVITY_THRESHOLD = 500
+
+# Разбивка больших периодов: соседние дни склеиваются в часть, пока в ней
+# не больше ACTIVITY_CHUNK_TARGET активностей и не больше ACTIVITY_CHUNK_MAX_DAYS дней
+ACTIVITY_CHUNK_TARGET = 2000
+ACTIVITY_CHUNK_MAX_DAYS = 31
+
+# Таймауты по классам методов: соединение короткое, чтение зависит от объема ответа
+REQUEST_TIMEOUTS = {
+    'default': aiohttp.ClientTimeout(total=None, connect=10, sock_connect=5, sock_read=30),
+    'list': aiohttp.ClientTimeout(total=None, connect=10, sock_connect=5, sock_read=60),
+    'batch': aiohttp.ClientTimeout(total=None, connect=10, sock_connect=5, sock_read=120),
+}
+
+
+def _timeout_for(method: str) -> aiohttp.ClientTimeout:
+    """Таймаут для метода: batch и списочные методы читаются дольше"""
+    if method == "batch":
+        return REQUEST_TIMEOUTS['batch']
+    if method.endswith('.list') or method == 'user.get':
+        return REQUEST_TIMEOUTS['list']
+    return REQUEST_TIMEOUTS['default']
+
+
+def _flatten_params(params: Dict) -> List[Tuple[str, Any]]:
+    """Разворачивает параметры в пары ключ-значение в формате PHP (key[]=a&key[]=b)"""
+    items = []
+    for key, value in (params or {}).items():
+        if isinstance(value, (list, tuple)):
+            list_key = key if key.endswith('[]') else f"{key}[]"
+            items.extend((list_key, str(v)) for v in value)
+        elif value is not None:
+            items.append((key, str(value)))
+    return items
+
+
+# Ошибки авторизации: повторять бессмысленно, нужен новый вебхук/права
+AUTH_ERRORS = {
+    'NO_AUTH_FOUND', 'INVALID_CREDENTIALS', 'expired_token', 'invalid_token',
+    'insufficient_scope', 'ACCESS_DENIED', 'WRONG_AUTH_TYPE', 'authorization_error'
+}
+# Временные ошибки портала: имеет смысл повторить с паузой
+TRANSIENT_ERRORS = {'QUERY_LIMIT_EXCEEDED', 'INTERNAL_SERVER_ERROR', 'OPERATION_TIME_LIMIT'}
+TRANSIENT_HTTP_STATUSES = {429, 500, 502, 503, 504}
+
+# Методы только на чтение - их одинаковые одновременные вызовы можно склеивать
+READ_METHOD_SUFFIXES = {'list', 'get', 'current', 'time', 'fields'}
+
+
+class BitrixError(Exception):
+    """Базовая ошибка обращения к Bitrix24"""
+
+
+class BitrixAuthError(BitrixError):
+    """Ошибка авторизации вебхука - без повторов"""
+
+
+class BitrixTransientError(BitrixError):
+    """Временная ошибка (лимит запросов, 5xx, таймаут) - повторяется"""
+
+
+class BitrixUnavailableError(BitrixError):
+    """Повторы исчерпаны или портал признан недоступным (circuit open)"""
+
+
+class BitrixOfflineError(BitrixError):
+    """Запрос к Bitrix24 внутри bitrix_offline() - эндпоинт обязан обойтись кэшем"""
+
+
+# Флаг "только кэш" для текущей задачи: все запросы к Bitrix24 запрещены
+_offline = contextvars.ContextVar('bitrix_offline', default=False)
+
+
+@contextlib.contextmanager
+def bitrix_offline():
+    """Блок, в котором любой запрос к Bitrix24 падает с BitrixOfflineError
+
+    Флаг наследуют и задачи, созданные внутри блока.
+    """
+    token = _offline.set(True)
+    try:
+        yield
+    finally:
+        _offline.reset(token)
+
+
+def is_bitrix_offline() -> bool:
+    return _offline.get()
+
+
+class CircuitBreaker:
+    """Размыкатель: после серии неудачных запросов на время перестает ходить в Bitrix
+
+    closed - запросы идут; open - запросы сразу отклоняются reset_timeout секунд;
+    half_open - пропускается один пробный запрос, успех замыкает цепь.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == 'open' and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+            self._probe_in_flight = False
+        if self.state == 'half_open' and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info("✅ Bitrix circuit closed")
+        self.state = 'closed'
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """Освобождает пробный слот, если проба завершилась без исхода (отмена)"""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f"⚠️ Bitrix circuit opened after {self.failures} failures")
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'state': 'open' if self.is_open else self.state,
+            'failures': self.failures,
+            'failure_threshold': self.failure_threshold,
+            'reset_timeout': self.reset_timeout
+        }
+
+
+class BitrixRateLimiter:
+    """Общий лимитер запросов к Bitrix24 для всех вызывающих
+
+    Token bucket (темп rate запросов/сек с запасом burst) плюс ограничение
+    числа одновременных запросов. Темп подстраивается по блоку time из ответов:
+    чем ближе operating метода к лимиту портала (480 сек за 10 минут), тем
+    медленнее идут запросы; QUERY_LIMIT_EXCEEDED урезает темп вдвое, спокойные
+    ответы плавно возвращают его к базовому.
+    """
+
+    OPERATING_LIMIT = 480
+
+    def __init__(self, rate: float = 2.0, burst: int = 50, max_in_flight: int = 6, min_rate: float = 0.5):
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.tokens = float(burst)
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.limit_exceeded_count = 0
+        self._operating = {}
+        self._updated_at = time.monotonic()
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        """Ждет свободный слот и токен; запросы обслуживаются по очереди"""
+        started = time.perf_counter()
+        self.queue_depth += 1
+        try:
+            await self._semaphore.acquire()
+            try:
+                async with self._lock:
+                    self._refill()
+                    while self.tokens < 1:
+                        await asyncio.sleep((1 - self.tokens) / self.rate)
+                        self._refill()
+                    self.tokens -= 1
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.queue_depth -= 1
+        self.in_flight += 1
+        metrics.bitrix_limiter_wait.observe(time.perf_counter() - started)
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def observe(self, method: str, time_info: Optional[Dict]):
+        """Подстраивает темп по блоку time из ответа Bitrix"""
+        if not time_info:
+            return
+
+        operating = float(time_info.get('operating') or 0)
+        self._operating[method] = operating
+        metrics.bitrix_operating_seconds.set(operating, method=method)
+        load = operating / self.OPERATING_LIMIT
+
+        if load > 0.5:
+            # Чем ближе к лимиту, тем сильнее притормаживаем
+            self.rate = max(self.min_rate, self.base_rate * (1 - load))
+        elif self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + 0.1)
+
+    def on_limit_exceeded(self):
+        """Bitrix ответил QUERY_LIMIT_EXCEEDED - резко снижаем темп"""
+        self.limit_exceeded_count += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        logger.warning(f"⚠️ Bitrix rate limit exceeded, slowing down to {self.rate:.2f} req/s")
+
+    def get_status(self) -> Dict[str, Any]:
+        """Текущее состояние лимитера для мониторинга"""
+        self._refill()
+        return {
+            'rate': round(self.rate, 3),
+            'base_rate': self.base_rate,
+            'tokens': round(self.tokens, 2),
+            'burst': self.burst,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'queue_depth': self.queue_depth,
+            'limit_exceeded_count': self.limit_exceeded_count,
+            'operating': dict(self._operating)
+        }
+
+
+class ActivityStatsAccumulator:
+    """Инкрементальная статистика активностей для графиков
+
+    Принимает активности страницами (add_page) и хранит только счетчики,
+    поэтому память не зависит от длины периода.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.daily_stats = {}
+        self.hourly_stats = {str(i).zfill(2): 0 for i in range(24)}
+        self.type_stats = {}
+        self.weekday_stats = {
+            'Monday': 0, 'Tuesday': 0, 'Wednesday': 0, 'Thursday': 0,
+            'Friday': 0, 'Saturday': 0, 'Sunday': 0
+        }
+
+    def add_page(self, activities: List[Dict]):
+        for activity in activities:
+            created_str = activity['CREATED'].replace('Z', '+00:00')
+            activity_date = datetime.fromisoformat(created_str)
+            date_key = activity_date.strftime('%Y-%m-%d')
+            hour_key = activity_date.strftime('%H')
+            weekday = activity_date.strftime('%A')
+            type_id = str(activity['TYPE_ID'])
+
+            if date_key not in self.daily_stats:
+                self.daily_stats[date_key] = {'date': date_key, 'day_of_week': weekday, 'total': 0, 'by_type': {}}
+
+            self.daily_stats[date_key]['total'] += 1
+            self.daily_stats[date_key]['by_type'][type_id] = self.daily_stats[date_key]['by_type'].get(type_id, 0) + 1
+            self.type_stats[type_id] = self.type_stats.get(type_id, 0) + 1
+            self.hourly_stats[hour_key] += 1
+            self.weekday_stats[weekday] += 1
+            self.total += 1
+
+    def result(self, start_date: str = '', end_date: str = '') -> Dict[str, Any]:
+        if not self.total:
+            return {}
+
+        sorted_daily = sorted(self.daily_stats.values(), key=lambda x: x['date'])
+
+        return {
+            'total_activities': self.total,
+            'daily_stats': sorted_daily,
+            'hourly_stats': self.hourly_stats,
+            'type_stats': self.type_stats,
+            'weekday_stats': self.weekday_stats,
+            'date_range': {
+                'start': sorted_daily[0]['date'] if sorted_daily else start_date,
+                'end': sorted_daily[-1]['date'] if sorted_daily else end_date
+            }
+        }
+
+
 class BitrixService:
     def __init__(self):
         self.webhook_url = os.getenv("BITRIX_WEBHOOK_URL")
         self.session = None
         self._cache = {}
         self._cache_ttl = 10 * 60
-        self.executor = ThreadPoolExecutor(max_workers=5)
+        self.rate_limiter = BitrixRateLimiter(
+            rate=float(os.getenv("BITRIX_RATE_LIMIT", "2")),
+            burst=int(os.getenv("BITRIX_RATE_BURST", "50")),
+            max_in_flight=int(os.getenv("BITRIX_MAX_IN_FLIGHT", "6"))
+        )
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv("BITRIX_CIRCUIT_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("BITRIX_CIRCUIT_RESET", "60"))
+        )
+        self.max_retries = int(os.getenv("BITRIX_MAX_RETRIES", "4"))
+        self.retry_base_delay = 0.5
+        self.retry_max_delay = 10
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.coalesced_requests = 0
+        # Словарь стадий (DealStageService); подключается в main.py
+        self.stage_service = None
+        # Хранилище истории стадий (DataWarehouseService); подключается в main.py
+        self.stage_history_store = None
+        self.stage_history_concurrency = int(os.getenv("BITRIX_STAGE_HISTORY_CONCURRENCY", "4"))
+        # Сколько частей большого периода грузится одновременно (темп держит rate_limiter)
+        self.chunk_concurrency = int(os.getenv("BITRIX_CHUNK_CONCURRENCY", "3"))
         
+    async def open_session(self):
+        """Создает пул соединений к порталу (вызывается из lifespan приложения)
+
+        Число соединений к хосту совпадает с лимитом одновременных запросов
+        rate_limiter, соединения переиспользуются (keep-alive), DNS кэшируется.
+        """
+        if self.session is not None and not self.session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.rate_limiter.max_in_flight * 2,
+            limit_per_host=self.rate_limiter.max_in_flight,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+            enable_cleanup_closed=True
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=REQUEST_TIMEOUTS['default'],
+            headers={'Accept-Encoding': 'gzip, deflate'}
+        )
+        logger.info(f"✅ Bitrix session opened (max {self.rate_limiter.max_in_flight} connections per host)")
+
     async def ensure_session(self):
-        """Создает сессию если её нет"""
+        """Создает сессию если её нет (для вызовов вне lifespan)"""
         if self.session is None or self.session.closed:
-            timeout = aiohttp.ClientTimeout(total=120)
-            self.session = aiohttp.ClientSession(timeout=timeout)
+            await self.open_session()
+
+    async def warm_up(self):
+        """Прогревает соединение: DNS, TCP и TLS-рукопожатие до первого запроса дашборда"""
+        if not self.webhook_url:
+            return
+
+        await self.ensure_session()
+        try:
+            # Одна попытка без повторов: старт приложения не должен зависеть от портала
+            await self._send("server.time", f"{self.webhook_url}/server.time")
+            logger.info("✅ Bitrix connection warmed up")
+        except BitrixError as e:
+            logger.warning(f"⚠️ Bitrix warm-up failed: {e}")
 
     async def close_session(self):
         """Закрывает сессию"""
@@ -30,11 +428,80 @@ class BitrixService:
             self.session = None
 
     async def make_bitrix_request(self, method: str, params: Dict = None) -> Optional[Dict]:
-        """Выполняет запрос к Bitrix24 API"""
-        if not self.webhook_url:
-            logger.error("BITRIX_WEBHOOK_URL не настроен")
+        """Выполняет запрос к Bitrix24 API (None при любой ошибке)
+
+        Для постраничных загрузок используйте _request: None здесь нельзя
+        отличить от пустой страницы.
+        """
+        try:
+            return await self._request(method, params)
+        except BitrixError as e:
+            logger.error(f"Bitrix request {method} failed: {e}")
             return None
 
+    async def _request(self, method: str, params: Dict = None) -> Any:
+        """Запрос к Bitrix24 с single-flight склейкой одинаковых вызовов
+
+        Если такой же запрос на чтение (метод + те же параметры) уже выполняется,
+        новый вызов ждет его результат вместо повторного похода в портал.
+        Запрос выполняется отдельной задачей, поэтому отмена одного из
+        ожидающих не отменяет его для остальных.
+        """
+        if _offline.get():
+            metrics.bitrix_requests.inc(method=method, outcome='offline_blocked')
+            raise BitrixOfflineError(f"{method}: network access is disabled for cache-only requests")
+
+        if not self._is_read_method(method):
+            return await self._request_with_retries(method, params)
+
+        key = self._request_key(method, params)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced_requests += 1
+            metrics.bitrix_coalesced.inc()
+            logger.info(f"🔗 Joining in-flight request: {method}")
+        else:
+            task = asyncio.create_task(self._request_with_retries(method, params))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def _is_read_method(method: str) -> bool:
+        return method == "batch" or method.rsplit('.', 1)[-1] in READ_METHOD_SUFFIXES
+
+    @staticmethod
+    def _request_key(method: str, params: Dict = None) -> str:
+        """Ключ запроса: метод + нормализованные параметры"""
+        return method + '?' + json.dumps(sorted(_flatten_params(params)), ensure_ascii=False)
+
+    async def _request_with_retries(self, method: str, params: Dict = None) -> Any:
+        """Запрос к Bitrix24 с повторами, экспоненциальной паузой и circuit breaker
+
+        Временные ошибки (лимит запросов, 5xx, таймауты) повторяются с jitter,
+        ошибки авторизации и прочие ошибки API пробрасываются сразу.
+        Бросает BitrixUnavailableError, если повторы исчерпаны или цепь разомкнута.
+
+        Для circuit breaker ошибка API (неверный фильтр, нет доступа к сущности)
+        считается успехом - портал ответил; ошибка авторизации и любое
+        непредвиденное исключение - неудачей: с битым вебхуком ходить в портал
+        бессмысленно. Если запрос отменен, пробный слот half_open освобождается.
+        """
+        if not self.webhook_url:
+            raise BitrixAuthError("BITRIX_WEBHOOK_URL не настроен")
+
+        if not self.circuit_breaker.allow():
+            raise BitrixUnavailableError(f"Bitrix circuit is open, {method} skipped")
+        is_probe = self.circuit_breaker.state == 'half_open'
+
+        try:
+            return await self._attempt_with_retries(method, params)
+        finally:
+            if is_probe:
+                self.circuit_breaker.release_probe()
+
+    async def _attempt_with_retries(self, method: str, params: Dict = None) -> Any:
         await self.ensure_session()
         url = f"{self.webhook_url}/{method}"
         
@@ -43,28 +510,195 @@ class BitrixService:
             logger.info(f"🔍 Params keys: {list(params.keys())}")
             if 'filter[ASSIGNED_BY_ID]' in params:
                 logger.info(f"🔍 ASSIGNED_BY_ID filter: {params['filter[ASSIGNED_BY_ID]']}")
-        
+
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+                logger.warning(f"🔁 Retry {attempt}/{self.max_retries} for {method} in {delay:.1f}s: {last_error}")
+                metrics.bitrix_retries.inc(method=method)
+                await asyncio.sleep(delay)
+
+            try:
+                result = await self._send(method, url, params)
+            except BitrixTransientError as e:
+                metrics.bitrix_requests.inc(method=method, outcome='transient_error')
+                metrics.bitrix_errors.inc(method=method, error_class=type(e).__name__)
+                last_error = e
+                continue
+            except BitrixAuthError as e:
+                metrics.bitrix_requests.inc(method=method, outcome='error')
+                metrics.bitrix_errors.inc(method=method, error_class=type(e).__name__)
+                self.circuit_breaker.record_failure()
+                raise
+            except BitrixError as e:
+                metrics.bitrix_requests.inc(method=method, outcome='error')
+                metrics.bitrix_errors.inc(method=method, error_class=type(e).__name__)
+                self.circuit_breaker.record_success()
+                raise
+            except Exception as e:
+                metrics.bitrix_requests.inc(method=method, outcome='error')
+                metrics.bitrix_errors.inc(method=method, error_class=type(e).__name__)
+                self.circuit_breaker.record_failure()
+                raise
+
+            metrics.bitrix_requests.inc(method=method, outcome='ok')
+            self.circuit_breaker.record_success()
+            return result
+
+        self.circuit_breaker.record_failure()
+        raise BitrixUnavailableError(f"{method} failed after {self.max_retries + 1} attempts: {last_error}")
+
+    async def _send(self, method: str, url: str, params: Dict = None) -> Any:
+        """Одна попытка HTTP-запроса с классификацией ошибок"""
         try:
-            async with self.session.get(url, params=params) as response:
-                logger.info(f"🔍 Response status: {response.status}")
-                if response.status == 200:
-                    data = await response.json()
-                    if 'result' in data:
-                        logger.info(f"🔍 Bitrix API Success: got {len(data['result'])} results")
-                        return data['result']
-                    elif 'error' in data:
-                        logger.error(f"Bitrix API error: {data['error']}")
-                        return None
+            async with self.rate_limiter:
+                # batch уходит POST-ом: 50 команд с фильтрами не влезают в URL
+                timeout = _timeout_for(method)
+                if method == "batch":
+                    request = self.session.post(url, data=_flatten_params(params), timeout=timeout)
                 else:
-                    error_text = await response.text()
-                    logger.error(f"HTTP error {response.status} for {url}: {error_text}")
-                    return None
+                    request = self.session.get(url, params=_flatten_params(params), timeout=timeout)
+
+                request_started = time.perf_counter()
+                try:
+                    return await self._read_response(method, url, params, request)
+                finally:
+                    metrics.bitrix_request_duration.observe(time.perf_counter() - request_started, method=method)
         except asyncio.TimeoutError:
             logger.error(f"Timeout error for method {method}")
-            return None
-        except Exception as e:
+            raise BitrixTransientError(f"Timeout for {method}")
+        except aiohttp.ClientError as e:
             logger.error(f"Request error: {str(e)}")
-            return None
+            raise BitrixTransientError(f"Connection error: {e}")
+
+    async def _read_response(self, method: str, url: str, params: Dict, request) -> Any:
+        """Читает и разбирает ответ Bitrix24, ошибки превращает в исключения"""
+        async with request as response:
+            logger.info(f"🔍 Response status: {response.status}")
+            if response.status == 200:
+                body = await response.read()
+                metrics.bitrix_response_bytes.inc(len(body), method=method)
+                row_fields = (params or {}).get('select[]') if method.endswith('.list') else None
+                try:
+                    data = json_codec.decode_bitrix_response(body, row_fields)
+                except Exception as e:
+                    # HTML-заглушка прокси или обрезанный ответ - как временная ошибка
+                    raise BitrixTransientError(f"Malformed response for {method}: {e}") from e
+                if not isinstance(data, dict):
+                    raise BitrixTransientError(f"Unexpected response for {method}: {type(data).__name__}")
+                self.rate_limiter.observe(method, data.get('time'))
+                if 'result' in data:
+                    result = data['result']
+                    logger.info(f"🔍 Bitrix API Success: got {len(result) if isinstance(result, (list, dict)) else 1} results")
+                    return result
+                elif 'error' in data:
+                    self._raise_api_error(data['error'], data.get('error_description'))
+                return None
+
+            error_text = await response.text()
+            logger.error(f"HTTP error {response.status} for {url}: {error_text}")
+            try:
+                error_data = json_codec.loads(error_text)
+            except ValueError:
+                error_data = None
+            if isinstance(error_data, dict) and 'error' in error_data:
+                self._raise_api_error(error_data['error'], error_data.get('error_description'), response.status)
+            if response.status in (401, 403):
+                raise BitrixAuthError(f"HTTP {response.status}")
+            if response.status in TRANSIENT_HTTP_STATUSES:
+                raise BitrixTransientError(f"HTTP {response.status}")
+            raise BitrixError(f"HTTP {response.status}: {error_text[:200]}")
+
+    def _raise_api_error(self, error: str, description: str = None, status: int = 200):
+        """Переводит код ошибки Bitrix в исключение нужного класса"""
+        message = f"{error}: {description}" if description else str(error)
+        logger.error(f"Bitrix API error: {message}")
+        if error == 'QUERY_LIMIT_EXCEEDED':
+            self.rate_limiter.on_limit_exceeded()
+        if error in TRANSIENT_ERRORS or status in TRANSIENT_HTTP_STATUSES:
+            raise BitrixTransientError(message)
+        if error in AUTH_ERRORS or status in (401, 403):
+            raise BitrixAuthError(message)
+        raise BitrixError(message)
+
+    async def call_batch(self, commands: Dict[str, Tuple[str, Dict]], halt: bool = False) -> Dict[str, Dict]:
+        """Выполняет набор вызовов через метод batch (до 50 команд за HTTP-запрос)
+
+        commands: {ключ: (метод, параметры)}.
+        Возвращает {ключ: {'result', 'error', 'total', 'next'}} для каждой команды.
+        """
+        results = {}
+        keys = list(commands.keys())
+
+        for offset in range(0, len(keys), BATCH_MAX_COMMANDS):
+            chunk = keys[offset:offset + BATCH_MAX_COMMANDS]
+            params = {'halt': 1 if halt else 0}
+            for key in chunk:
+                method, cmd_params = commands[key]
+                query = urlencode(_flatten_params(cmd_params))
+                params[f'cmd[{key}]'] = f"{method}?{query}" if query else method
+
+            response = await self._request("batch", params) or {}
+
+            # Пустые словари PHP отдает как [], поэтому нормализуем
+            cmd_results = response.get('result') or {}
+            cmd_errors = response.get('result_error') or {}
+            cmd_totals = response.get('result_total') or {}
+            cmd_next = response.get('result_next') or {}
+
+            for key in chunk:
+                error = cmd_errors.get(key)
+                results[key] = {
+                    'result': None if error else cmd_results.get(key),
+                    'error': error,
+                    'total': cmd_totals.get(key),
+                    'next': cmd_next.get(key)
+                }
+                if error:
+                    logger.error(f"Bitrix batch command {key} error: {error}")
+
+            logger.info(f"📦 Batch executed: {len(chunk)} commands")
+
+        return results
+
+    async def iter_list_by_id(self, method: str, params: Dict = None, limit: int = None):
+        """Постраничный обход списочного crm-метода по ID-курсору (keyset pagination)
+
+        Вместо start += 50 сортирует по ID, на каждой странице фильтрует
+        filter[>ID] по последнему полученному ID и передает start=-1, чтобы
+        Bitrix не считал total. Стоимость страницы не растет с глубиной.
+        Отдает страницы (списки записей) по мере получения.
+        """
+        base_params = {k: v for k, v in (params or {}).items() if not k.startswith('order[') and k != 'start'}
+        last_id = int(base_params.pop('filter[>ID]', 0) or 0)
+
+        select = base_params.get('select[]')
+        if select and 'ID' not in select:
+            base_params['select[]'] = ['ID'] + list(select)
+
+        loaded = 0
+        while True:
+            page_params = dict(base_params)
+            page_params['order[ID]'] = 'ASC'
+            page_params['filter[>ID]'] = last_id
+            page_params['start'] = -1
+
+            page = await self._request(method, page_params)
+            if not page:
+                break
+
+            if limit and loaded + len(page) >= limit:
+                yield page[:limit - loaded]
+                break
+
+            yield page
+            loaded += len(page)
+
+            if len(page) < 50:
+                break
+
+            last_id = int(page[-1]['ID'])
 
     async def test_connection(self) -> bool:
         """Проверяет подключение к Bitrix24"""
@@ -85,6 +719,48 @@ class BitrixService:
             logger.error(f"Error getting user by ID {user_id}: {str(e)}")
             return None
 
+    async def get_users_by_ids(self, user_ids: List[str]) -> List[Dict]:
+        """Пользователи по списку ID одним запросом user.get
+
+        Если портал вернул не всех (фильтр по массиву ID поддерживается не везде),
+        недостающие добираются одним batch-запросом. Ошибки Bitrix пробрасываются.
+        """
+        user_ids = [str(uid) for uid in user_ids]
+        users = await self._request("user.get", {'FILTER[ID]': user_ids}) or []
+        found = {str(u['ID']): u for u in users if str(u.get('ID')) in user_ids}
+
+        missing = [uid for uid in user_ids if uid not in found]
+        if missing:
+            results = await self.call_batch({f"u{uid}": ("user.get", {'ID': uid}) for uid in missing})
+            for uid in missing:
+                page = results[f"u{uid}"].get('result') or []
+                if page:
+                    found[uid] = page[0]
+
+        return [found[uid] for uid in user_ids if uid in found]
+
+    async def get_users_modified_since(self, timestamp: str) -> List[Dict]:
+        """Пользователи, измененные не раньше timestamp (по полю TIMESTAMP_X, включительно)"""
+        users = []
+        start = 0
+        while True:
+            page = await self._request("user.get", {
+                'FILTER[>=TIMESTAMP_X]': timestamp,
+                'sort': 'ID',
+                'order': 'ASC',
+                'start': start
+            })
+            if not page:
+                break
+
+            users.extend(page)
+            if len(page) < 50:
+                break
+            start += 50
+
+        logger.info(f"👥 {len(users)} users modified since {timestamp}")
+        return users
+
     async def get_presales_users(self) -> Optional[List[Dict]]:
         """Получает список сотрудников пресейла по жёстко заданным ID с кэшированием"""
         try:
@@ -92,14 +768,15 @@ class BitrixService:
             if cache_key in self._cache:
                 cache_time, cached_data = self._cache[cache_key]
                 if (datetime.now() - cache_time).total_seconds() < self._cache_ttl:
+                    metrics.cache_lookups.inc(cache=cache_key, result='hit')
                     return cached_data
+            metrics.cache_lookups.inc(cache=cache_key, result='miss')
 
-            known_presales_ids = ['8860', '8988', '17087', '17919', '17395', '18065']
+            users_by_id = {str(u['ID']): u for u in await self.get_users_by_ids(PRESALES_USER_IDS)}
             presales_users = []
-            for user_id in known_presales_ids:
-                user = await self.get_user_by_id(user_id)
-                if user:
-                    presales_users.append(user)
+            for user_id in PRESALES_USER_IDS:
+                if user_id in users_by_id:
+                    presales_users.append(users_by_id[user_id])
                 else:
                     logger.warning(f"Presales user ID {user_id} not found in Bitrix24")
 
@@ -107,7 +784,7 @@ class BitrixService:
             return presales_users
         except Exception as e:
             logger.error(f"Error in get_presales_users: {str(e)}")
-            return None
+            return self._get_stale_cache("presales_users")
 
     async def get_activities(
         self,
@@ -115,348 +792,435 @@ class BitrixService:
         start_date: str = None,
         end_date: str = None,
         user_ids: List[str] = None,
-        activity_types: List[str] = None
+        activity_types: List[str] = None,
+        use_batch: bool = False,
+        fields: str = 'stats',
+        completed: Optional[bool] = None,
+        multi_author: bool = True
     ) -> Optional[List[Dict]]:
-        """ОСНОВНОЙ МЕТОД - получение активностей БЕЗ ОГРАНИЧЕНИЙ"""
+        """ОСНОВНОЙ МЕТОД - получение активностей БЕЗ ОГРАНИЧЕНИЙ
+
+        use_batch=True собирает страницы всех пользователей в batch-запросы.
+        multi_author=True грузит нескольких пользователей общей выборкой
+        (см. _get_activities_multi_author), иначе - отдельным циклом на каждого.
+        fields - профиль полей из ACTIVITY_SELECT_PROFILES ('stats', 'detail', 'full').
+        completed - фильтр по завершенности на стороне Bitrix (None - все активности).
+        """
         try:
-            # Определяем диапазон дат
-            if start_date and end_date:
-                start_date_obj = datetime.fromisoformat(start_date)
-                end_date_obj = datetime.fromisoformat(end_date)
-                start_date_obj = start_date_obj.replace(hour=0, minute=0, second=0, microsecond=0)
-                end_date_obj = end_date_obj.replace(hour=23, minute=59, second=59, microsecond=999999)
-                
-                total_days = (end_date_obj - start_date_obj).days + 1
-                logger.info(f"📅 Loading activities for {total_days} days")
-                        
-            elif days:
-                end_date_obj = datetime.now().replace(hour=23, minute=59, second=59, microsecond=999999)
-                start_date_obj = (end_date_obj - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
-                logger.info(f"📅 Loading activities for {days} days")
-            else:
-                end_date_obj = datetime.now().replace(hour=23, minute=59, second=59, microsecond=999999)
-                start_date_obj = (end_date_obj - timedelta(days=30)).replace(hour=0, minute=0, second=0, microsecond=0)
-                logger.info(f"📅 Loading activities for 30 days (default)")
-
-            start_date_str = start_date_obj.strftime("%Y-%m-%dT%H:%M:%S")
-            end_date_str = end_date_obj.strftime("%Y-%m-%dT%H:%M:%S")
+            start_date_str, end_date_str = self._resolve_period(days, start_date, end_date)
+            final_user_ids = await self._resolve_activity_user_ids(user_ids)
 
-            # Определяем, по каким пользователям фильтровать
-            final_user_ids = None
-            if user_ids and user_ids != ["all"]:
-                final_user_ids = [str(uid) for uid in user_ids]
-            else:
-                presales = await self.get_presales_users()
-                if presales:
-                    final_user_ids = [str(user["ID"]) for user in presales]
+            logger.info(f"🔍 get_activities: user_ids={final_user_ids}, start_date={start_date_str}, end_date={end_date_str}, fields={fields}")
 
-            logger.info(f"🔍 get_activities: user_ids={final_user_ids}, start_date={start_date_str}, end_date={end_date_str}")
+            query_params = self._activity_query_params(
+                start_date_str, end_date_str, activity_types, fields, completed
+            )
 
             # Параллельные запросы для всех пользователей
             all_activities = []
             
-            if final_user_ids:
+            if final_user_ids and use_batch:
+                all_activities = await self._get_activities_batched(final_user_ids, query_params)
+            elif final_user_ids and multi_author and len(final_user_ids) > 1:
+                all_activities = await self._get_activities_multi_author(final_user_ids, query_params)
+            elif final_user_ids:
                 tasks = []
                 for user_id in final_user_ids:
-                    task = self._get_activities_for_single_user(
-                        user_id, start_date_str, end_date_str, activity_types
-                    )
+                    task = self._get_activities_for_single_user(user_id, query_params)
                     tasks.append(task)
                 
                 results = await asyncio.gather(*tasks, return_exceptions=True)
                 
+                errors = []
                 for i, user_activities in enumerate(results):
                     if isinstance(user_activities, Exception):
                         logger.error(f"Error getting activities for user {final_user_ids[i]}: {user_activities}")
+                        errors.append(user_activities)
                     elif user_activities:
                         all_activities.extend(user_activities)
                         logger.info(f"🔍 User {final_user_ids[i]}: got {len(user_activities)} activities")
 
-            # Фильтрация завершенных активностей
-            filtered_activities = await self._filter_completed_activities(all_activities)
-            
-            logger.info(f"📊 FINAL ACTIVITIES: {len(all_activities)} total, {len(filtered_activities)} completed")
+                # Неполный набор нельзя отдавать: он попадет в хранилище как полный
+                if errors:
+                    raise errors[0]
+
+            logger.info(f"📊 FINAL ACTIVITIES: {len(all_activities)} total")
 
             # Проверим распределение по пользователям
-            if filtered_activities:
+            if all_activities:
                 user_distribution = {}
-                for act in filtered_activities:
+                for act in all_activities:
                     user_id = str(act.get('AUTHOR_ID', ''))
                     user_distribution[user_id] = user_distribution.get(user_id, 0) + 1
-                logger.info(f"📊 Completed activities by user: {user_distribution}")
+                logger.info(f"📊 Activities by user: {user_distribution}")
 
-            return filtered_activities
+            return all_activities
 
         except Exception as e:
             logger.error(f"Error in get_activities: {str(e)}")
             return None
 
-    async def _get_activities_for_single_user(
-        self, 
-        user_id: str, 
-        start_date_str: str, 
-        end_date_str: str, 
-        activity_types: List[str] = None
-    ) -> List[Dict]:
-        """Получение активностей для одного пользователя С ОГРАНИЧЕНИЯМИ"""
-        user_activities = []
-        start = 0
-        request_count = 0
-        max_requests = 20
-        max_activities_per_user = 500
-
-        while request_count < max_requests and len(user_activities) < max_activities_per_user:
-            params = {
-                'filter[>=CREATED]': start_date_str,
-                'filter[<=CREATED]': end_date_str,
-                'filter[AUTHOR_ID]': user_id,
-                'start': start,
-                'order[CREATED]': 'DESC'
-            }
-
-            if activity_types:
-                params['filter[TYPE_ID]'] = activity_types
+    def _resolve_period(self, days: int = None, start_date: str = None, end_date: str = None) -> Tuple[str, str]:
+        """Границы периода для фильтра CREATED (по умолчанию - последние 30 дней)"""
+        if start_date and end_date:
+            start_date_obj = datetime.fromisoformat(start_date)
+            end_date_obj = datetime.fromisoformat(end_date)
+            start_date_obj = start_date_obj.replace(hour=0, minute=0, second=0, microsecond=0)
+            end_date_obj = end_date_obj.replace(hour=23, minute=59, second=59, microsecond=999999)
 
-            activities = await self.make_bitrix_request("crm.activity.list", params)
-            if activities is None:
-                break
-            if not activities:
-                break
+            total_days = (end_date_obj - start_date_obj).days + 1
+            logger.info(f"📅 Loading activities for {total_days} days")
+
+        elif days:
+            end_date_obj = datetime.now().replace(hour=23, minute=59, second=59, microsecond=999999)
+            start_date_obj = (end_date_obj - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+            logger.info(f"📅 Loading activities for {days} days")
+        else:
+            end_date_obj = datetime.now().replace(hour=23, minute=59, second=59, microsecond=999999)
+            start_date_obj = (end_date_obj - timedelta(days=30)).replace(hour=0, minute=0, second=0, microsecond=0)
+            logger.info(f"📅 Loading activities for 30 days (default)")
+
+        return start_date_obj.strftime("%Y-%m-%dT%H:%M:%S"), end_date_obj.strftime("%Y-%m-%dT%H:%M:%S")
+
+    async def _resolve_activity_user_ids(self, user_ids: List[str] = None) -> Optional[List[str]]:
+        """Пользователи для фильтра AUTHOR_ID: переданные или весь пресейл"""
+        if user_ids and user_ids != ["all"]:
+            return [str(uid) for uid in user_ids]
+
+        presales = await self.get_presales_users()
+        if presales:
+            return [str(user["ID"]) for user in presales]
+        return None
+
+    async def iter_activities(
+        self,
+        days: int = None,
+        start_date: str = None,
+        end_date: str = None,
+        user_ids: List[str] = None,
+        activity_types: List[str] = None,
+        fields: str = 'stats',
+        completed: Optional[bool] = None
+    ):
+        """Потоковая выдача активностей страницами по мере получения, без ограничений
+
+        Все пользователи идут одной выборкой по ID-курсору, в памяти держится
+        только текущая страница. Ошибка Bitrix пробрасывается (BitrixError),
+        чтобы потребитель не принял оборванный поток за полный.
+        """
+        start_date_str, end_date_str = self._resolve_period(days, start_date, end_date)
+        final_user_ids = await self._resolve_activity_user_ids(user_ids)
+        if not final_user_ids:
+            return
+
+        params = self._activity_query_params(start_date_str, end_date_str, activity_types, fields, completed)
+        params['filter[AUTHOR_ID]'] = final_user_ids if len(final_user_ids) > 1 else final_user_ids[0]
+
+        page_number = 0
+        async for page in self.iter_list_by_id("crm.activity.list", params):
+            page_number += 1
+            logger.info(f"🔍 Activities stream - page {page_number}: {len(page)} activities")
+            yield page
+
+    async def iter_activities_updated_since(
+        self,
+        user_ids: List[str],
+        updated_since: Optional[str] = None,
+        created_since: Optional[str] = None
+    ):
+        """Активности авторов user_ids, измененные (LAST_UPDATED) начиная с updated_since
+
+        created_since задает окно первичной загрузки. Поля - профиль 'detail',
+        чтобы страницы можно было сразу писать в activities.
+        Ошибки Bitrix пробрасываются.
+        """
+        params = {
+            'select[]': ACTIVITY_SELECT_PROFILES['detail'],
+            'filter[AUTHOR_ID]': list(user_ids)
+        }
+        if updated_since:
+            params['filter[>=LAST_UPDATED]'] = updated_since
+        if created_since:
+            params['filter[>=CREATED]'] = created_since
+
+        async for page in self.iter_list_by_id("crm.activity.list", params):
+            yield page
+
+    async def get_activities_by_ids(self, activity_ids: List[str]) -> List[Dict]:
+        """Активности по списку ID (фильтр по массиву ID, по 50 за запрос), профиль 'detail'"""
+        return await self._get_list_by_ids("crm.activity.list", activity_ids, ACTIVITY_SELECT_PROFILES['detail'])
+
+    async def get_deals_by_ids(self, deal_ids: List[str]) -> List[Dict]:
+        """Сырые сделки (без стадий) по списку ID"""
+        return await self._get_list_by_ids("crm.deal.list", deal_ids, DEAL_SELECT_FIELDS)
+
+    async def _get_list_by_ids(self, method: str, ids: List[str], select: List[str]) -> List[Dict]:
+        """Записи списочного метода по ID; удаленных записей в ответе просто нет"""
+        rows = []
+        ids = [str(entity_id) for entity_id in ids]
+        for offset in range(0, len(ids), 50):
+            params = {'select[]': select, 'filter[ID]': ids[offset:offset + 50]}
+            async for page in self.iter_list_by_id(method, params):
+                rows.extend(page)
+        return rows
+
+    async def _get_activities_for_single_user(self, user_id: str, query_params: Dict) -> List[Dict]:
+        """Получение активностей для одного пользователя (ID-курсор, без ограничений)"""
+        user_activities = []
+        params = self._activity_page_params(user_id, query_params)
 
+        page_number = 0
+        async for activities in self.iter_list_by_id("crm.activity.list", params):
+            page_number += 1
             user_activities.extend(activities)
-            logger.info(f"🔍 User {user_id} - Batch {request_count + 1}: got {len(activities)} activities, total: {len(user_activities)}")
-
-            if len(user_activities) >= max_activities_per_user:
-                logger.warning(f"⚠️ User {user_id} reached activity limit ({max_activities_per_user}), stopping")
-                user_activities = user_activities[:max_activities_per_user]
-                break
-
-            if len(activities) < 50:
-                logger.info(f"🔍 User {user_id} - Last batch had {len(activities)} items, stopping pagination.")
-                break
-
-            start += 50
-            request_count += 1
-            await asyncio.sleep(0.2)
+            logger.info(f"🔍 User {user_id} - Batch {page_number}: got {len(activities)} activities, total: {len(user_activities)}")
 
         logger.info(f"🔍 User {user_id} - COMPLETED: {len(user_activities)} total activities")
         return user_activities
 
-    async def _filter_completed_activities(self, activities: List[Dict]) -> List[Dict]:
-        """Фильтрует активности - УПРОЩЕННАЯ ВЕРСИЯ БЕЗ ПРОВЕРКИ ЗАДАЧ"""
-        if not activities:
-            return []
-
-        completed_activities = []
-        
-        for activity in activities:
-            type_id = str(activity.get('TYPE_ID'))
-            
-            if type_id == '4':
-                completed_activities.append(activity)
+    async def _get_activities_multi_author(self, user_ids: List[str], query_params: Dict) -> List[Dict]:
+        """Активности нескольких пользователей без цикла пагинации на каждого
+
+        1. Один batch берет первую страницу каждого пользователя и его total:
+           у кого активностей не больше 50, тот уже загружен полностью.
+        2. Пользователи со средним объемом грузятся одной общей выборкой
+           с фильтром AUTHOR_ID по списку и раскладываются по авторам локально.
+        3. Только "тяжелые" (больше HEAVY_USER_ACTIVITY_THRESHOLD) получают
+           собственные параллельные циклы, чтобы не растягивать общую выборку.
+        """
+        first_pages = await self.call_batch({
+            f"u{user_id}": ("crm.activity.list", self._activity_page_params(user_id, query_params))
+            for user_id in user_ids
+        })
+
+        user_activities = {user_id: [] for user_id in user_ids}
+        shared_user_ids = []
+        heavy_user_ids = []
+        for user_id in user_ids:
+            page = first_pages.get(f"u{user_id}", {})
+            if page.get('error'):
+                raise BitrixError(f"Activities for user {user_id}: {page['error']}")
+            total = page.get('total') or 0
+            if total <= 50:
+                user_activities[user_id].extend(page.get('result') or [])
+            elif total > HEAVY_USER_ACTIVITY_THRESHOLD:
+                heavy_user_ids.append(user_id)
             else:
-                completed_activities.append(activity)
-        
-        logger.info(f"📊 Simplified filter: {len(activities)} -> {len(completed_activities)} activities")
-        return completed_activities
+                shared_user_ids.append(user_id)
 
-    async def get_activity_statistics(
-        self,
-        days: int = None,
-        start_date: str = None,
-        end_date: str = None,
-        user_ids: List[str] = None
-    ) -> Dict[str, Any]:
-        activities = await self.get_activities(days=days, start_date=start_date, end_date=end_date, user_ids=user_ids)
-        if not activities:
-            return {}
+        logger.info(
+            f"🔍 Multi-author: {len(user_ids) - len(shared_user_ids) - len(heavy_user_ids)} users done in one batch, "
+            f"{len(shared_user_ids)} in shared query, {len(heavy_user_ids)} heavy"
+        )
 
-        daily_stats = {}
-        hourly_stats = {str(i).zfill(2): 0 for i in range(24)}
-        type_stats = {}
-        weekday_stats = {
-            'Monday': 0, 'Tuesday': 0, 'Wednesday': 0, 'Thursday': 0,
-            'Friday': 0, 'Saturday': 0, 'Sunday': 0
+        async def load_shared() -> List[Dict]:
+            if not shared_user_ids:
+                return []
+            params = {**query_params, 'filter[AUTHOR_ID]': shared_user_ids}
+            activities = []
+            async for page in self.iter_list_by_id("crm.activity.list", params):
+                activities.extend(page)
+            return activities
+
+        results = await asyncio.gather(
+            load_shared(),
+            *[self._get_activities_for_single_user(user_id, query_params) for user_id in heavy_user_ids]
+        )
+
+        for activities in results:
+            for activity in activities:
+                user_id = str(activity.get('AUTHOR_ID'))
+                if user_id in user_activities:
+                    user_activities[user_id].append(activity)
+
+        all_activities = []
+        for user_id, activities in user_activities.items():
+            logger.info(f"🔍 User {user_id}: got {len(activities)} activities")
+            all_activities.extend(activities)
+
+        return all_activities
+
+    def _activity_query_params(
+        self,
+        start_date_str: str,
+        end_date_str: str,
+        activity_types: List[str] = None,
+        fields: str = 'stats',
+        completed: Optional[bool] = None
+    ) -> Dict:
+        """Фильтры и проекция crm.activity.list - все отсекается на стороне Bitrix"""
+        params = {
+            'filter[>=CREATED]': start_date_str,
+            'filter[<=CREATED]': end_date_str,
+            'order[CREATED]': 'DESC'
         }
+        if activity_types:
+            params['filter[TYPE_ID]'] = activity_types
+        if completed is not None:
+            params['filter[COMPLETED]'] = 'Y' if completed else 'N'
+
+        select = ACTIVITY_SELECT_PROFILES[fields]
+        if select:
+            params['select[]'] = select
+        return params
+
+    def _activity_page_params(self, user_id: str, query_params: Dict, start: int = 0) -> Dict:
+        """Параметры одной страницы crm.activity.list для пользователя"""
+        return {**query_params, 'filter[AUTHOR_ID]': user_id, 'start': start}
+
+    async def _get_activities_batched(self, user_ids: List[str], query_params: Dict) -> List[Dict]:
+        """Получение активностей всех пользователей через batch
+
+        Первый batch берет первую страницу каждого пользователя и узнает total,
+        остальные страницы всех пользователей добираются пачками по 50 команд.
+        """
+        first_pages = await self.call_batch({
+            f"u{user_id}": (
+                "crm.activity.list",
+                self._activity_page_params(user_id, query_params)
+            )
+            for user_id in user_ids
+        })
+
+        user_activities = {user_id: [] for user_id in user_ids}
+        next_pages = {}
+        for user_id in user_ids:
+            page = first_pages.get(f"u{user_id}", {})
+            if page.get('error'):
+                raise BitrixError(f"Activities for user {user_id}: {page['error']}")
+            user_activities[user_id].extend(page.get('result') or [])
+            total = page.get('total') or 0
+            for start in range(50, total, 50):
+                next_pages[f"u{user_id}_s{start}"] = (
+                    "crm.activity.list",
+                    self._activity_page_params(user_id, query_params, start)
+                )
 
-        for activity in activities:
-            created_str = activity['CREATED'].replace('Z', '+00:00')
-            activity_date = datetime.fromisoformat(created_str)
-            date_key = activity_date.strftime('%Y-%m-%d')
-            hour_key = activity_date.strftime('%H')
-            weekday = activity_date.strftime('%A')
-            type_id = str(activity['TYPE_ID'])
-
-            if date_key not in daily_stats:
-                daily_stats[date_key] = {'date': date_key, 'day_of_week': weekday, 'total': 0, 'by_type': {}}
-
-            daily_stats[date_key]['total'] += 1
-            daily_stats[date_key]['by_type'][type_id] = daily_stats[date_key]['by_type'].get(type_id, 0) + 1
-            type_stats[type_id] = type_stats.get(type_id, 0) + 1
-            hourly_stats[hour_key] += 1
-            weekday_stats[weekday] += 1
+        if next_pages:
+            logger.info(f"📦 Batch activities: {len(next_pages)} more pages for {len(user_ids)} users")
+            pages = await self.call_batch(next_pages)
+            for key, page in pages.items():
+                if page.get('error'):
+                    raise BitrixError(f"Activities page {key}: {page['error']}")
+                user_id = key[1:].split('_s')[0]
+                user_activities[user_id].extend(page.get('result') or [])
 
-        sorted_daily = sorted(daily_stats.values(), key=lambda x: x['date'])
+        all_activities = []
+        for user_id, activities in user_activities.items():
+            logger.info(f"🔍 User {user_id}: got {len(activities)} activities (batch)")
+            all_activities.extend(activities)
 
-        return {
-            'total_activities': len(activities),
-            'daily_stats': sorted_daily,
-            'hourly_stats': hourly_stats,
-            'type_stats': type_stats,
-            'weekday_stats': weekday_stats,
-            'date_range': {
-                'start': sorted_daily[0]['date'] if sorted_daily else '',
-                'end': sorted_daily[-1]['date'] if sorted_daily else ''
-            }
-        }
+        return all_activities
 
     async def get_activity_statistics_from_activities(self, activities: List[Dict], start_date: str, end_date: str) -> Dict[str, Any]:
         """Генерирует статистику из готового списка активностей (для кэша)"""
-        if not activities:
-            return {}
-
-        daily_stats = {}
-        hourly_stats = {str(i).zfill(2): 0 for i in range(24)}
-        type_stats = {}
-        weekday_stats = {
-            'Monday': 0, 'Tuesday': 0, 'Wednesday': 0, 'Thursday': 0,
-            'Friday': 0, 'Saturday': 0, 'Sunday': 0
-        }
-
-        for activity in activities:
-            created_str = activity['CREATED'].replace('Z', '+00:00')
-            activity_date = datetime.fromisoformat(created_str)
-            date_key = activity_date.strftime('%Y-%m-%d')
-            hour_key = activity_date.strftime('%H')
-            weekday = activity_date.strftime('%A')
-            type_id = str(activity['TYPE_ID'])
-
-            if date_key not in daily_stats:
-                daily_stats[date_key] = {'date': date_key, 'day_of_week': weekday, 'total': 0, 'by_type': {}}
-
-            daily_stats[date_key]['total'] += 1
-            daily_stats[date_key]['by_type'][type_id] = daily_stats[date_key]['by_type'].get(type_id, 0) + 1
-            type_stats[type_id] = type_stats.get(type_id, 0) + 1
-            hourly_stats[hour_key] += 1
-            weekday_stats[weekday] += 1
-
-        sorted_daily = sorted(daily_stats.values(), key=lambda x: x['date'])
-
-        return {
-            'total_activities': len(activities),
-            'daily_stats': sorted_daily,
-            'hourly_stats': hourly_stats,
-            'type_stats': type_stats,
-            'weekday_stats': weekday_stats,
-            'date_range': {
-                'start': sorted_daily[0]['date'] if sorted_daily else start_date,
-                'end': sorted_daily[-1]['date'] if sorted_daily else end_date
-            }
-        }
+        accumulator = ActivityStatsAccumulator()
+        accumulator.add_page(activities or [])
+        return accumulator.result(start_date, end_date)
 
     async def get_deals(
         self,
         start_date: str = None,
         end_date: str = None,
         user_ids: List[str] = None,
-        limit: int = None
+        limit: int = None,
+        use_batch: bool = False
     ) -> Optional[List[Dict]]:
-        """Получение списка сделок - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
+        """Получение списка сделок - ИСПРАВЛЕННАЯ ВЕРСИЯ
+
+        use_batch=True собирает страницы всех пользователей в batch-запросы.
+        """
         try:
             logger.info(f"📊 Starting deals loading: start_date={start_date}, end_date={end_date}, users={user_ids}")
             
+            if use_batch and user_ids:
+                all_deals = await self._get_deals_batched(user_ids, start_date, end_date, limit)
+                logger.info(f"📊 Batch deals loading COMPLETED: {len(all_deals)} total deals")
+                if not all_deals:
+                    return []
+                return await self.enrich_deals_with_stages(all_deals)
+            
             # 🔥 ИСПРАВЛЕНИЕ: Если передано несколько user_ids, делаем отдельные запросы
             if user_ids and len(user_ids) > 1:
                 logger.info(f"📊 Multiple users detected ({len(user_ids)}), making separate requests")
                 
+                # Темп задает общий rate_limiter, поэтому пользователей грузим параллельно
+                results = await asyncio.gather(*[
+                    self._get_deals_for_single_user(user_id, start_date, end_date, limit)
+                    for user_id in user_ids
+                ])
+
                 all_deals = []
-                for user_id in user_ids:
-                    logger.info(f"📊 Loading deals for user {user_id}")
-                    user_deals = await self._get_deals_for_single_user(
-                        user_id, start_date, end_date, limit
-                    )
+                for user_id, user_deals in zip(user_ids, results):
                     if user_deals:
                         all_deals.extend(user_deals)
                         logger.info(f"📊 User {user_id}: loaded {len(user_deals)} deals")
-                    await asyncio.sleep(0.1)
                 
                 logger.info(f"📊 Multiple users loading COMPLETED: {len(all_deals)} total deals")
                 
                 if not all_deals:
                     return []
                 
-                return await self._enrich_deals_with_stages(all_deals)
+                return await self.enrich_deals_with_stages(all_deals)
             
             # 🔥 Оригинальный код для одного пользователя или без фильтра
             all_deals = []
-            start = 0
-            total_loaded = 0
-            
-            while True:
-                params = {
-                    'select[]': ['ID', 'TITLE', 'STAGE_ID', 'ASSIGNED_BY_ID', 'DATE_CREATE', 'DATE_MODIFY', 'OPPORTUNITY', 'CURRENCY_ID', 'TYPE_ID', 'STATUS_ID'],
-                    'start': start
-                }
-
-                # Фильтрация по дате
-                if start_date and end_date:
-                    try:
-                        start_date_obj = datetime.fromisoformat(start_date)
-                        end_date_obj = datetime.fromisoformat(end_date)
-                        params['filter[>=DATE_CREATE]'] = start_date_obj.strftime("%Y-%m-%d")
-                        params['filter[<=DATE_CREATE]'] = end_date_obj.strftime("%Y-%m-%d")
-                    except Exception as e:
-                        logger.error(f"Error parsing dates: {e}")
-
-                # 🔥 ИСПРАВЛЕНИЕ: Правильная фильтрация по пользователям
-                if user_ids and len(user_ids) == 1:
-                    params['filter[ASSIGNED_BY_ID]'] = user_ids[0]
-                elif user_ids and len(user_ids) > 1:
-                    params['filter[ASSIGNED_BY_ID]'] = user_ids
-
-                logger.info(f"📊 Making Bitrix request for deals, start={start}")
-                deals = await self.make_bitrix_request("crm.deal.list", params)
-                
-                if not deals:
-                    logger.info("📊 No more deals found")
-                    break
+            params = {
+                'select[]': DEAL_SELECT_FIELDS
+            }
 
+            # Фильтрация по дате
+            if start_date and end_date:
+                try:
+                    start_date_obj = datetime.fromisoformat(start_date)
+                    end_date_obj = datetime.fromisoformat(end_date)
+                    params['filter[>=DATE_CREATE]'] = start_date_obj.strftime("%Y-%m-%d")
+                    params['filter[<=DATE_CREATE]'] = end_date_obj.strftime("%Y-%m-%d")
+                except Exception as e:
+                    logger.error(f"Error parsing dates: {e}")
+
+            # 🔥 ИСПРАВЛЕНИЕ: Правильная фильтрация по пользователям
+            if user_ids and len(user_ids) == 1:
+                params['filter[ASSIGNED_BY_ID]'] = user_ids[0]
+
+            batch_number = 0
+            async for deals in self.iter_list_by_id("crm.deal.list", params, limit=limit):
                 all_deals.extend(deals)
-                total_loaded += len(deals)
-                
-                batch_number = start // 50 + 1
-                logger.info(f"📊 Batch {batch_number}: got {len(deals)} deals, total: {total_loaded}")
+                batch_number += 1
+                logger.info(f"📊 Batch {batch_number}: got {len(deals)} deals, total: {len(all_deals)}")
 
-                if total_loaded % 500 == 0:
-                    logger.info(f"📊 Progress: {total_loaded} deals loaded...")
+                if batch_number % 10 == 0:
+                    logger.info(f"📊 Progress: {len(all_deals)} deals loaded...")
 
-                if total_loaded >= 5000:
-                    logger.warning(f"⚠️ Reached large dataset limit ({total_loaded} deals). Consider filtering by date.")
-                    break
-
-                if limit and total_loaded >= limit:
-                    logger.info(f"📊 Reached user limit of {limit} deals")
-                    all_deals = all_deals[:limit]
-                    break
-
-                if len(deals) < 50:
-                    logger.info("📊 Last batch (less than 50 items)")
-                    break
-
-                start += 50
-                await asyncio.sleep(0.1)
+            if limit and len(all_deals) >= limit:
+                logger.info(f"📊 Reached user limit of {limit} deals")
 
             logger.info(f"📊 Deal loading COMPLETED: {len(all_deals)} total deals")
 
             if not all_deals:
                 return []
 
-            return await self._enrich_deals_with_stages(all_deals)
+            return await self.enrich_deals_with_stages(all_deals)
 
         except Exception as e:
             logger.error(f"❌ Error getting deals: {str(e)}", exc_info=True)
             return None
 
+    async def iter_deals_modified_since(self, modified_since: Optional[str] = None, user_ids: List[str] = None):
+        """Сырые сделки (без стадий), измененные начиная с modified_since
+
+        Без modified_since отдает все сделки; user_ids ограничивает ответственных.
+        Отдает страницы по мере получения, ошибки Bitrix пробрасываются.
+        """
+        params = {'select[]': DEAL_SELECT_FIELDS}
+        if user_ids:
+            params['filter[ASSIGNED_BY_ID]'] = list(user_ids)
+        if modified_since:
+            params['filter[>=DATE_MODIFY]'] = modified_since
+
+        async for deals in self.iter_list_by_id("crm.deal.list", params):
+            yield deals
+
     async def _get_deals_for_single_user(
         self,
         user_id: str,
@@ -464,63 +1228,100 @@ class BitrixService:
         end_date: str = None,
         limit: int = None
     ) -> List[Dict]:
-        """Получение сделок для одного пользователя"""
+        """Получение сделок для одного пользователя (ID-курсор)"""
         try:
             user_deals = []
-            start = 0
-            total_loaded = 0
-            
-            while True:
-                params = {
-                    'select[]': ['ID', 'TITLE', 'STAGE_ID', 'ASSIGNED_BY_ID', 'DATE_CREATE', 'DATE_MODIFY', 'OPPORTUNITY', 'CURRENCY_ID', 'TYPE_ID', 'STATUS_ID'],
-                    'filter[ASSIGNED_BY_ID]': user_id,
-                    'start': start
-                }
-
-                if start_date and end_date:
-                    try:
-                        start_date_obj = datetime.fromisoformat(start_date)
-                        end_date_obj = datetime.fromisoformat(end_date)
-                        params['filter[>=DATE_CREATE]'] = start_date_obj.strftime("%Y-%m-%d")
-                        params['filter[<=DATE_CREATE]'] = end_date_obj.strftime("%Y-%m-%d")
-                    except Exception as e:
-                        logger.error(f"Error parsing dates: {e}")
-
-                deals = await self.make_bitrix_request("crm.deal.list", params)
-                
-                if not deals:
-                    break
+            params = self._deal_page_params(user_id, start_date, end_date)
 
+            async for deals in self.iter_list_by_id("crm.deal.list", params, limit=limit):
                 user_deals.extend(deals)
-                total_loaded += len(deals)
-
-                if limit and total_loaded >= limit:
-                    user_deals = user_deals[:limit]
-                    break
-
-                if len(deals) < 50:
-                    break
-
-                start += 50
-                await asyncio.sleep(0.1)
 
             logger.info(f"📊 User {user_id}: loaded {len(user_deals)} deals")
             return user_deals
 
+        except BitrixError:
+            raise
         except Exception as e:
             logger.error(f"Error getting deals for user {user_id}: {str(e)}")
             return []
 
-    async def _enrich_deals_with_stages(self, deals: List[Dict]) -> List[Dict]:
+    def _deal_page_params(
+        self,
+        user_id: str,
+        start_date: str = None,
+        end_date: str = None,
+        start: int = 0
+    ) -> Dict:
+        """Параметры одной страницы crm.deal.list для пользователя"""
+        params = {
+            'select[]': DEAL_SELECT_FIELDS,
+            'filter[ASSIGNED_BY_ID]': user_id,
+            'start': start
+        }
+        if start_date and end_date:
+            try:
+                params['filter[>=DATE_CREATE]'] = datetime.fromisoformat(start_date).strftime("%Y-%m-%d")
+                params['filter[<=DATE_CREATE]'] = datetime.fromisoformat(end_date).strftime("%Y-%m-%d")
+            except Exception as e:
+                logger.error(f"Error parsing dates: {e}")
+        return params
+
+    async def _get_deals_batched(
+        self,
+        user_ids: List[str],
+        start_date: str = None,
+        end_date: str = None,
+        limit: int = None
+    ) -> List[Dict]:
+        """Получение сделок всех пользователей через batch"""
+        first_pages = await self.call_batch({
+            f"u{user_id}": ("crm.deal.list", self._deal_page_params(user_id, start_date, end_date))
+            for user_id in user_ids
+        })
+
+        user_deals = {user_id: [] for user_id in user_ids}
+        next_pages = {}
+        for user_id in user_ids:
+            page = first_pages.get(f"u{user_id}", {})
+            if page.get('error'):
+                raise BitrixError(f"Deals for user {user_id}: {page['error']}")
+            user_deals[user_id].extend(page.get('result') or [])
+            total = page.get('total') or 0
+            if limit:
+                total = min(total, limit)
+            for start in range(50, total, 50):
+                next_pages[f"u{user_id}_s{start}"] = (
+                    "crm.deal.list",
+                    self._deal_page_params(user_id, start_date, end_date, start)
+                )
+
+        if next_pages:
+            logger.info(f"📦 Batch deals: {len(next_pages)} more pages for {len(user_ids)} users")
+            pages = await self.call_batch(next_pages)
+            for key, page in pages.items():
+                if page.get('error'):
+                    raise BitrixError(f"Deals page {key}: {page['error']}")
+                user_id = key[1:].split('_s')[0]
+                user_deals[user_id].extend(page.get('result') or [])
+
+        all_deals = []
+        for user_id, deals in user_deals.items():
+            if limit:
+                deals = deals[:limit]
+            logger.info(f"📊 User {user_id}: loaded {len(deals)} deals (batch)")
+            all_deals.extend(deals)
+
+        return all_deals
+
+    async def enrich_deals_with_stages(self, deals: List[Dict]) -> List[Dict]:
         """Обогащает сделки информацией о стадиях"""
         if not deals:
             return []
 
-        all_stages = await self.get_deal_stages()
-        stage_map = {}
-        for stage in all_stages:
-            stage_id = stage.get('STATUS_ID')
-            stage_map[stage_id] = stage
+        if self.stage_service is not None:
+            stage_index = await self.stage_service.get_index()
+        else:
+            stage_index = build_stage_index(await self.get_deal_stages())
         
         enriched_deals = []
         for deal in deals:
@@ -528,18 +1329,7 @@ class BitrixService:
             type_id = deal.get('TYPE_ID')
             status_id = deal.get('STATUS_ID')
             
-            stage_info = None
-            for potential_id in [stage_id, type_id, status_id]:
-                if potential_id and potential_id in stage_map:
-                    stage_info = stage_map[potential_id]
-                    break
-            
-            if not stage_info:
-                stage_info = {
-                    'NAME': stage_id or 'Неизвестно',
-                    'COLOR': '#cccccc',
-                    'ENTITY_ID': 'UNKNOWN'
-                }
+            stage_info = resolve_stage(stage_index, stage_id, type_id, status_id)
             
             enriched_deals.append({
                 'ID': deal.get('ID'),
@@ -571,11 +1361,17 @@ class BitrixService:
         self,
         start_date: str = None,
         end_date: str = None,
-        user_ids: List[str] = None
+        user_ids: List[str] = None,
+        deals: List[Dict] = None
     ) -> Dict[str, Any]:
-        """Улучшенная статистика по сделкам с правильной группировкой"""
+        """Улучшенная статистика по сделкам с правильной группировкой
+
+        deals - уже загруженные сделки со стадиями (например, из warehouse);
+        без них сделки запрашиваются у Bitrix24.
+        """
         try:
-            deals = await self.get_deals(start_date, end_date, user_ids)
+            if deals is None:
+                deals = await self.get_deals(start_date, end_date, user_ids)
             if not deals:
                 return {
                     'total_deals': 0,
@@ -645,59 +1441,118 @@ class BitrixService:
     async def get_deal_stage_history(self, deal_id: str) -> Optional[List[Dict]]:
         """Получение истории изменения стадий сделки"""
         try:
-            timeline = await self.make_bitrix_request("crm.timeline.list", {
-                'filter[ENTITY_ID]': deal_id,
-                'filter[ENTITY_TYPE]': 'deal',
-                'filter[TYPE_CATEGORY_ID]': '1'
-            })
-            
-            if not timeline:
-                return None
-                
-            stage_history = []
-            for event in timeline:
-                if event.get('TYPE_ID') == '1':
-                    data = event.get('DATA', {})
-                    if 'STAGE_ID' in data:
-                        stage_history.append({
-                            'date': event.get('CREATED'),
-                            'stage_id': data['STAGE_ID'],
-                            'stage_name': data.get('STAGE_NAME', 'Неизвестно'),
-                            'event_id': event.get('ID')
-                        })
-            
-            return sorted(stage_history, key=lambda x: x['date'])
+            histories = await self.get_deal_stage_histories([deal_id])
+            return histories.get(str(deal_id)) or None
             
         except Exception as e:
             logger.error(f"Error getting deal stage history: {str(e)}")
             return None
 
+    async def get_deal_stage_histories(self, deal_ids: List[str]) -> Dict[str, List[Dict]]:
+        """История стадий для набора сделок: {deal_id: [{date, stage_id, stage_name, event_id}]}
+
+        Если подключено хранилище, из Bitrix24 догружаются только новые события.
+        """
+        deal_ids = [str(deal_id) for deal_id in deal_ids if deal_id]
+        if not deal_ids:
+            return {}
+
+        if self.stage_history_store is not None:
+            events = await self.stage_history_store.get_stage_history_events(deal_ids)
+        else:
+            events = await self.fetch_stage_history_events(deal_ids)
+
+        if self.stage_service is not None:
+            stage_index = await self.stage_service.get_index()
+        else:
+            stage_index = build_stage_index(await self.get_deal_stages())
+
+        histories = {deal_id: [] for deal_id in deal_ids}
+        for event in events:
+            stage_id = event['stage_id']
+            histories.setdefault(event['deal_id'], []).append({
+                'date': event['date'],
+                'stage_id': stage_id,
+                'stage_name': resolve_stage(stage_index, stage_id).get('NAME', 'Неизвестно'),
+                'event_id': event['event_id']
+            })
+
+        for history in histories.values():
+            history.sort(key=lambda x: x['date'] or '')
+        return histories
+
+    async def fetch_stage_history_events(self, deal_ids: List[str], after_event_id: int = 0) -> List[Dict]:
+        """События смены стадий сделок из crm.stagehistory.list
+
+        Сделки запрашиваются пачками по STAGE_HISTORY_OWNER_CHUNK через фильтр
+        по массиву OWNER_ID, пачки идут параллельно (не больше
+        stage_history_concurrency одновременно). after_event_id отсекает уже
+        известные события. Ошибки Bitrix пробрасываются.
+        """
+        semaphore = asyncio.Semaphore(self.stage_history_concurrency)
+
+        async def fetch_chunk(owner_ids: List[str]) -> List[Dict]:
+            events = []
+            last_id = after_event_id
+            async with semaphore:
+                while True:
+                    page = await self._request("crm.stagehistory.list", {
+                        'entityTypeId': 2,
+                        'filter[OWNER_ID]': owner_ids,
+                        'filter[>ID]': last_id,
+                        'order[ID]': 'ASC',
+                        'start': -1
+                    })
+                    # Метод отдает {"items": [...]}, а не список
+                    if isinstance(page, dict):
+                        items = page.get('items') or []
+                    else:
+                        items = page or []
+                    for item in items:
+                        events.append({
+                            'event_id': int(item['ID']),
+                            'deal_id': str(item.get('OWNER_ID')),
+                            'stage_id': item.get('STAGE_ID'),
+                            'type_id': str(item.get('TYPE_ID', '')),
+                            'date': item.get('CREATED_TIME')
+                        })
+                    if len(items) < 50:
+                        break
+                    last_id = int(items[-1]['ID'])
+            return events
+
+        chunks = [
+            deal_ids[offset:offset + STAGE_HISTORY_OWNER_CHUNK]
+            for offset in range(0, len(deal_ids), STAGE_HISTORY_OWNER_CHUNK)
+        ]
+        results = await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks))
+        events = [event for chunk_events in results for event in chunk_events]
+        logger.info(f"📜 Loaded {len(events)} stage history events for {len(deal_ids)} deals ({len(chunks)} requests)")
+        return events
+
     async def get_deal_stages(self) -> List[Dict]:
-        """Получение списка ВСЕХ стадий и статусов сделок"""
+        """Получение списка ВСЕХ стадий и статусов сделок
+
+        DEAL_STAGE, DEAL_TYPE и STATUS загружаются одним batch-запросом.
+        Порядок сохраняется: при совпадении STATUS_ID в индексе побеждает последний.
+        Если хотя бы одна команда batch не удалась - пустой список.
+        """
         try:
-            all_stages = []
-            
-            stages = await self.make_bitrix_request("crm.status.list", {
-                'filter[ENTITY_ID]': 'DEAL_STAGE'
+            results = await self.call_batch({
+                entity_id: ("crm.status.list", {'filter[ENTITY_ID]': entity_id})
+                for entity_id in DEAL_STAGE_ENTITIES
             })
-            if stages:
+
+            all_stages = []
+            for entity_id in DEAL_STAGE_ENTITIES:
+                # Неполный справочник хуже прежнего - любая ошибка команды отменяет обновление
+                command = results.get(entity_id) or {}
+                if command.get('error') or command.get('result') is None:
+                    raise BitrixError(f"crm.status.list {entity_id}: {command.get('error') or 'no result'}")
+                stages = command['result']
                 all_stages.extend(stages)
-                logger.info(f"📊 Loaded {len(stages)} DEAL_STAGE stages")
-            
-            deal_types = await self.make_bitrix_request("crm.status.list", {
-                'filter[ENTITY_ID]': 'DEAL_TYPE'
-            })
-            if deal_types:
-                all_stages.extend(deal_types)
-                logger.info(f"📊 Loaded {len(deal_types)} DEAL_TYPE stages")
-            
-            statuses = await self.make_bitrix_request("crm.status.list", {
-                'filter[ENTITY_ID]': 'STATUS'
-            })
-            if statuses:
-                all_stages.extend(statuses)
-                logger.info(f"📊 Loaded {len(statuses)} STATUS stages")
-            
+                logger.info(f"📊 Loaded {len(stages)} {entity_id} stages")
+
             logger.info(f"📊 Total stages loaded: {len(all_stages)}")
             return all_stages
             
@@ -709,11 +1564,16 @@ class BitrixService:
         self,
         start_date: str = None,
         end_date: str = None,
-        user_ids: List[str] = None
+        user_ids: List[str] = None,
+        deals: List[Dict] = None
     ) -> Dict[str, Any]:
-        """Статистика по сделкам - УПРОЩЕННАЯ ВЕРСИЯ"""
+        """Статистика по сделкам - УПРОЩЕННАЯ ВЕРСИЯ
+
+        deals - уже загруженные сделки со стадиями; без них запрашиваются у Bitrix24.
+        """
         try:
-            deals = await self.get_deals(start_date, end_date, user_ids)
+            if deals is None:
+                deals = await self.get_deals(start_date, end_date, user_ids)
             if not deals:
                 return {
                     'total_deals': 0,
@@ -775,7 +1635,9 @@ class BitrixService:
             if cache_key in self._cache:
                 cache_time, cached_data = self._cache[cache_key]
                 if (datetime.now() - cache_time).total_seconds() < self._cache_ttl:
+                    metrics.cache_lookups.inc(cache=cache_key, result='hit')
                     return cached_data
+            metrics.cache_lookups.inc(cache=cache_key, result='miss')
 
             all_users = []
             start = 0
@@ -785,7 +1647,7 @@ class BitrixService:
                     'start': start
                 }
                 
-                users = await self.make_bitrix_request("user.get", params)
+                users = await self._request("user.get", params)
                 if not users:
                     break
                     
@@ -795,7 +1657,6 @@ class BitrixService:
                     break
                     
                 start += 50
-                await asyncio.sleep(0.1)
 
             self._cache[cache_key] = (datetime.now(), all_users)
             logger.info(f"✅ Loaded {len(all_users)} users from Bitrix24")
@@ -803,7 +1664,7 @@ class BitrixService:
             
         except Exception as e:
             logger.error(f"Error getting all users: {str(e)}")
-            return None
+            return self._get_stale_cache("all_users")
 
     async def get_activities_optimized(
         self,
@@ -811,7 +1672,8 @@ class BitrixService:
         end_date: str,
         user_ids: List[str] = None,
         activity_types: List[str] = None,
-        chunk_size_days: int = 7
+        chunk_size_days: int = 7,
+        use_batch: bool = False
     ) -> Optional[List[Dict]]:
         """Оптимизированное получение активностей для больших периодов"""
         try:
@@ -823,14 +1685,15 @@ class BitrixService:
             
             if total_days > 14:
                 return await self._get_activities_chunked(
-                    start_date_obj, end_date_obj, user_ids, activity_types, chunk_size_days
+                    start_date_obj, end_date_obj, user_ids, activity_types, chunk_size_days, use_batch
                 )
             else:
                 return await self.get_activities(
                     start_date=start_date,
                     end_date=end_date,
                     user_ids=user_ids,
-                    activity_types=activity_types
+                    activity_types=activity_types,
+                    use_batch=use_batch
                 )
                 
         except Exception as e:
@@ -838,44 +1701,159 @@ class BitrixService:
             return None
 
     async def _get_activities_chunked(
-            self,
-            start_date: datetime,
-            end_date: datetime,
-            user_ids: List[str],
-            activity_types: List[str],
-            chunk_size_days: int
-        ) -> List[Dict]:
-            """Получение активностей по частям"""
-            all_activities = []
-            current_start = start_date
-            chunk_number = 1
-            
-            while current_start <= end_date:
-                current_end = min(current_start + timedelta(days=chunk_size_days - 1), end_date)
-                
-                chunk_start_str = current_start.strftime("%Y-%m-%d")
-                chunk_end_str = current_end.strftime("%Y-%m-%d")
-                
-                logger.info(f"📅 Chunk {chunk_number}: {chunk_start_str} to {chunk_end_str}")
-                
-                chunk_activities = await self.get_activities(
-                    start_date=chunk_start_str,
-                    end_date=chunk_end_str,
-                    user_ids=user_ids,
-                    activity_types=activity_types
+        self,
+        start_date: datetime,
+        end_date: datetime,
+        user_ids: List[str],
+        activity_types: List[str],
+        chunk_size_days: int,
+        use_batch: bool = False
+    ) -> Optional[List[Dict]]:
+        """Получение активностей по частям (None, если хоть одна часть не загрузилась)
+
+        Части грузятся параллельно (iter_activity_chunks), результат собирается
+        в хронологическом порядке частей без повторов по ID.
+        """
+        chunk_results = {}
+        chunks = self.iter_activity_chunks(
+            start_date, end_date, user_ids, activity_types, chunk_size_days, use_batch
+        )
+        try:
+            async for chunk_start, chunk_end, chunk_activities in chunks:
+                if chunk_activities is None:
+                    logger.error(f"📅 Chunk {chunk_start} - {chunk_end} failed, period result would be incomplete")
+                    return None
+                chunk_results[chunk_start] = chunk_activities
+                logger.info(f"📅 Chunk {chunk_start} - {chunk_end} completed: {len(chunk_activities)} activities")
+        finally:
+            await chunks.aclose()
+
+        activities_by_id = {}
+        for chunk_start in sorted(chunk_results):
+            for activity in chunk_results[chunk_start]:
+                activities_by_id.setdefault(str(activity.get('ID')), activity)
+
+        logger.info(f"📅 All chunks completed: {len(activities_by_id)} total activities")
+        return list(activities_by_id.values())
+
+    async def iter_activity_chunks(
+        self,
+        start_date: datetime,
+        end_date: datetime,
+        user_ids: List[str] = None,
+        activity_types: List[str] = None,
+        chunk_size_days: int = 7,
+        use_batch: bool = False
+    ):
+        """Параллельная загрузка периода частями: отдает (начало, конец, активности) по готовности
+
+        Границы частей подбираются по плотности (_plan_activity_chunks).
+        Одновременно грузится не больше chunk_concurrency частей; общий темп
+        запросов ограничивает rate_limiter. Для неудавшейся части вместо
+        списка отдается None; части, в которых по оценке плотности активностей
+        нет, отдаются пустым списком без запроса.
+        """
+        final_user_ids = await self._resolve_activity_user_ids(user_ids)
+        if not final_user_ids:
+            return
+
+        plan = await self._plan_activity_chunks(
+            start_date, end_date, final_user_ids, activity_types, chunk_size_days
+        )
+        logger.info(f"📅 Chunk plan: {len(plan)} chunks, concurrency {self.chunk_concurrency}")
+
+        semaphore = asyncio.Semaphore(max(1, self.chunk_concurrency))
+
+        async def fetch(chunk_start: str, chunk_end: str, expected: Optional[int]):
+            if expected == 0:
+                return chunk_start, chunk_end, []
+            async with semaphore:
+                activities = await self.get_activities(
+                    start_date=chunk_start,
+                    end_date=chunk_end,
+                    user_ids=final_user_ids,
+                    activity_types=activity_types,
+                    use_batch=use_batch
                 )
-                
-                if chunk_activities:
-                    all_activities.extend(chunk_activities)
-                    logger.info(f"📅 Chunk {chunk_number} completed: {len(chunk_activities)} activities")
-                
-                current_start = current_end + timedelta(days=1)
-                chunk_number += 1
-                
-                await asyncio.sleep(1)
-            
-            logger.info(f"📅 All chunks completed: {len(all_activities)} total activities")
-            return all_activities
+                return chunk_start, chunk_end, activities
+
+        tasks = [asyncio.create_task(fetch(*chunk)) for chunk in plan]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _plan_activity_chunks(
+        self,
+        start_date: datetime,
+        end_date: datetime,
+        user_ids: List[str],
+        activity_types: List[str] = None,
+        chunk_size_days: int = 7
+    ) -> List[Tuple[str, str, Optional[int]]]:
+        """Границы частей периода и число активностей в них по оценке на каждый день
+
+        Число активностей за день берется из total первой страницы (batch,
+        до 50 дней в одном запросе, select только ID). Соседние дни
+        склеиваются, пока часть не превысит ACTIVITY_CHUNK_TARGET активностей
+        или ACTIVITY_CHUNK_MAX_DAYS дней; плотный день становится отдельной
+        частью. Пустые части остаются в плане с числом 0 - их не нужно грузить,
+        но период все равно получен целиком. Если оценить плотность не удалось -
+        фиксированные части по chunk_size_days с неизвестным (None) числом.
+        """
+        days = []
+        current = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        while current.date() <= end_date.date():
+            days.append(current)
+            current += timedelta(days=1)
+
+        commands = {}
+        for day in days:
+            params = self._activity_query_params(
+                day.strftime("%Y-%m-%dT00:00:00"), day.strftime("%Y-%m-%dT23:59:59"), activity_types
+            )
+            params.pop('order[CREATED]', None)
+            params['select[]'] = ['ID']
+            params['filter[AUTHOR_ID]'] = user_ids
+            params['start'] = 0
+            commands[f"d{day.strftime('%Y%m%d')}"] = ("crm.activity.list", params)
+
+        try:
+            probes = await self.call_batch(commands)
+            counts = []
+            for key in commands:
+                probe = probes.get(key) or {}
+                if probe.get('error'):
+                    raise BitrixError(f"Density probe {key}: {probe['error']}")
+                counts.append(int(probe.get('total') or 0))
+        except Exception as e:
+            logger.warning(f"📅 Density probe failed ({e}), using fixed {chunk_size_days}-day chunks")
+            plan = []
+            for offset in range(0, len(days), chunk_size_days):
+                chunk_days = days[offset:offset + chunk_size_days]
+                plan.append((chunk_days[0].strftime("%Y-%m-%d"), chunk_days[-1].strftime("%Y-%m-%d"), None))
+            return plan
+
+        plan = []
+        chunk_first, chunk_last, chunk_count = None, None, 0
+        for day, count in zip(days, counts):
+            if chunk_first is not None and (
+                chunk_count + count > ACTIVITY_CHUNK_TARGET
+                or (day - chunk_first).days >= ACTIVITY_CHUNK_MAX_DAYS
+            ):
+                plan.append((chunk_first.strftime("%Y-%m-%d"), chunk_last.strftime("%Y-%m-%d"), chunk_count))
+                chunk_first, chunk_count = None, 0
+            if chunk_first is None:
+                chunk_first = day
+            chunk_last = day
+            chunk_count += count
+        if chunk_first is not None:
+            plan.append((chunk_first.strftime("%Y-%m-%d"), chunk_last.strftime("%Y-%m-%d"), chunk_count))
+
+        logger.info(f"📅 Density: {sum(counts)} activities in {len(days)} days -> {len(plan)} chunks")
+        return plan
 
     async def get_deals_with_timing(self, user_ids: List[str] = None, limit: int = 100) -> Optional[List[Dict]]:
         """Получение сделок с информацией о времени взятия в работу"""
@@ -886,14 +1864,18 @@ class BitrixService:
             if not deals:
                 return []
             
+            try:
+                histories = await self.get_deal_stage_histories([deal.get('ID') for deal in deals])
+            except BitrixError as e:
+                logger.warning(f"⚠️ Stage history unavailable, using creation dates: {e}")
+                histories = {}
             enriched_deals = []
             
             for deal in deals:
                 deal_id = deal.get('ID')
-                stage_id = deal.get('STAGE_ID')
                 created_date = deal.get('DATE_CREATE')
                 
-                taken_to_work_date = await self._get_taken_to_work_date(deal_id, created_date)
+                taken_to_work_date = self._get_taken_to_work_date(histories.get(str(deal_id)), created_date)
                 
                 enriched_deal = {
                     **deal,
@@ -911,12 +1893,11 @@ class BitrixService:
             logger.error(f"Error getting deals with timing: {str(e)}")
             return None
 
-    async def _get_taken_to_work_date(self, deal_id: str, created_date: str) -> Optional[str]:
-        """Определяет дату взятия сделки в работу"""
+    def _get_taken_to_work_date(self, history: Optional[List[Dict]], created_date: str) -> Optional[str]:
+        """Определяет дату взятия сделки в работу по истории стадий"""
         try:
             initial_stages = ['NEW', 'PREPARATION', '1', 'C1', 'C1:NEW']
             
-            history = await self.get_deal_stage_history(deal_id)
             if not history:
                 return created_date
                 
@@ -963,6 +1944,15 @@ class BitrixService:
             logger.error(f"Error calculating days in work: {e}")
             return 0
 
+    def _get_stale_cache(self, cache_key: str):
+        """Данные из кэша без учета TTL - когда Bitrix недоступен"""
+        if cache_key in self._cache:
+            cache_time, cached_data = self._cache[cache_key]
+            logger.warning(f"⚠️ Bitrix unavailable, serving stale {cache_key} from {cache_time.isoformat()}")
+            metrics.cache_lookups.inc(cache=cache_key, result='stale')
+            return cached_data
+        return None
+
     def clear_cache(self):
         """Очищает кэш"""
         self._cache.clear()
@@ -1,25 +1,122 @@
 import asyncio
-import aiosqlite
 import json
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
 import logging
 
+from app.services import json_codec, metrics
+from app.services.sqlite_pool import SQLitePool
+from app.services.bitrix_service import PRESALES_USER_IDS, is_bitrix_offline
+
 logger = logging.getLogger(__name__)
 
+# Вставка активности с обновлением существующей записи по ID
+ACTIVITY_UPSERT_SQL = '''
+    INSERT INTO activities
+        (id, user_id, type_id, created_ts, tz_offset, local_date, local_hour, weekday, updated_ts, cached_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        user_id = excluded.user_id,
+        type_id = excluded.type_id,
+        created_ts = excluded.created_ts,
+        tz_offset = excluded.tz_offset,
+        local_date = excluded.local_date,
+        local_hour = excluded.local_hour,
+        weekday = excluded.weekday,
+        updated_ts = excluded.updated_ts,
+        cached_at = excluded.cached_at
+'''
+
+ACTIVITY_PAYLOAD_UPSERT_SQL = '''
+    INSERT INTO activity_payloads (id, raw_data) VALUES (?, ?)
+    ON CONFLICT(id) DO UPDATE SET raw_data = excluded.raw_data
+'''
+
+# Активность из колонок в том виде, в каком ее отдает Bitrix (CREATED - ISO с поясом портала)
+CACHED_ACTIVITY_COLUMNS = '''
+    id, user_id, type_id,
+    strftime('%Y-%m-%dT%H:%M:%S', created_ts + tz_offset, 'unixepoch')
+        || printf('%s%02d:%02d', CASE WHEN tz_offset < 0 THEN '-' ELSE '+' END,
+                  abs(tz_offset) / 3600, abs(tz_offset) % 3600 / 60),
+    local_date
+'''
+
+
+def _shift_day(day: str, days: int) -> str:
+    return (date.fromisoformat(day) + timedelta(days=days)).isoformat()
+
+
+def _intervals_mergeable(first: tuple, second: tuple) -> bool:
+    """Интервалы журнала покрытия (start, end, fetched_at) можно слить в один
+
+    Пересекающиеся - всегда; смежные - если левый кончается окончательным днем,
+    иначе недогруженный "сегодняшний" день оказался бы внутри интервала.
+    """
+    left, right = sorted([first, second])
+    if right[0] <= left[1]:
+        return True
+    return right[0] == _shift_day(left[1], 1) and left[2][:10] > left[1]
+
+
+def _parse_bitrix_datetime(value) -> Optional[datetime]:
+    """ISO-дата Bitrix24 с поясом; без пояса считается UTC"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
 
 class DataWarehouseService:
     def __init__(self, bitrix_service):
         self.bitrix_service = bitrix_service
         self.db_path = "app/data/warehouse.db"
+        self.pool = SQLitePool(self.db_path)
+        # Активностей в одной транзакции cache_activities
+        self.ingest_chunk_size = int(os.getenv("WAREHOUSE_INGEST_CHUNK", "5000"))
+        # Полный ответ Bitrix по активности (activity_payloads) статистике не нужен - по умолчанию не хранится
+        self.store_activity_payloads = os.getenv("WAREHOUSE_STORE_PAYLOADS", "0") == "1"
+        # Сколько секунд загрузка текущего дня считается покрытием этого дня
+        self.coverage_fresh_seconds = int(os.getenv("COVERAGE_FRESH_SECONDS", "600"))
         self.is_syncing = False
+        # Справочник пользователей в памяти: ID -> запись user.get
+        self._user_directory: Dict[str, Dict] = {}
+        self._user_directory_refreshed_at: Optional[datetime] = None
+        # Справочник загружался из Bitrix целиком (user.get без фильтра); до этого
+        # в нем могут быть только точечно догруженные пользователи
+        self._user_directory_complete = False
+        self._user_directory_ttl = 600
+        self._user_refresh_task: Optional[asyncio.Task] = None
+        # Сделки досинхронизируются не чаще, чем раз в deals_sync_interval секунд
+        self.deals_sync_interval = int(os.getenv("DEALS_SYNC_INTERVAL", "60"))
+        self._deals_synced_at: Dict[str, datetime] = {}
+        self._deals_sync_lock = asyncio.Lock()
+        # Фоновая синхронизация активностей
+        self.activity_sync_interval = int(os.getenv("ACTIVITY_SYNC_INTERVAL", "300"))
+        self.activity_sync_backfill_days = int(os.getenv("ACTIVITY_SYNC_BACKFILL_DAYS", "30"))
+        self._activity_sync_state: Dict[str, Dict] = {}
+        self._sync_task: Optional[asyncio.Task] = None
+        self._sync_status = {
+            "running": False,
+            "runs": 0,
+            "last_started_at": None,
+            "last_finished_at": None,
+            "last_success_at": None,
+            "last_error": None,
+            "last_synced_activities": 0
+        }
         
     async def initialize(self):
         """Инициализация базы данных"""
-        import os
         os.makedirs("app/data", exist_ok=True)
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             # Таблица для ежедневных снапшотов активностей
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS activity_snapshots (
@@ -36,129 +133,948 @@ class DataWarehouseService:
                 )
             ''')
             
-            # Таблица для кэша активностей
+            # Кэш активностей: только колонки для статистики, даты - заранее разобранные
             await db.execute('''
-                CREATE TABLE IF NOT EXISTS activities_cache (
+                CREATE TABLE IF NOT EXISTS activities (
                     id INTEGER PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    created TEXT NOT NULL,
-                    type_id TEXT NOT NULL,
-                    description TEXT,
-                    subject TEXT,
-                    raw_data TEXT,
-                    cached_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                    data_date TEXT NOT NULL  -- Дата данных (без времени)
+                    user_id INTEGER NOT NULL,      -- AUTHOR_ID
+                    type_id INTEGER NOT NULL,
+                    created_ts INTEGER NOT NULL,   -- CREATED, epoch-секунды (UTC)
+                    tz_offset INTEGER NOT NULL,    -- смещение CREATED от UTC, секунды
+                    local_date TEXT NOT NULL,      -- дата CREATED во времени портала
+                    local_hour INTEGER NOT NULL,
+                    weekday INTEGER NOT NULL,      -- 0 = понедельник
+                    updated_ts INTEGER,            -- LAST_UPDATED
+                    cached_at INTEGER NOT NULL
+                )
+            ''')
+
+            # Полный ответ Bitrix по активности (WAREHOUSE_STORE_PAYLOADS=1)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS activity_payloads (
+                    id INTEGER PRIMARY KEY,
+                    raw_data TEXT NOT NULL
                 )
             ''')
             
-            # Индексы для быстрого поиска
-            await db.execute('CREATE INDEX IF NOT EXISTS idx_activities_user_date ON activities_cache(user_id, created)')
+            # Индексы для быстрого поиска. Имя idx_activities_user_date занято индексом
+            # старой activities_cache (имена индексов общие для всей схемы), поэтому у
+            # индекса activities свое имя; копия под старым именем на activities не нужна
+            cursor = await db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_activities_user_date' AND tbl_name = 'activities'"
+            )
+            if await cursor.fetchone():
+                await db.execute('DROP INDEX idx_activities_user_date')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_activities_user_local_date ON activities(user_id, local_date)')
             await db.execute('CREATE INDEX IF NOT EXISTS idx_snapshots_user_date ON activity_snapshots(user_id, date)')
-            await db.execute('CREATE INDEX IF NOT EXISTS idx_activities_data_date ON activities_cache(data_date)')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_activities_local_date ON activities(local_date)')
+
+            # Справочник пользователей Bitrix24 (переживает перезапуск)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS users_directory (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT,
+                    last_name TEXT,
+                    active INTEGER DEFAULT 1,
+                    timestamp_x TEXT,
+                    raw_data TEXT NOT NULL,
+                    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Словарь стадий сделок (crm.status.list)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS deal_stages (
+                    position INTEGER PRIMARY KEY,
+                    status_id TEXT NOT NULL,
+                    entity_id TEXT,
+                    raw_data TEXT NOT NULL,
+                    loaded_at TEXT NOT NULL
+                )
+            ''')
+
+            # История стадий сделок (crm.stagehistory.list) и отметки синхронизации по сделкам
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS deal_stage_history (
+                    event_id INTEGER PRIMARY KEY,
+                    deal_id TEXT NOT NULL,
+                    stage_id TEXT,
+                    type_id TEXT,
+                    created TEXT
+                )
+            ''')
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS deal_stage_history_sync (
+                    deal_id TEXT PRIMARY KEY,
+                    last_event_id INTEGER NOT NULL,
+                    synced_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_stage_history_deal ON deal_stage_history(deal_id)')
+
+            # Сделки и отметки синхронизации (DATE_MODIFY) по ответственным; '*' - все сделки портала
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS deals (
+                    id INTEGER PRIMARY KEY,
+                    title TEXT,
+                    stage_id TEXT,
+                    type_id TEXT,
+                    status_id TEXT,
+                    assigned_by_id TEXT,
+                    date_create TEXT,
+                    date_modify TEXT,
+                    opportunity REAL,
+                    currency_id TEXT
+                )
+            ''')
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS deals_sync_state (
+                    scope TEXT PRIMARY KEY,
+                    last_modified TEXT,
+                    synced_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_deals_assigned_created ON deals(assigned_by_id, date_create)')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_deals_created ON deals(date_create)')
+
+            # Журнал покрытия: за какие дни активности автора полностью загружены из Bitrix.
+            # Интервалы одного автора не пересекаются; дни до даты fetched_at окончательные,
+            # сам день загрузки (end_date = дата fetched_at) покрыт, пока загрузка свежая
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS fetch_coverage (
+                    user_id INTEGER NOT NULL,
+                    start_date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL,
+                    PRIMARY KEY (user_id, start_date)
+                ) WITHOUT ROWID
+            ''')
+
+            # Отметка полной загрузки справочника пользователей (одна строка)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS users_directory_state (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    full_loaded_at TEXT NOT NULL
+                )
+            ''')
+
+            # Отметки фоновой синхронизации активностей по авторам
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS activity_sync_state (
+                    user_id TEXT PRIMARY KEY,
+                    last_updated TEXT,
+                    backfill_from TEXT NOT NULL,
+                    synced_at TEXT NOT NULL
+                )
+            ''')
             
             await db.commit()
-        logger.info("✅ Data warehouse initialized")
+
+            cursor = await db.execute("SELECT raw_data FROM users_directory")
+            rows = await cursor.fetchall()
+            self._user_directory = {}
+            for row in rows:
+                user = json.loads(row[0])
+                self._user_directory[str(user['ID'])] = user
+            cursor = await db.execute("SELECT 1 FROM users_directory_state")
+            self._user_directory_complete = await cursor.fetchone() is not None
+
+            cursor = await db.execute("SELECT user_id, last_updated, backfill_from, synced_at FROM activity_sync_state")
+            self._activity_sync_state = {
+                row[0]: {"last_updated": row[1], "backfill_from": row[2], "synced_at": datetime.fromisoformat(row[3])}
+                for row in await cursor.fetchall()
+            }
+        await self._migrate_activities_cache()
+        logger.info(f"✅ Data warehouse initialized ({len(self._user_directory)} users in directory)")
+
+    async def _migrate_activities_cache(self):
+        """Переносит старую таблицу activities_cache (raw_data JSON) в activities и удаляет ее"""
+        async with self.pool.write() as db:
+            cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'activities_cache'")
+            if not await cursor.fetchone():
+                return
+
+            migrated = 0
+            cursor = await db.execute("SELECT id, user_id, type_id, created, raw_data FROM activities_cache")
+            while True:
+                legacy_rows = await cursor.fetchmany(self.ingest_chunk_size)
+                if not legacy_rows:
+                    break
+                rows = []
+                payloads = []
+                for activity_id, user_id, type_id, created, raw_data in legacy_rows:
+                    row = self._activity_row({'ID': activity_id, 'AUTHOR_ID': user_id, 'TYPE_ID': type_id, 'CREATED': created})
+                    if row:
+                        rows.append(row)
+                        if self.store_activity_payloads and raw_data:
+                            payloads.append((activity_id, raw_data))
+                await db.executemany(ACTIVITY_UPSERT_SQL, rows)
+                await db.executemany(ACTIVITY_PAYLOAD_UPSERT_SQL, payloads)
+                migrated += len(rows)
+
+            await db.execute("DROP TABLE activities_cache")
+            await db.commit()
+            await db.execute("VACUUM")
+        logger.info(f"✅ Migrated {migrated} activities from activities_cache to activities")
     
-    async def cache_activities(self, activities: List[Dict]):
-        """Кэширует активности в БД"""
+    @metrics.timed(metrics.warehouse_query_duration, operation="cache_activities")
+    async def cache_activities(self, activities: List[Dict]) -> bool:
+        """Кэширует активности в БД; False, если запись не удалась
+
+        Строки готовятся за один проход и пишутся executemany транзакциями
+        по ingest_chunk_size; между транзакциями писатель освобождается.
+        Существующие записи обновляются (ON CONFLICT DO UPDATE).
+        """
         if not activities:
+            return True
+
+        try:
+            skipped = 0
+            for offset in range(0, len(activities), self.ingest_chunk_size):
+                chunk = activities[offset:offset + self.ingest_chunk_size]
+                rows = [row for row in map(self._activity_row, chunk) if row]
+                skipped += len(chunk) - len(rows)
+                async with self.pool.write() as db:
+                    await db.executemany(ACTIVITY_UPSERT_SQL, rows)
+                    if self.store_activity_payloads:
+                        await db.executemany(
+                            ACTIVITY_PAYLOAD_UPSERT_SQL,
+                            [(int(activity['ID']), json_codec.dumps(activity)) for activity in chunk if activity.get('ID')]
+                        )
+                    await db.commit()
+            if skipped:
+                logger.warning(f"⚠️ Skipped {skipped} activities without ID/AUTHOR_ID/TYPE_ID/CREATED")
+            logger.info(f"✅ Cached {len(activities) - skipped} activities")
+            return True
+        except Exception as e:
+            logger.error(f"Error caching activities: {e}")
+            return False
+
+    async def store_fetched_period(
+        self,
+        activities: List[Dict],
+        user_ids: List[str],
+        start_date: str,
+        end_date: str,
+        fetched_at: datetime = None
+    ) -> bool:
+        """Сохраняет полную загрузку периода из Bitrix и отмечает его в журнале покрытия
+
+        activities - все активности user_ids за период (без фильтра по типу);
+        fetched_at - момент начала загрузки. Покрытие пишется только после
+        успешной записи активностей.
+        """
+        if not await self.cache_activities(activities):
+            return False
+        await self.record_coverage(user_ids, start_date, end_date, fetched_at)
+        return True
+
+    @staticmethod
+    def _activity_row(activity: Dict) -> Optional[tuple]:
+        """Строка таблицы activities; None, если без ключевых полей"""
+        created = _parse_bitrix_datetime(activity.get('CREATED'))
+        try:
+            activity_id = int(activity['ID'])
+            user_id = int(activity['AUTHOR_ID'])
+            type_id = int(activity['TYPE_ID'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if created is None:
+            return None
+
+        updated = _parse_bitrix_datetime(activity.get('LAST_UPDATED'))
+        return (
+            activity_id,
+            user_id,
+            type_id,
+            int(created.timestamp()),
+            int(created.utcoffset().total_seconds()),
+            f"{created.year:04d}-{created.month:02d}-{created.day:02d}",
+            created.hour,
+            created.weekday(),
+            int(updated.timestamp()) if updated else None,
+            int(time.time())
+        )
+
+    async def _select_cached_activities(self, db, user_ids: List[str], start_date: str, end_date: str, activity_types: List[str] = None) -> List[tuple]:
+        """(активность, local_date) за период, новые первыми - без разбора JSON
+
+        Активность - словарь с полями статистики (ID, AUTHOR_ID, TYPE_ID, CREATED).
+        """
+        user_ids = self._int_ids(user_ids)
+        query = f'''
+            SELECT {CACHED_ACTIVITY_COLUMNS} FROM activities
+            WHERE user_id IN ({','.join('?' for _ in user_ids)})
+            AND local_date BETWEEN ? AND ?
+        '''
+        params = user_ids + [start_date[:10], end_date[:10]]
+
+        if activity_types and activity_types != ['all']:
+            type_ids = self._int_ids(activity_types)
+            query += f" AND type_id IN ({','.join('?' for _ in type_ids)})"
+            params.extend(type_ids)
+
+        query += ' ORDER BY created_ts DESC'
+        cursor = await db.execute(query, params)
+        return [
+            ({'ID': str(row[0]), 'AUTHOR_ID': str(row[1]), 'TYPE_ID': str(row[2]), 'CREATED': row[3]}, row[4])
+            for row in await cursor.fetchall()
+        ]
+
+    @staticmethod
+    def _int_ids(ids: List) -> List[int]:
+        return [int(value) for value in ids if str(value).isdigit()]
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="record_coverage")
+    async def record_coverage(self, user_ids: List[str], start_date: str, end_date: str, fetched_at: datetime = None):
+        """Отмечает, что активности user_ids за [start_date, end_date] загружены из Bitrix полностью
+
+        Конец обрезается датой загрузки. Новый интервал сливается с
+        пересекающимися интервалами автора и со смежными, если день на стыке
+        окончательный (не был "сегодня" в момент загрузки).
+        """
+        fetched_at = fetched_at or datetime.now()
+        fetched_iso = fetched_at.isoformat(timespec='seconds')
+        start = start_date[:10]
+        end = min(end_date[:10], fetched_at.strftime("%Y-%m-%d"))
+        if start > end:
             return
-            
+
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                for activity in activities:
-                    # Извлекаем дату из CREATED для data_date
-                    created_str = activity.get('CREATED', '')
-                    try:
-                        activity_date = datetime.fromisoformat(created_str.replace('Z', '+00:00'))
-                        data_date = activity_date.strftime("%Y-%m-%d")
-                    except:
-                        data_date = datetime.now().strftime("%Y-%m-%d")
-                    
+            async with self.pool.write() as db:
+                for user_id in self._int_ids(user_ids):
+                    cursor = await db.execute(
+                        '''SELECT start_date, end_date, fetched_at FROM fetch_coverage
+                           WHERE user_id = ? AND start_date <= ? AND end_date >= ?''',
+                        (user_id, _shift_day(end, 1), _shift_day(start, -1))
+                    )
+                    intervals = [(start, end, fetched_iso)]
+                    merged = []
+                    for row in await cursor.fetchall():
+                        if _intervals_mergeable((start, end, fetched_iso), row):
+                            intervals.append(row)
+                            merged.append(row[0])
+
+                    new_start = min(interval[0] for interval in intervals)
+                    # Конец и время загрузки - от интервала с самым поздним концом (при равенстве - более свежего)
+                    new_end, new_fetched = max((interval[1], interval[2]) for interval in intervals)
+
+                    if merged:
+                        await db.execute(
+                            f"DELETE FROM fetch_coverage WHERE user_id = ? AND start_date IN ({','.join('?' for _ in merged)})",
+                            [user_id] + merged
+                        )
                     await db.execute(
-                        '''INSERT OR REPLACE INTO activities_cache 
-                           (id, user_id, created, type_id, description, subject, raw_data, data_date)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                        "INSERT OR REPLACE INTO fetch_coverage (user_id, start_date, end_date, fetched_at) VALUES (?, ?, ?, ?)",
+                        (user_id, new_start, new_end, new_fetched)
+                    )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Error recording fetch coverage: {e}")
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_coverage_gaps")
+    async def get_coverage_gaps(self, user_ids: List[str], start_date: str, end_date: str) -> Dict[str, List[Tuple[str, str]]]:
+        """Непокрытые журналом диапазоны дней [(начало, конец)] по каждому автору"""
+        start = start_date[:10]
+        end = end_date[:10]
+        now = datetime.now()
+        gaps = {}
+        async with self.pool.read() as db:
+            for user_id in user_ids:
+                cursor = await db.execute(
+                    '''SELECT start_date, end_date, fetched_at FROM fetch_coverage
+                       WHERE user_id = ? AND start_date <= ? AND end_date >= ?
+                       ORDER BY start_date''',
+                    (int(user_id), end, start)
+                )
+                user_gaps = []
+                next_day = start
+                for interval_start, interval_end, fetched_at in await cursor.fetchall():
+                    covered_end = self._covered_end(interval_end, fetched_at, now)
+                    if interval_start > next_day:
+                        user_gaps.append((next_day, min(_shift_day(interval_start, -1), end)))
+                    if covered_end >= next_day:
+                        next_day = _shift_day(covered_end, 1)
+                if next_day <= end:
+                    user_gaps.append((next_day, end))
+                gaps[str(user_id)] = user_gaps
+        return gaps
+
+    async def get_coverage(self, user_ids: List[str], start_date: str, end_date: str) -> Dict:
+        """Точная полнота кэша по журналу: доля покрытых дней автор*день"""
+        user_ids = [str(uid) for uid in user_ids]
+        total_days = (date.fromisoformat(end_date[:10]) - date.fromisoformat(start_date[:10])).days + 1
+        if not user_ids or total_days <= 0:
+            return {"completeness": 0, "is_complete": False, "missing_days": [], "gaps": {}}
+
+        gaps = await self.get_coverage_gaps(user_ids, start_date, end_date)
+        missing_days = set()
+        missing_user_days = 0
+        for user_gaps in gaps.values():
+            for gap_start, gap_end in user_gaps:
+                day = date.fromisoformat(gap_start)
+                last = date.fromisoformat(gap_end)
+                missing_user_days += (last - day).days + 1
+                while day <= last:
+                    missing_days.add(day.isoformat())
+                    day += timedelta(days=1)
+
+        total_user_days = total_days * len(user_ids)
+        completeness = (total_user_days - missing_user_days) / total_user_days * 100
+        return {
+            "completeness": completeness,
+            "is_complete": missing_user_days == 0,
+            "missing_days": sorted(missing_days),
+            "gaps": gaps
+        }
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="is_period_covered")
+    async def is_period_covered(self, user_ids: List[str], start_date: str, end_date: str) -> bool:
+        """Загружен ли период полностью для всех авторов - один поиск по индексу на автора"""
+        start = start_date[:10]
+        end = end_date[:10]
+        now = datetime.now()
+        if not user_ids or start > end:
+            return False
+        async with self.pool.read() as db:
+            for user_id in user_ids:
+                cursor = await db.execute(
+                    '''SELECT end_date, fetched_at FROM fetch_coverage
+                       WHERE user_id = ? AND start_date <= ?
+                       ORDER BY start_date DESC LIMIT 1''',
+                    (int(user_id), start)
+                )
+                row = await cursor.fetchone()
+                if not row or self._covered_end(row[0], row[1], now) < end:
+                    return False
+        return True
+
+    def _covered_end(self, end_date: str, fetched_at: str, now: datetime) -> str:
+        """Последний покрытый день интервала: день загрузки засчитывается, пока загрузка свежая"""
+        if fetched_at[:10] > end_date:
+            return end_date
+        if (now - datetime.fromisoformat(fetched_at)).total_seconds() <= self.coverage_fresh_seconds:
+            return end_date
+        return _shift_day(end_date, -1)
+
+    @staticmethod
+    def plan_gap_fetches(gaps: Dict[str, List[Tuple[str, str]]]) -> List[Tuple[str, str, List[str]]]:
+        """Запросы в Bitrix для пробелов покрытия: [(начало, конец, авторы)]
+
+        Пробелы каждого автора уже слиты в непрерывные диапазоны; авторы
+        с одинаковым диапазоном (обычно - все) грузятся одним запросом.
+        """
+        users_by_range: Dict[Tuple[str, str], List[str]] = {}
+        for user_id, user_gaps in gaps.items():
+            for gap in user_gaps:
+                users_by_range.setdefault(tuple(gap), []).append(str(user_id))
+        return [(gap_start, gap_end, users) for (gap_start, gap_end), users in sorted(users_by_range.items())]
+
+    async def fill_coverage_gaps(
+        self,
+        cached_activities: List[Dict],
+        gaps: Dict[str, List[Tuple[str, str]]],
+        activity_types: List[str] = None,
+        use_batch: bool = False
+    ) -> Optional[List[Dict]]:
+        """Догружает из Bitrix только непокрытые дни и объединяет их с кэшем
+
+        Диапазоны грузятся параллельно (темп держит rate_limiter) без фильтра
+        по типу, чтобы их можно было отметить в журнале покрытия; фильтр
+        применяется при объединении. Строки кэша внутри пробелов заменяются
+        загруженными. None - если хотя бы один диапазон загрузить не удалось
+        (удавшиеся все равно сохраняются).
+        """
+        plan = self.plan_gap_fetches(gaps)
+        if not plan:
+            return cached_activities
+
+        missing_user_days = sum(
+            (date.fromisoformat(gap_end) - date.fromisoformat(gap_start)).days + 1
+            for gap_start, gap_end, users in plan for _ in users
+        )
+        logger.info(f"🧩 Loading coverage gaps: {len(plan)} ranges, {missing_user_days} user-days")
+
+        fetched_at = datetime.now()
+        results = await asyncio.gather(*(
+            self.bitrix_service.get_activities_optimized(
+                start_date=gap_start,
+                end_date=gap_end,
+                user_ids=users,
+                use_batch=use_batch
+            )
+            for gap_start, gap_end, users in plan
+        ))
+
+        failed = False
+        for (gap_start, gap_end, users), activities in zip(plan, results):
+            if activities is None:
+                failed = True
+                continue
+            await self.store_fetched_period(activities, users, gap_start, gap_end, fetched_at)
+        if failed:
+            logger.warning("⚠️ Some coverage gaps failed to load")
+            return None
+
+        gap_ranges: Dict[str, List[Tuple[str, str]]] = {}
+        for gap_start, gap_end, users in plan:
+            for user_id in users:
+                gap_ranges.setdefault(user_id, []).append((gap_start, gap_end))
+
+        def in_gap(activity: Dict) -> bool:
+            day = str(activity.get('CREATED', ''))[:10]
+            return any(gap_start <= day <= gap_end for gap_start, gap_end in gap_ranges.get(str(activity.get('AUTHOR_ID')), ()))
+
+        types = {str(t) for t in activity_types} if activity_types else None
+        merged = {str(a['ID']): a for a in cached_activities if not in_gap(a)}
+        from_cache = len(merged)
+        for activities in results:
+            for activity in activities:
+                if types is None or str(activity.get('TYPE_ID')) in types:
+                    merged[str(activity.get('ID'))] = activity
+
+        logger.info(f"🧩 Merged {from_cache} cached and {len(merged) - from_cache} loaded activities")
+        return sorted(merged.values(), key=lambda a: str(a.get('CREATED', '')), reverse=True)
+
+    async def cache_activity_stream(self, pages) -> Optional[int]:
+        """Кэширует активности постранично из асинхронного потока (BitrixService.iter_activities*)
+
+        Каждая страница пишется сразу, поэтому память не растет с длиной периода.
+        Возвращает количество сохраненных активностей; None, если хотя бы одну
+        страницу записать не удалось (остальные все равно пишутся).
+        """
+        cached_count = 0
+        failed = False
+        async for page in pages:
+            if await self.cache_activities(page):
+                cached_count += len(page)
+            else:
+                failed = True
+        logger.info(f"✅ Cached {cached_count} activities from stream")
+        return None if failed else cached_count
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="upsert_users")
+    async def upsert_users(self, users: List[Dict]) -> bool:
+        """Сохраняет пользователей в справочник (БД и память); False, если запись не удалась"""
+        if not users:
+            return True
+
+        try:
+            async with self.pool.write() as db:
+                await db.executemany(
+                    '''INSERT OR REPLACE INTO users_directory
+                       (id, name, last_name, active, timestamp_x, raw_data, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''',
+                    [
                         (
-                            activity.get('ID'),
-                            activity.get('AUTHOR_ID'),
-                            created_str,
-                            activity.get('TYPE_ID'),
-                            activity.get('DESCRIPTION', ''),
-                            activity.get('SUBJECT', ''),
-                            json.dumps(activity),
-                            data_date
+                            int(user['ID']),
+                            user.get('NAME', ''),
+                            user.get('LAST_NAME', ''),
+                            1 if user.get('ACTIVE', True) not in (False, 'N') else 0,
+                            user.get('TIMESTAMP_X'),
+                            json.dumps(user)
                         )
+                        for user in users
+                    ]
+                )
+                await db.commit()
+            for user in users:
+                self._user_directory[str(user['ID'])] = user
+            logger.info(f"✅ Saved {len(users)} users to directory")
+            return True
+        except Exception as e:
+            logger.error(f"Error saving users to directory: {e}")
+            return False
+
+    async def refresh_user_directory(self) -> bool:
+        """Обновляет справочник пользователей
+
+        Пока справочник ни разу не загружался целиком (отметка в
+        users_directory_state), он загружается целиком - точечно догруженные
+        get_users_by_ids пользователи полным справочником не считаются.
+        Дальше забираются пользователи с TIMESTAMP_X не старше последнего
+        сохраненного (>=: у нескольких пользователей бывает одинаковая отметка).
+        """
+        try:
+            if not self._user_directory_complete:
+                users = await self.bitrix_service.get_all_users()
+                if users is None or not await self.upsert_users(users):
+                    return False
+                async with self.pool.write() as db:
+                    await db.execute(
+                        "INSERT OR REPLACE INTO users_directory_state (id, full_loaded_at) VALUES (1, ?)",
+                        (datetime.now().isoformat(),)
                     )
+                    await db.commit()
+                self._user_directory_complete = True
+            else:
+                async with self.pool.read() as db:
+                    cursor = await db.execute("SELECT MAX(timestamp_x) FROM users_directory")
+                    row = await cursor.fetchone()
+                watermark = row[0] if row else None
+                if watermark:
+                    users = await self.bitrix_service.get_users_modified_since(watermark)
+                    if not await self.upsert_users(list({str(user['ID']): user for user in users}.values())):
+                        return False
+
+            self._user_directory_refreshed_at = datetime.now()
+            return True
+        except Exception as e:
+            logger.error(f"Error refreshing user directory: {e}")
+            return False
+
+    def _schedule_user_refresh(self):
+        """Запускает фоновое обновление справочника, если он устарел"""
+        if self._user_refresh_task and not self._user_refresh_task.done():
+            return
+        refreshed_at = self._user_directory_refreshed_at
+        if refreshed_at and (datetime.now() - refreshed_at).total_seconds() < self._user_directory_ttl:
+            return
+        if is_bitrix_offline():
+            # Запрос "только из кэша" - обновление запустит следующий обычный запрос
+            return
+        self._user_refresh_task = asyncio.create_task(self.refresh_user_directory())
+
+    async def get_all_users(self) -> Optional[List[Dict]]:
+        """Все пользователи из локального справочника
+
+        Если справочник еще не загружался целиком, он загружается из Bitrix24
+        синхронно, иначе устаревший справочник обновляется в фоне.
+        """
+        if not self._user_directory_complete:
+            await self.refresh_user_directory()
+            if not self._user_directory_complete:
+                return None
+        else:
+            self._schedule_user_refresh()
+        return list(self._user_directory.values())
+
+    async def get_users_by_ids(self, user_ids: List[str]) -> List[Dict]:
+        """Пользователи по ID: из справочника, недостающие — одним запросом к Bitrix24"""
+        user_ids = [str(uid) for uid in user_ids]
+        missing = [uid for uid in user_ids if uid not in self._user_directory]
+        metrics.cache_lookups.inc(cache='user_directory', result='miss' if missing else 'hit')
+        if missing:
+            try:
+                await self.upsert_users(await self.bitrix_service.get_users_by_ids(missing))
+            except Exception as e:
+                logger.error(f"Error loading users {missing}: {e}")
+        return [self._user_directory[uid] for uid in user_ids if uid in self._user_directory]
+
+    async def get_presales_users(self) -> Optional[List[Dict]]:
+        """Сотрудники пресейла из локального справочника"""
+        users = await self.get_users_by_ids(PRESALES_USER_IDS)
+        if not users:
+            return await self.bitrix_service.get_presales_users()
+        if self._user_directory:
+            self._schedule_user_refresh()
+        return users
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="save_deal_stages")
+    async def save_deal_stages(self, stages: List[Dict]):
+        """Сохраняет словарь стадий сделок целиком (порядок важен для индекса)"""
+        try:
+            loaded_at = datetime.now().isoformat()
+            async with self.pool.write() as db:
+                await db.execute("DELETE FROM deal_stages")
+                await db.executemany(
+                    '''INSERT INTO deal_stages (position, status_id, entity_id, raw_data, loaded_at)
+                       VALUES (?, ?, ?, ?, ?)''',
+                    [
+                        (position, stage.get('STATUS_ID', ''), stage.get('ENTITY_ID'), json.dumps(stage), loaded_at)
+                        for position, stage in enumerate(stages)
+                    ]
+                )
                 await db.commit()
-            logger.info(f"✅ Cached {len(activities)} activities")
+            logger.info(f"✅ Saved {len(stages)} deal stages")
         except Exception as e:
-            logger.error(f"Error caching activities: {e}")
-    
-    async def get_cached_activities(self, user_ids: List[str], start_date: str, end_date: str) -> List[Dict]:
-        """Получает активности из кэша с проверкой полноты данных за период"""
+            logger.error(f"Error saving deal stages: {e}")
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="load_deal_stages")
+    async def load_deal_stages(self):
+        """Словарь стадий сделок из БД: (стадии, время загрузки)"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                placeholders = ','.join('?' for _ in user_ids)
-                
-                # 🔥 ПРОВЕРЯЕМ ПОЛНОТУ ДАННЫХ ЗА ПЕРИОД
-                completeness_check = '''
-                    SELECT COUNT(DISTINCT data_date) as cached_days
-                    FROM activities_cache 
-                    WHERE user_id IN ({}) 
-                    AND data_date BETWEEN ? AND ?
-                '''.format(placeholders)
-                
-                params = user_ids + [start_date, end_date]
-                cursor = await db.execute(completeness_check, params)
-                result = await cursor.fetchone()
-                
-                if not result:
-                    return []
-                
-                cached_days = result[0]
-                
-                # Вычисляем общее количество дней в периоде
-                start = datetime.fromisoformat(start_date)
-                end = datetime.fromisoformat(end_date)
-                total_days = (end - start).days + 1
-                
-                # 🔥 Считаем кэш валидным если есть данные за ВСЕ дни периода
-                if cached_days < total_days:
-                    logger.info(f"🔄 Cache incomplete: {cached_days}/{total_days} days, will refresh")
-                    return []
-                
-                # 🔥 Если данные полные - получаем их (БЕЗ ПРОВЕРКИ ВРЕМЕНИ КЭШИРОВАНИЯ)
-                query = f'''
-                    SELECT raw_data FROM activities_cache 
-                    WHERE user_id IN ({placeholders}) 
-                    AND data_date BETWEEN ? AND ?
-                    ORDER BY created DESC
-                '''
-                
+            async with self.pool.read() as db:
+                cursor = await db.execute("SELECT raw_data, loaded_at FROM deal_stages ORDER BY position")
+                rows = await cursor.fetchall()
+            if not rows:
+                return [], None
+            return [json.loads(row[0]) for row in rows], datetime.fromisoformat(rows[0][1])
+        except Exception as e:
+            logger.error(f"Error loading deal stages: {e}")
+            return [], None
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_stage_history_events")
+    async def get_stage_history_events(self, deal_ids: List[str]) -> List[Dict]:
+        """События стадий по сделкам: из БД, с догрузкой только новых событий из Bitrix24
+
+        Для каждой сделки хранится last_event_id - максимальный ID события,
+        известный на момент последней синхронизации. ID событий в Bitrix24
+        сквозные и растут, поэтому все, что появится позже, будет выше отметки.
+        """
+        placeholders = ','.join('?' for _ in deal_ids)
+        async with self.pool.read() as db:
+            cursor = await db.execute(
+                f"SELECT deal_id, last_event_id FROM deal_stage_history_sync WHERE deal_id IN ({placeholders})",
+                deal_ids
+            )
+            watermarks = {row[0]: row[1] for row in await cursor.fetchall()}
+            cursor = await db.execute("SELECT MAX(event_id) FROM deal_stage_history")
+            row = await cursor.fetchone()
+            known_max_id = row[0] or 0
+
+        new_deals = [deal_id for deal_id in deal_ids if deal_id not in watermarks]
+        synced_deals = [deal_id for deal_id in deal_ids if deal_id in watermarks]
+
+        requests = []
+        if new_deals:
+            requests.append(self.bitrix_service.fetch_stage_history_events(new_deals))
+        if synced_deals:
+            requests.append(self.bitrix_service.fetch_stage_history_events(
+                synced_deals, after_event_id=min(watermarks[deal_id] for deal_id in synced_deals)
+            ))
+
+        try:
+            fetched = [event for events in await asyncio.gather(*requests) for event in events]
+        except Exception as e:
+            logger.warning(f"⚠️ Stage history refresh failed, using stored events: {e}")
+        else:
+            new_watermark = max([known_max_id] + [event['event_id'] for event in fetched])
+            async with self.pool.write() as db:
+                await db.executemany(
+                    '''INSERT OR REPLACE INTO deal_stage_history (event_id, deal_id, stage_id, type_id, created)
+                       VALUES (?, ?, ?, ?, ?)''',
+                    [
+                        (event['event_id'], event['deal_id'], event['stage_id'], event['type_id'], event['date'])
+                        for event in fetched
+                    ]
+                )
+                await db.executemany(
+                    '''INSERT OR REPLACE INTO deal_stage_history_sync (deal_id, last_event_id, synced_at)
+                       VALUES (?, ?, CURRENT_TIMESTAMP)''',
+                    [(deal_id, new_watermark) for deal_id in deal_ids]
+                )
+                await db.commit()
+            logger.info(f"📜 Stage history synced: {len(fetched)} new events for {len(deal_ids)} deals")
+
+        async with self.pool.read() as db:
+            cursor = await db.execute(
+                f'''SELECT event_id, deal_id, stage_id, type_id, created FROM deal_stage_history
+                    WHERE deal_id IN ({placeholders}) ORDER BY event_id''',
+                deal_ids
+            )
+            rows = await cursor.fetchall()
+
+        return [
+            {'event_id': row[0], 'deal_id': row[1], 'stage_id': row[2], 'type_id': row[3], 'date': row[4]}
+            for row in rows
+        ]
+
+    async def sync_deals(self, user_ids: List[str] = None, force: bool = False) -> bool:
+        """Догружает в таблицу deals сделки, измененные после последней синхронизации
+
+        Отметка хранится по каждому ответственному (scope = ID, '*' - без фильтра).
+        Впервые увиденные ответственные загружаются целиком (с фильтром по
+        ASSIGNED_BY_ID), остальные - по DATE_MODIFY >= отметки (>=, чтобы не
+        потерять изменения в ту же секунду) без фильтра по ответственному:
+        сделка, переданная неотслеживаемому сотруднику, под фильтр уже не
+        попадет, а ее строка осталась бы за прежним ответственным.
+        """
+        scopes = [str(uid) for uid in user_ids] if user_ids else ['*']
+
+        async with self._deals_sync_lock:
+            now = datetime.now()
+            if not force:
+                scopes = [
+                    scope for scope in scopes
+                    if scope not in self._deals_synced_at
+                    or (now - self._deals_synced_at[scope]).total_seconds() >= self.deals_sync_interval
+                ]
+            if not scopes:
+                return True
+
+            try:
+                placeholders = ','.join('?' for _ in scopes)
+                async with self.pool.read() as db:
+                    cursor = await db.execute(
+                        f"SELECT scope, last_modified FROM deals_sync_state WHERE scope IN ({placeholders})",
+                        scopes
+                    )
+                    watermarks = {row[0]: row[1] for row in await cursor.fetchall()}
+
+                new_scopes = [scope for scope in scopes if scope not in watermarks]
+                synced_scopes = [scope for scope in scopes if scope in watermarks]
+
+                # (ответственные, изменены с, фильтр по ответственным)
+                groups = []
+                if new_scopes:
+                    groups.append((new_scopes, None, '*' not in new_scopes))
+                if synced_scopes:
+                    known = [watermarks[scope] for scope in synced_scopes if watermarks[scope]]
+                    # Без отметки это полная загрузка - только по своим ответственным
+                    groups.append((synced_scopes, min(known) if known else None, not known and '*' not in synced_scopes))
+
+                total = 0
+                last_modified = {scope: watermarks.get(scope) for scope in scopes}
+                for group_scopes, modified_since, by_assignee in groups:
+                    filter_ids = group_scopes if by_assignee else None
+                    async for deals in self.bitrix_service.iter_deals_modified_since(modified_since, filter_ids):
+                        await self.upsert_deals(deals)
+                        total += len(deals)
+                        if filter_ids is None:
+                            # Видны все изменения портала - отметка общая для всей группы
+                            page_max = max((deal.get('DATE_MODIFY') or '' for deal in deals), default='')
+                            for scope in group_scopes:
+                                if page_max > (last_modified[scope] or ''):
+                                    last_modified[scope] = page_max
+                            continue
+                        for deal in deals:
+                            scope = str(deal.get('ASSIGNED_BY_ID'))
+                            date_modify = deal.get('DATE_MODIFY')
+                            if scope in last_modified and date_modify and date_modify > (last_modified[scope] or ''):
+                                last_modified[scope] = date_modify
+
+                async with self.pool.write() as db:
+                    # Ответственным без сделок ставим общий максимум: все, что появится
+                    # у них позже, будет изменено позже него
+                    cursor = await db.execute("SELECT MAX(date_modify) FROM deals")
+                    row = await cursor.fetchone()
+                    for scope in scopes:
+                        if not last_modified[scope]:
+                            last_modified[scope] = row[0] if row else None
+
+                    await db.executemany(
+                        '''INSERT OR REPLACE INTO deals_sync_state (scope, last_modified, synced_at)
+                           VALUES (?, ?, CURRENT_TIMESTAMP)''',
+                        [(scope, last_modified[scope]) for scope in scopes]
+                    )
+                    await db.commit()
+
+                for scope in scopes:
+                    self._deals_synced_at[scope] = now
+                logger.info(f"🔄 Deals synced for {scopes}: {total} new/changed deals")
+                return True
+
+            except Exception as e:
+                logger.error(f"Error syncing deals: {e}")
+                return False
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="upsert_deals")
+    async def upsert_deals(self, deals: List[Dict]):
+        """Сохраняет сырые сделки (crm.deal.list) в таблицу deals"""
+        async with self.pool.write() as db:
+            await db.executemany(
+                '''INSERT OR REPLACE INTO deals
+                   (id, title, stage_id, type_id, status_id, assigned_by_id, date_create, date_modify, opportunity, currency_id)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                [
+                    (
+                        int(deal['ID']),
+                        deal.get('TITLE'),
+                        deal.get('STAGE_ID'),
+                        deal.get('TYPE_ID'),
+                        deal.get('STATUS_ID'),
+                        str(deal.get('ASSIGNED_BY_ID') or ''),
+                        deal.get('DATE_CREATE'),
+                        deal.get('DATE_MODIFY'),
+                        float(deal.get('OPPORTUNITY') or 0),
+                        deal.get('CURRENCY_ID')
+                    )
+                    for deal in deals
+                ]
+            )
+            await db.commit()
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_deals")
+    async def get_deals(
+        self,
+        start_date: str = None,
+        end_date: str = None,
+        user_ids: List[str] = None,
+        limit: int = None
+    ) -> Optional[List[Dict]]:
+        """Сделки из локальной таблицы (после досинхронизации) со стадиями
+
+        Период фильтрует DATE_CREATE по дням включительно, limit действует
+        на каждого ответственного. Если синхронизация не удалась, отдаются
+        сохраненные данные; None - только если локальных данных нет вовсе.
+        """
+        synced = await self.sync_deals(user_ids)
+
+        try:
+            conditions = []
+            params = []
+            if user_ids:
+                conditions.append(f"assigned_by_id IN ({','.join('?' for _ in user_ids)})")
+                params.extend(str(uid) for uid in user_ids)
+            if start_date and end_date:
+                conditions.append("substr(date_create, 1, 10) BETWEEN ? AND ?")
+                params.extend([start_date[:10], end_date[:10]])
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+            query = f'''
+                SELECT id, title, stage_id, type_id, status_id, assigned_by_id,
+                       date_create, date_modify, opportunity, currency_id,
+                       ROW_NUMBER() OVER (PARTITION BY assigned_by_id ORDER BY id) AS user_rank
+                FROM deals {where}
+            '''
+            if limit:
+                query = f"SELECT * FROM ({query}) WHERE user_rank <= ?"
+                params.append(limit)
+            query += " ORDER BY id"
+
+            async with self.pool.read() as db:
                 cursor = await db.execute(query, params)
                 rows = await cursor.fetchall()
-                
-                activities = []
-                for row in rows:
-                    try:
-                        activity_data = json.loads(row[0])
-                        activities.append(activity_data)
-                    except Exception as e:
-                        logger.error(f"Error parsing cached activity: {e}")
-                        continue
-                        
-                logger.info(f"📊 Got {len(activities)} activities from cache (complete period: {start_date} to {end_date})")
-                return activities
+        except Exception as e:
+            logger.error(f"Error reading deals from warehouse: {e}")
+            return None
+
+        if not rows and not synced:
+            return None
+
+        deals = [
+            {
+                'ID': str(row[0]),
+                'TITLE': row[1],
+                'STAGE_ID': row[2],
+                'TYPE_ID': row[3],
+                'STATUS_ID': row[4],
+                'ASSIGNED_BY_ID': row[5],
+                'DATE_CREATE': row[6],
+                'DATE_MODIFY': row[7],
+                'OPPORTUNITY': row[8],
+                'CURRENCY_ID': row[9]
+            }
+            for row in rows
+        ]
+        logger.info(f"📊 Deals from warehouse: {len(deals)}")
+        return await self.bitrix_service.enrich_deals_with_stages(deals)
+
+    async def get_cached_activities(self, user_ids: List[str], start_date: str, end_date: str) -> List[Dict]:
+        """Получает активности из кэша, если период целиком есть в журнале покрытия"""
+        try:
+            # 🔥 ПРОВЕРЯЕМ ПОЛНОТУ ДАННЫХ ЗА ПЕРИОД
+            if not await self.is_period_covered(user_ids, start_date, end_date):
+                logger.info(f"🔄 Cache incomplete for {start_date} to {end_date}, will refresh")
+                return []
+
+            async with self.pool.read() as db:
+                rows = await self._select_cached_activities(db, user_ids, start_date, end_date)
+            activities = [activity for activity, _ in rows]
+
+            logger.info(f"📊 Got {len(activities)} activities from cache (complete period: {start_date} to {end_date})")
+            return activities
                 
         except Exception as e:
             logger.error(f"Error getting cached activities: {e}")
             return []
     
+    @metrics.timed(metrics.warehouse_query_duration, operation="save_daily_snapshot")
     async def save_daily_snapshot(self, user_stats: List[Dict], date: str):
         """Сохраняет ежедневный снапшот статистики"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 for stat in user_stats:
                     await db.execute(
                         '''INSERT OR REPLACE INTO activity_snapshots 
@@ -179,10 +1095,11 @@ class DataWarehouseService:
         except Exception as e:
             logger.error(f"Error saving daily snapshot: {e}")
     
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_fast_stats")
     async def get_fast_stats(self, user_ids: List[str], start_date: str, end_date: str) -> Optional[Dict]:
         """Быстрая статистика из кэша без запросов к Bitrix"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 # Получаем снапшоты за период
                 query = '''
                     SELECT user_id, date, calls, comments, tasks, meetings, total 
@@ -241,44 +1158,228 @@ class DataWarehouseService:
             logger.error(f"Error getting fast stats: {e}")
             return None
 
+    @metrics.timed(metrics.warehouse_query_duration, operation="is_period_cached")
     async def is_period_cached(self, user_ids: List[str], start_date: str, end_date: str) -> bool:
-        """Проверяет, есть ли полные данные за период в кэше"""
+        """Проверяет, есть ли полные данные за период в кэше (по журналу покрытия)"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Проверяем наличие снапшотов для всех дней периода
-                query = '''
-                    SELECT COUNT(DISTINCT date) as days_count
-                    FROM activity_snapshots 
-                    WHERE user_id IN ({}) AND date BETWEEN ? AND ?
-                '''.format(','.join('?' * len(user_ids)))
-                
-                params = user_ids + [start_date, end_date]
-                cursor = await db.execute(query, params)
-                result = await cursor.fetchone()
-                
-                if not result:
-                    return False
-                
-                # Вычисляем количество дней в периоде
-                start = datetime.fromisoformat(start_date)
-                end = datetime.fromisoformat(end_date)
-                total_days = (end - start).days + 1
-                
-                # Считаем кэш полным если есть данные за ВСЕ дни
-                return result[0] >= total_days
-                
+            return await self.is_period_covered(user_ids, start_date, end_date)
         except Exception as e:
             logger.error(f"Error checking cache completeness: {e}")
             return False
 
     async def start_background_sync(self):
-        """Запуск фоновой синхронизации - ОТКЛЮЧЕНА"""
-        logger.info("🔄 Background sync DISABLED - caching only on user requests")
-        return
-    
-    async def sync_recent_data(self):
-        """Фоновая синхронизация - ОТКЛЮЧЕНА"""
-        return
+        """Запускает фоновую синхронизацию активностей (ACTIVITY_SYNC_INTERVAL=0 - отключена)"""
+        if self.activity_sync_interval <= 0:
+            logger.info("🔄 Background sync DISABLED - caching only on user requests")
+            return
+        if self._sync_task and not self._sync_task.done():
+            return
+        self._sync_task = asyncio.create_task(self._background_sync_loop())
+        logger.info(f"🔄 Background sync started, every {self.activity_sync_interval}s")
+
+    async def stop_background_sync(self):
+        """Останавливает фоновую синхронизацию (shutdown приложения)"""
+        if self._sync_task:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+
+    async def close(self):
+        """Закрывает соединения с базой (shutdown приложения)"""
+        await self.pool.close()
+
+    async def _background_sync_loop(self):
+        while True:
+            await self.sync_recent_data()
+            await asyncio.sleep(self.activity_sync_interval)
+
+    async def sync_recent_data(self, user_ids: List[str] = None) -> int:
+        """Догружает новые и измененные активности в activities
+
+        Для каждого автора хранится отметка LAST_UPDATED. Новые авторы
+        загружаются за последние activity_sync_backfill_days дней, остальные -
+        по LAST_UPDATED >= отметки. После записи пересчитываются снапшоты
+        затронутых дней. Возвращает количество полученных активностей.
+        """
+        if self.is_syncing:
+            return 0
+
+        user_ids = [str(uid) for uid in (user_ids or PRESALES_USER_IDS)]
+        self.is_syncing = True
+        status = self._sync_status
+        status["running"] = True
+        status["last_started_at"] = datetime.now()
+        synced_count = 0
+
+        try:
+            now = datetime.now()
+            backfill_from = (now - timedelta(days=self.activity_sync_backfill_days)).strftime("%Y-%m-%d")
+            new_users = [uid for uid in user_ids if uid not in self._activity_sync_state]
+            synced_users = [uid for uid in user_ids if uid in self._activity_sync_state]
+
+            last_updated = {uid: self._activity_sync_state.get(uid, {}).get("last_updated") for uid in user_ids}
+            touched_dates = set()
+            all_cached = True
+
+            groups = []
+            if new_users:
+                groups.append((new_users, None, backfill_from))
+            if synced_users:
+                known = [last_updated[uid] for uid in synced_users if last_updated[uid]]
+                groups.append((synced_users, min(known) if known else None, None))
+
+            async def tracked(pages):
+                # Отметки и затронутые дни собираются по ходу потока, страницы пишет cache_activity_stream
+                nonlocal synced_count
+                async for page in pages:
+                    synced_count += len(page)
+                    for activity in page:
+                        uid = str(activity.get('AUTHOR_ID'))
+                        touched_dates.add(str(activity.get('CREATED', ''))[:10])
+                        updated = activity.get('LAST_UPDATED')
+                        if uid in last_updated and updated and updated > (last_updated[uid] or ''):
+                            last_updated[uid] = updated
+                    yield page
+
+            for group_users, updated_since, created_since in groups:
+                if not updated_since and not created_since:
+                    created_since = min(self._activity_sync_state[uid]["backfill_from"] for uid in group_users)
+                pages = self.bitrix_service.iter_activities_updated_since(group_users, updated_since, created_since)
+                if await self.cache_activity_stream(tracked(pages)) is None:
+                    all_cached = False
+
+            await self.refresh_snapshots(sorted(d for d in touched_dates if d))
+            if not all_cached:
+                # Отметки не двигаем: несохраненные активности заберет следующий запуск
+                raise RuntimeError("some activity pages were not cached, sync state kept")
+
+            await self._save_activity_sync_state(user_ids, last_updated, backfill_from, now)
+
+            # Изменения с backfill_from по сегодня теперь в кэше - период покрыт
+            users_by_backfill: Dict[str, List[str]] = {}
+            for uid in user_ids:
+                users_by_backfill.setdefault(self._activity_sync_state[uid]["backfill_from"], []).append(uid)
+            for from_date, group_users in users_by_backfill.items():
+                await self.record_coverage(group_users, from_date, now.strftime("%Y-%m-%d"), now)
+
+            status["last_success_at"] = datetime.now()
+            status["last_error"] = None
+            status["last_synced_activities"] = synced_count
+            logger.info(f"🔄 Background sync: {synced_count} new/updated activities for {len(user_ids)} users")
+        except Exception as e:
+            status["last_error"] = str(e)
+            logger.error(f"Error in background sync: {e}")
+        finally:
+            self.is_syncing = False
+            status["running"] = False
+            status["runs"] += 1
+            status["last_finished_at"] = datetime.now()
+
+        return synced_count
+
+    async def _save_activity_sync_state(self, user_ids: List[str], last_updated: Dict[str, Optional[str]], backfill_from: str, synced_at: datetime):
+        rows = []
+        for uid in user_ids:
+            state = self._activity_sync_state.get(uid)
+            state = {
+                "last_updated": last_updated[uid],
+                "backfill_from": state["backfill_from"] if state else backfill_from,
+                "synced_at": synced_at
+            }
+            self._activity_sync_state[uid] = state
+            rows.append((uid, state["last_updated"], state["backfill_from"], synced_at.isoformat()))
+
+        async with self.pool.write() as db:
+            await db.executemany(
+                '''INSERT OR REPLACE INTO activity_sync_state (user_id, last_updated, backfill_from, synced_at)
+                   VALUES (?, ?, ?, ?)''',
+                rows
+            )
+            await db.commit()
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="refresh_snapshots")
+    async def refresh_snapshots(self, dates: List[str]):
+        """Пересчитывает activity_snapshots за указанные дни по activities"""
+        if not dates:
+            return
+
+        try:
+            placeholders = ','.join('?' for _ in dates)
+            async with self.pool.write() as db:
+                # Сначала удаляем: у пользователя за день могло не остаться активностей
+                await db.execute(f"DELETE FROM activity_snapshots WHERE date IN ({placeholders})", dates)
+                await db.execute(
+                    f'''INSERT OR REPLACE INTO activity_snapshots
+                        (user_id, date, calls, comments, tasks, meetings, total)
+                        SELECT CAST(user_id AS TEXT), local_date,
+                               SUM(type_id = 2), SUM(type_id = 6), SUM(type_id = 4), SUM(type_id = 1),
+                               COUNT(*)
+                        FROM activities
+                        WHERE local_date IN ({placeholders})
+                        GROUP BY user_id, local_date''',
+                    dates
+                )
+                await db.commit()
+            logger.info(f"✅ Refreshed snapshots for {len(dates)} days")
+        except Exception as e:
+            logger.error(f"Error refreshing snapshots: {e}")
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_activity_dates")
+    async def get_activity_dates(self, activity_ids: List[str]) -> List[str]:
+        """Дни (local_date), к которым относятся сохраненные активности"""
+        placeholders = ','.join('?' for _ in activity_ids)
+        async with self.pool.read() as db:
+            cursor = await db.execute(
+                f"SELECT DISTINCT local_date FROM activities WHERE id IN ({placeholders})",
+                [int(activity_id) for activity_id in activity_ids]
+            )
+            return [row[0] for row in await cursor.fetchall()]
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="delete_activities")
+    async def delete_activities(self, activity_ids: List[str]):
+        """Удаляет активности из кэша"""
+        placeholders = ','.join('?' for _ in activity_ids)
+        async with self.pool.write() as db:
+            ids = [int(activity_id) for activity_id in activity_ids]
+            await db.execute(f"DELETE FROM activities WHERE id IN ({placeholders})", ids)
+            await db.execute(f"DELETE FROM activity_payloads WHERE id IN ({placeholders})", ids)
+            await db.commit()
+        logger.info(f"🗑️ Deleted {len(activity_ids)} activities from cache")
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="delete_deals")
+    async def delete_deals(self, deal_ids: List[str]):
+        """Удаляет сделки из таблицы deals"""
+        placeholders = ','.join('?' for _ in deal_ids)
+        async with self.pool.write() as db:
+            await db.execute(
+                f"DELETE FROM deals WHERE id IN ({placeholders})",
+                [int(deal_id) for deal_id in deal_ids]
+            )
+            await db.commit()
+        logger.info(f"🗑️ Deleted {len(deal_ids)} deals")
+
+    def get_sync_status(self) -> Dict:
+        """Состояние фоновой синхронизации: последний запуск, ошибка, отставание"""
+        status = dict(self._sync_status)
+        last_success = status["last_success_at"]
+        status["lag_seconds"] = round((datetime.now() - last_success).total_seconds(), 1) if last_success else None
+        for key in ("last_started_at", "last_finished_at", "last_success_at"):
+            if status[key]:
+                status[key] = status[key].isoformat()
+        status["enabled"] = self.activity_sync_interval > 0
+        status["interval_seconds"] = self.activity_sync_interval
+        status["users"] = {
+            uid: {
+                "last_updated": state["last_updated"],
+                "backfill_from": state["backfill_from"],
+                "synced_at": state["synced_at"].isoformat()
+            }
+            for uid, state in self._activity_sync_state.items()
+        }
+        return status
 
     async def save_daily_snapshot_from_activities(self, activities: List[Dict], user_ids: List[str], date: str):
         """Сохраняет ежедневный снапшот из списка активностей"""
@@ -319,15 +1420,20 @@ class DataWarehouseService:
         except Exception as e:
             logger.error(f"Error saving snapshot from activities: {e}")
 
+    @metrics.timed(metrics.warehouse_query_duration, operation="clear_old_cache")
     async def clear_old_cache(self, days_to_keep: int = 30):
         """Очищает старый кэш"""
         try:
             cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).strftime("%Y-%m-%d")
             
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 # Удаляем старые записи из кэша активностей
                 await db.execute(
-                    "DELETE FROM activities_cache WHERE data_date < ?",
+                    "DELETE FROM activity_payloads WHERE id IN (SELECT id FROM activities WHERE local_date < ?)",
+                    (cutoff_date,)
+                )
+                await db.execute(
+                    "DELETE FROM activities WHERE local_date < ?",
                     (cutoff_date,)
                 )
                 # Удаляем старые снапшоты
@@ -335,357 +1441,158 @@ class DataWarehouseService:
                     "DELETE FROM activity_snapshots WHERE date < ?",
                     (cutoff_date,)
                 )
+                # Дни до cutoff больше не в кэше - убираем их из журнала покрытия
+                await db.execute("DELETE FROM fetch_coverage WHERE end_date < ?", (cutoff_date,))
+                await db.execute("UPDATE fetch_coverage SET start_date = ? WHERE start_date < ?", (cutoff_date, cutoff_date))
                 await db.commit()
                 
                 logger.info(f"🧹 Cleared cache older than {cutoff_date}")
         except Exception as e:
             logger.error(f"Error clearing old cache: {e}")
     
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_cached_activities_direct")
     async def get_cached_activities_direct(self, user_ids: List[str], start_date: str, end_date: str, activity_types: List[str] = None) -> Dict:
         """
-        🔥 СУПЕР-ПРОСТОЙ МЕТОД - считает полноту только по РАБОЧИМ дням
+        🔥 СУПЕР-ПРОСТОЙ МЕТОД - все, что есть в кэше, и точная полнота по журналу покрытия
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                placeholders = ','.join('?' for _ in user_ids)
-                
-                query = f'''
-                    SELECT raw_data, data_date FROM activities_cache 
-                    WHERE user_id IN ({placeholders}) 
-                    AND data_date BETWEEN ? AND ?
-                '''
-                params = user_ids + [start_date, end_date]
-                
-                if activity_types and activity_types != ['all']:
-                    type_placeholders = ','.join('?' for _ in activity_types)
-                    query += f' AND type_id IN ({type_placeholders})'
-                    params.extend(activity_types)
-                
-                query += ' ORDER BY created DESC'
-                
-                cursor = await db.execute(query, params)
-                rows = await cursor.fetchall()
-                
-                activities = []
-                cached_dates = set()
-                
-                for row in rows:
-                    try:
-                        activity_data = json.loads(row[0])
-                        activities.append(activity_data)
-                        cached_dates.add(row[1])
-                    except Exception as e:
-                        continue
-                
-                # 🔥 СЧИТАЕМ ТОЛЬКО РАБОЧИЕ ДНИ
-                start = datetime.fromisoformat(start_date)
-                end = datetime.fromisoformat(end_date)
-                
-                work_days = 0
-                current = start
-                while current <= end:
-                    # Пн=0, Вт=1, Ср=2, Чт=3, Пт=4, Сб=5, Вс=6
-                    if current.weekday() < 5:  # Только пн-пт
-                        work_days += 1
-                    current += timedelta(days=1)
-                
-                # Считаем рабочие дни с данными
-                work_days_with_data = 0
-                current = start
-                while current <= end:
-                    date_str = current.strftime("%Y-%m-%d")
-                    if current.weekday() < 5 and date_str in cached_dates:
-                        work_days_with_data += 1
-                    current += timedelta(days=1)
-                
-                completeness = (work_days_with_data / work_days) * 100 if work_days > 0 else 0
-                
-                logger.info(f"🚀 Direct cache access: {len(activities)} activities, {work_days_with_data}/{work_days} work days ({completeness:.1f}% complete)")
-                
-                return {
-                    "activities": activities,
-                    "completeness": completeness,
-                    "work_days_with_data": work_days_with_data,
-                    "total_work_days": work_days,
-                    "note": "Полнота считается только по рабочим дням (пн-пт)"
-                }
+            coverage = await self.get_coverage(user_ids, start_date, end_date)
+            async with self.pool.read() as db:
+                rows = await self._select_cached_activities(db, user_ids, start_date, end_date, activity_types)
+            activities = [activity for activity, _ in rows]
+
+            logger.info(f"🚀 Direct cache access: {len(activities)} activities ({coverage['completeness']:.1f}% complete)")
+
+            return {
+                "activities": activities,
+                "completeness": coverage["completeness"],
+                "is_complete": coverage["is_complete"],
+                "missing_days": coverage["missing_days"]
+            }
                     
         except Exception as e:
             logger.error(f"Error in direct cache access: {e}")
-            return {"activities": [], "completeness": 0}
+            return {"activities": [], "completeness": 0, "is_complete": False}
         
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_cached_activities_optimized")
     async def get_cached_activities_optimized(self, user_ids: List[str], start_date: str, end_date: str, activity_types: List[str] = None) -> Dict:
         """
         Умное получение данных из кэша с фильтрацией по типу активности
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                placeholders = ','.join('?' for _ in user_ids)
-                
-                # Базовый запрос
-                query = f'''
-                    SELECT raw_data, data_date FROM activities_cache 
-                    WHERE user_id IN ({placeholders}) 
-                    AND data_date BETWEEN ? AND ?
-                '''
-                params = user_ids + [start_date, end_date]
-                
-                # Добавляем фильтр по типу активности если нужно
-                if activity_types and activity_types != ['all']:
-                    type_placeholders = ','.join('?' for _ in activity_types)
-                    query += f' AND type_id IN ({type_placeholders})'
-                    params.extend(activity_types)
-                
-                query += ' ORDER BY created DESC'
-                
-                cursor = await db.execute(query, params)
-                rows = await cursor.fetchall()
-                
-                if not rows:
-                    return {"activities": [], "missing_days": [], "completeness": 0}
-                
-                # Анализируем данные
-                cached_dates = set()
-                activities = []
-                
-                for row in rows:
-                    try:
-                        activity_data = json.loads(row[0])
-                        activities.append(activity_data)
-                        cached_dates.add(row[1])
-                    except Exception as e:
-                        continue
-                
-                # Определяем недостающие дни
-                start = datetime.fromisoformat(start_date)
-                end = datetime.fromisoformat(end_date)
-                total_days = (end - start).days + 1
-                
-                missing_days = []
-                current = start
-                while current <= end:
-                    date_str = current.strftime("%Y-%m-%d")
-                    if date_str not in cached_dates:
-                        missing_days.append(date_str)
-                    current += timedelta(days=1)
-                
-                completeness = ((total_days - len(missing_days)) / total_days) * 100
-                
-                logger.info(f"📊 Cache analysis: {len(activities)} activities, {completeness:.1f}% complete ({total_days - len(missing_days)}/{total_days} days)")
-                
-                if missing_days:
-                    logger.info(f"🔄 Missing days: {missing_days}")
-                
-                return {
-                    "activities": activities,
-                    "missing_days": missing_days,
-                    "completeness": completeness,
-                    "cached_days_count": len(cached_dates),
-                    "total_days": total_days
-                }
+            coverage = await self.get_coverage(user_ids, start_date, end_date)
+            async with self.pool.read() as db:
+                rows = await self._select_cached_activities(db, user_ids, start_date, end_date, activity_types)
+
+            activities = [activity for activity, _ in rows]
+            cached_dates = {local_date for _, local_date in rows}
+            missing_days = coverage["missing_days"]
+            total_days = (date.fromisoformat(end_date[:10]) - date.fromisoformat(start_date[:10])).days + 1
+
+            logger.info(f"📊 Cache analysis: {len(activities)} activities, {coverage['completeness']:.1f}% complete")
+
+            if missing_days:
+                logger.info(f"🔄 Missing days: {missing_days}")
+
+            return {
+                "activities": activities,
+                "missing_days": missing_days,
+                "completeness": coverage["completeness"],
+                "is_complete": coverage["is_complete"],
+                "cached_days_count": len(cached_dates),
+                "total_days": total_days
+            }
                     
         except Exception as e:
             logger.error(f"Error analyzing cache: {e}")
-            return {"activities": [], "missing_days": [], "completeness": 0}
+            return {"activities": [], "missing_days": [], "completeness": 0, "is_complete": False}
         
+    @staticmethod
+    def _observe_completeness(completeness: float, is_complete: bool):
+        # Попадание - период целиком покрыт, /api/stats/main отдаст его из кэша
+        metrics.warehouse_completeness.observe(completeness)
+        metrics.cache_lookups.inc(cache='activities', result='hit' if is_complete else 'miss')
+
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_cached_activities_for_selected_users")
     async def get_cached_activities_for_selected_users(self, selected_user_ids: List[str], start_date: str, end_date: str, activity_types: List[str] = None) -> Dict:
         """
-        Проверяет полноту кэша ТОЛЬКО для выбранных пользователей
-        с умной логикой для разного количества пользователей
+        Активности выбранных пользователей из кэша и полнота по журналу покрытия
+
+        Полнота - доля дней (пользователь * день), загруженных из Bitrix полностью;
+        дни без активностей, которые были загружены, считаются покрытыми.
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                placeholders = ','.join('?' for _ in selected_user_ids)
-                
-                # Базовый запрос для выбранных пользователей
-                query = f'''
-                    SELECT raw_data, data_date FROM activities_cache 
-                    WHERE user_id IN ({placeholders}) 
-                    AND data_date BETWEEN ? AND ?
-                '''
-                params = selected_user_ids + [start_date, end_date]
-                
-                # Фильтр по типу активности
-                if activity_types and activity_types != ['all']:
-                    type_placeholders = ','.join('?' for _ in activity_types)
-                    query += f' AND type_id IN ({type_placeholders})'
-                    params.extend(activity_types)
-                
-                query += ' ORDER BY created DESC'
-                
-                cursor = await db.execute(query, params)
-                rows = await cursor.fetchall()
-                
-                if not rows:
-                    return {"activities": [], "missing_days": [], "completeness": 0, "selected_users": selected_user_ids}
-                
-                # Анализируем данные ТОЛЬКО для выбранных пользователей
-                activities = []
-                user_activities = {user_id: [] for user_id in selected_user_ids}
-                all_dates = set()
-                
-                for row in rows:
-                    try:
-                        activity_data = json.loads(row[0])
-                        user_id = str(activity_data.get('AUTHOR_ID'))
-                        if user_id in selected_user_ids:
-                            activities.append(activity_data)
-                            user_activities[user_id].append(activity_data)
-                            # Извлекаем дату из CREATED
-                            created_str = activity_data.get('CREATED', '').replace('Z', '+00:00')
-                            activity_date = datetime.fromisoformat(created_str).strftime('%Y-%m-%d')
-                            all_dates.add(activity_date)
-                    except Exception as e:
-                        continue
-                
-                # 🔥 УМНАЯ ЛОГИКА: разный подход для разного количества пользователей
-                start = datetime.fromisoformat(start_date)
-                end = datetime.fromisoformat(end_date)
-                total_days = (end - start).days + 1
-                
-                # Считаем покрытие дней для каждого пользователя
-                user_days_coverage = {}
-                for user_id, user_acts in user_activities.items():
-                    user_dates = set()
-                    for act in user_acts:
-                        try:
-                            created_str = act.get('CREATED', '').replace('Z', '+00:00')
-                            activity_date = datetime.fromisoformat(created_str).strftime('%Y-%m-%d')
-                            user_dates.add(activity_date)
-                        except:
-                            continue
-                    user_days_coverage[user_id] = user_dates
-                
-                # 🔥 КЛЮЧЕВОЕ ИСПРАВЛЕНИЕ: разная логика в зависимости от количества пользователей
-                if len(selected_user_ids) == 1:
-                    # Для одного пользователя: требуем данные только за рабочие дни
-                    user_id = selected_user_ids[0]
-                    user_dates = user_days_coverage.get(user_id, set())
-                    
-                    # Считаем только рабочие дни (пн-пт)
-                    work_days = 0
-                    current = start
-                    while current <= end:
-                        # Пн=0, Вт=1, Ср=2, Чт=3, Пт=4, Сб=5, Вс=6
-                        if current.weekday() < 5:  # Только пн-пт
-                            work_days += 1
-                        current += timedelta(days=1)
-                    
-                    # Для одного пользователя считаем полноту только по рабочим дням
-                    user_work_days_with_data = 0
-                    current = start
-                    while current <= end:
-                        date_str = current.strftime("%Y-%m-%d")
-                        if current.weekday() < 5 and date_str in user_dates:  # Рабочий день с данными
-                            user_work_days_with_data += 1
-                        current += timedelta(days=1)
-                    
-                    completeness = (user_work_days_with_data / work_days) * 100 if work_days > 0 else 0
-                    missing_days = []
-                    
-                    logger.info(f"📊 Single user cache: {user_work_days_with_data}/{work_days} work days ({completeness:.1f}%)")
-                    
-                else:
-                    # Для нескольких пользователей: объединенное покрытие
-                    all_covered_days = set()
-                    for user_dates in user_days_coverage.values():
-                        all_covered_days.update(user_dates)
-                    
-                    missing_days = []
-                    current = start
-                    while current <= end:
-                        date_str = current.strftime("%Y-%m-%d")
-                        if date_str not in all_covered_days:
-                            missing_days.append(date_str)
-                        current += timedelta(days=1)
-                    
-                    completeness = ((total_days - len(missing_days)) / total_days) * 100
-                
-                # 🔥 АДАПТИВНЫЕ ПОРОГИ в зависимости от количества пользователей
-                user_coverage_info = {}
-                for user_id in selected_user_ids:
-                    user_dates = user_days_coverage.get(user_id, set())
-                    user_coverage_info[user_id] = {
-                        'days_with_data': len(user_dates),
-                        'total_days': total_days,
-                        'coverage_percent': (len(user_dates) / total_days) * 100 if total_days > 0 else 0
-                    }
-                
-                logger.info(f"📊 Smart cache analysis for {len(selected_user_ids)} users: {len(activities)} activities, {completeness:.1f}% complete")
-                
-                return {
-                    "activities": activities,
-                    "missing_days": missing_days,
-                    "completeness": completeness,
-                    "total_days": total_days,
-                    "selected_users": selected_user_ids,
-                    "user_coverage_info": user_coverage_info,
-                    "total_activities": len(activities),
-                    "user_count": len(selected_user_ids)  # Добавляем количество пользователей
+            coverage = await self.get_coverage(selected_user_ids, start_date, end_date)
+            async with self.pool.read() as db:
+                rows = await self._select_cached_activities(db, selected_user_ids, start_date, end_date, activity_types)
+
+            activities = []
+            user_days_coverage = {user_id: set() for user_id in selected_user_ids}
+            for activity, local_date in rows:
+                user_id = activity['AUTHOR_ID']
+                if user_id in user_days_coverage:
+                    activities.append(activity)
+                    user_days_coverage[user_id].add(local_date)
+
+            completeness = coverage["completeness"]
+            total_days = (date.fromisoformat(end_date[:10]) - date.fromisoformat(start_date[:10])).days + 1
+
+            user_coverage_info = {}
+            for user_id in selected_user_ids:
+                user_dates = user_days_coverage.get(user_id, set())
+                user_gaps = coverage["gaps"].get(str(user_id), [])
+                missing = sum((date.fromisoformat(gap_end) - date.fromisoformat(gap_start)).days + 1 for gap_start, gap_end in user_gaps)
+                user_coverage_info[user_id] = {
+                    'days_with_data': len(user_dates),
+                    'total_days': total_days,
+                    'coverage_percent': (total_days - missing) / total_days * 100 if total_days > 0 else 0,
+                    'gaps': user_gaps
                 }
+
+            logger.info(f"📊 Cache for {len(selected_user_ids)} users: {len(activities)} activities, {completeness:.1f}% covered")
+            self._observe_completeness(completeness, coverage["is_complete"])
+
+            return {
+                "activities": activities,
+                "missing_days": coverage["missing_days"],
+                "completeness": completeness,
+                "is_complete": coverage["is_complete"],
+                "total_days": total_days,
+                "selected_users": selected_user_ids,
+                "user_coverage_info": user_coverage_info,
+                "gaps": coverage["gaps"],
+                "total_activities": len(activities),
+                "user_count": len(selected_user_ids)  # Добавляем количество пользователей
+            }
                     
         except Exception as e:
             logger.error(f"Error analyzing cache for selected users: {e}")
-            return {"activities": [], "missing_days": [], "completeness": 0, "selected_users": selected_user_ids}
+            return {"activities": [], "missing_days": [], "completeness": 0, "is_complete": False, "gaps": {}, "selected_users": selected_user_ids}
 
+    @metrics.timed(metrics.warehouse_query_duration, operation="get_cached_activities_simple")
     async def get_cached_activities_simple(self, user_ids: List[str], start_date: str, end_date: str, activity_types: List[str] = None) -> Dict:
         """
-        🔥 УПРОЩЕННЫЙ МЕТОД для быстрой загрузки - только проверяет наличие данных без сложной логики
+        🔥 УПРОЩЕННЫЙ МЕТОД для быстрой загрузки - данные из кэша и полнота по журналу покрытия
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                placeholders = ','.join('?' for _ in user_ids)
-                
-                # Простой запрос - получаем ВСЕ данные за период
-                query = f'''
-                    SELECT raw_data, data_date FROM activities_cache 
-                    WHERE user_id IN ({placeholders}) 
-                    AND data_date BETWEEN ? AND ?
-                '''
-                params = user_ids + [start_date, end_date]
-                
-                # Фильтр по типу активности
-                if activity_types and activity_types != ['all']:
-                    type_placeholders = ','.join('?' for _ in activity_types)
-                    query += f' AND type_id IN ({type_placeholders})'
-                    params.extend(activity_types)
-                
-                query += ' ORDER BY created DESC'
-                
-                cursor = await db.execute(query, params)
-                rows = await cursor.fetchall()
-                
-                if not rows:
-                    return {"activities": [], "completeness": 0}
-                
-                # Просто собираем активности
-                activities = []
-                cached_dates = set()
-                
-                for row in rows:
-                    try:
-                        activity_data = json.loads(row[0])
-                        activities.append(activity_data)
-                        cached_dates.add(row[1])
-                    except Exception as e:
-                        continue
-                
-                # Простая проверка полноты - считаем дни
-                start = datetime.fromisoformat(start_date)
-                end = datetime.fromisoformat(end_date)
-                total_days = (end - start).days + 1
-                
-                completeness = (len(cached_dates) / total_days) * 100
-                
-                logger.info(f"⚡ Simple cache check: {len(activities)} activities, {completeness:.1f}% complete ({len(cached_dates)}/{total_days} days)")
-                
-                return {
-                    "activities": activities,
-                    "completeness": completeness,
-                    "cached_days": len(cached_dates),
-                    "total_days": total_days
-                }
+            coverage = await self.get_coverage(user_ids, start_date, end_date)
+            async with self.pool.read() as db:
+                rows = await self._select_cached_activities(db, user_ids, start_date, end_date, activity_types)
+
+            activities = [activity for activity, _ in rows]
+            cached_dates = {local_date for _, local_date in rows}
+            total_days = (date.fromisoformat(end_date[:10]) - date.fromisoformat(start_date[:10])).days + 1
+
+            logger.info(f"⚡ Simple cache check: {len(activities)} activities, {coverage['completeness']:.1f}% complete")
+
+            return {
+                "activities": activities,
+                "completeness": coverage["completeness"],
+                "is_complete": coverage["is_complete"],
+                "cached_days": len(cached_dates),
+                "total_days": total_days
+            }
                     
         except Exception as e:
             logger.error(f"Error in simple cache check: {e}")
-            return {"activities": [], "completeness": 0}
\ No newline at end of file
+            return {"activities": [], "completeness": 0, "is_complete": False}
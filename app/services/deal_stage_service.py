@@ -0,0 +1,95 @@
+import asyncio
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def build_stage_index(stages: List[Dict]) -> Dict[str, Dict]:
+    """Индекс STATUS_ID -> стадия (при совпадении ID побеждает последняя запись)"""
+    index = {}
+    for stage in stages:
+        status_id = stage.get('STATUS_ID')
+        if status_id:
+            index[status_id] = stage
+    return index
+
+
+def resolve_stage(index: Dict[str, Dict], stage_id: str = None, type_id: str = None, status_id: str = None) -> Dict:
+    """Стадия сделки по цепочке STAGE_ID -> TYPE_ID -> STATUS_ID"""
+    for potential_id in (stage_id, type_id, status_id):
+        if potential_id and potential_id in index:
+            return index[potential_id]
+    return {
+        'NAME': stage_id or 'Неизвестно',
+        'COLOR': '#cccccc',
+        'ENTITY_ID': 'UNKNOWN'
+    }
+
+
+class DealStageService:
+    """Словарь стадий сделок: память -> warehouse -> Bitrix24 (один batch-запрос)"""
+
+    def __init__(self, bitrix_service, warehouse_service=None):
+        self.bitrix_service = bitrix_service
+        self.warehouse_service = warehouse_service
+        self._stages: List[Dict] = []
+        self._index: Dict[str, Dict] = {}
+        self._loaded_at: Optional[datetime] = None
+        self._ttl = int(os.getenv("DEAL_STAGES_TTL", str(6 * 60 * 60)))
+        self._lock = asyncio.Lock()
+
+    def _set_stages(self, stages: List[Dict], loaded_at: datetime):
+        self._stages = stages
+        self._index = build_stage_index(stages)
+        self._loaded_at = loaded_at
+
+    def _is_fresh(self) -> bool:
+        return bool(self._loaded_at) and (datetime.now() - self._loaded_at).total_seconds() < self._ttl
+
+    async def initialize(self):
+        """Поднимает словарь из warehouse, чтобы после перезапуска не ходить в Bitrix24"""
+        if self.warehouse_service is None:
+            return
+        stages, loaded_at = await self.warehouse_service.load_deal_stages()
+        if stages:
+            self._set_stages(stages, loaded_at)
+            logger.info(f"📊 Deal stages restored from warehouse: {len(stages)}")
+
+    async def refresh(self) -> bool:
+        """Перезагружает словарь из Bitrix24; при неудаче остается прежний"""
+        stages = await self.bitrix_service.get_deal_stages()
+        if not stages:
+            logger.warning("⚠️ Deal stages refresh failed, keeping previous dictionary")
+            return False
+
+        self._set_stages(stages, datetime.now())
+        if self.warehouse_service is not None:
+            await self.warehouse_service.save_deal_stages(stages)
+        return True
+
+    async def _ensure_loaded(self):
+        if self._is_fresh():
+            return
+        async with self._lock:
+            if not self._is_fresh():
+                await self.refresh()
+
+    async def get_stages(self) -> List[Dict]:
+        """Все стадии в порядке DEAL_STAGE, DEAL_TYPE, STATUS"""
+        await self._ensure_loaded()
+        return self._stages
+
+    async def get_index(self) -> Dict[str, Dict]:
+        """Индекс STATUS_ID -> стадия для resolve_stage"""
+        await self._ensure_loaded()
+        return self._index
+
+    def get_status(self) -> Dict:
+        return {
+            "stages": len(self._stages),
+            "loaded_at": self._loaded_at.isoformat() if self._loaded_at else None,
+            "ttl_seconds": self._ttl
+        }
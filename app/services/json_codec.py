@@ -0,0 +1,76 @@
+import json
+import logging
+from typing import Any, Dict, Optional, Sequence, TypedDict
+
+logger = logging.getLogger(__name__)
+
+# Быстрые декодеры подключаются, если установлены; иначе работает stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+elif msgspec is not None:
+    JSON_BACKEND = "msgspec"
+else:
+    JSON_BACKEND = "json"
+
+_msgspec_decoder = msgspec.json.Decoder() if msgspec is not None else None
+_typed_decoders: Dict[tuple, Any] = {}
+
+
+def loads(data):
+    """Разбирает JSON (bytes или str) самым быстрым доступным декодером"""
+    if orjson is not None:
+        return orjson.loads(data)
+    if _msgspec_decoder is not None:
+        return _msgspec_decoder.decode(data.encode() if isinstance(data, str) else data)
+    return json.loads(data)
+
+
+def dumps(obj) -> str:
+    """Сериализует объект в JSON-строку"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _typed_decoder(fields: tuple):
+    """msgspec-декодер ответа списочного метода, который собирает только поля fields"""
+    decoder = _typed_decoders.get(fields)
+    if decoder is None:
+        row_type = TypedDict("BitrixRow", {field: Any for field in fields}, total=False)
+        response_type = TypedDict("BitrixListResponse", {
+            'result': list[row_type],
+            'total': int,
+            'next': int,
+            'time': Dict[str, Any],
+            'error': str,
+            'error_description': str,
+        }, total=False)
+        decoder = msgspec.json.Decoder(response_type)
+        _typed_decoders[fields] = decoder
+    return decoder
+
+
+def decode_bitrix_response(body: bytes, row_fields: Optional[Sequence[str]] = None) -> Dict:
+    """Декодирует ответ Bitrix24
+
+    row_fields включает типизированный режим (нужен msgspec): из каждой строки
+    result материализуются только перечисленные поля, остальные пропускаются
+    парсером без создания объектов. Если ответ не подходит под схему
+    (ошибка, result не список), используется обычный разбор.
+    """
+    if row_fields and msgspec is not None:
+        try:
+            return _typed_decoder(tuple(row_fields)).decode(body)
+        except msgspec.ValidationError:
+            pass
+    return loads(body)
@@ -0,0 +1,171 @@
+"""Метрики приложения в текстовом формате Prometheus (без prometheus_client)
+
+Счетчики, гистограммы и gauge с метками хранятся в памяти процесса;
+render() отдает их для эндпоинта /metrics.
+"""
+import functools
+import time
+from typing import Dict, Iterable, List, Tuple
+
+# Секунды: от быстрых чтений SQLite до медленных страниц Bitrix
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, description: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, key)} {value}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        # ключ меток -> [счетчики по корзинам, сумма, количество]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][index] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+_registry: List[_Metric] = []
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def timed(histogram: Histogram, **labels):
+    """Декоратор корутины: длительность вызова в histogram"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+# --- Bitrix24 ---
+bitrix_requests = _register(Counter(
+    'bitrix_requests_total', 'HTTP-запросы к Bitrix24 по методу и результату', ('method', 'outcome')))
+bitrix_request_duration = _register(Histogram(
+    'bitrix_request_duration_seconds', 'Длительность HTTP-запроса к Bitrix24 (без ожидания лимитера)', ('method',)))
+bitrix_errors = _register(Counter(
+    'bitrix_errors_total', 'Ошибки Bitrix24 по классу', ('method', 'error_class')))
+bitrix_response_bytes = _register(Counter(
+    'bitrix_response_bytes_total', 'Объем ответов Bitrix24', ('method',)))
+bitrix_limiter_wait = _register(Histogram(
+    'bitrix_rate_limiter_wait_seconds', 'Ожидание слота в лимитере запросов'))
+bitrix_retries = _register(Counter(
+    'bitrix_retries_total', 'Повторы запросов после временных ошибок', ('method',)))
+bitrix_coalesced = _register(Counter(
+    'bitrix_coalesced_requests_total', 'Запросы, склеенные с уже выполняющимся одинаковым'))
+bitrix_operating_seconds = _register(Gauge(
+    'bitrix_operating_seconds', 'Последнее time.operating метода (квота портала 480 с за 10 мин)', ('method',)))
+bitrix_limiter_rate = _register(Gauge(
+    'bitrix_rate_limiter_rate', 'Текущий темп лимитера, запросов/сек'))
+bitrix_limiter_in_flight = _register(Gauge(
+    'bitrix_rate_limiter_in_flight', 'Запросы к Bitrix24 в работе'))
+bitrix_limiter_queue_depth = _register(Gauge(
+    'bitrix_rate_limiter_queue_depth', 'Запросы, ожидающие слот лимитера'))
+bitrix_circuit_open = _register(Gauge(
+    'bitrix_circuit_open', '1, если circuit breaker разомкнут'))
+
+# --- Кэши ---
+cache_lookups = _register(Counter(
+    'cache_lookups_total', 'Обращения к кэшам', ('cache', 'result')))
+warehouse_completeness = _register(Histogram(
+    'warehouse_cache_completeness_percent', 'Полнота кэша активностей за запрошенный период',
+    buckets=(10, 25, 50, 75, 90, 95, 99, 100)))
+
+# --- SQLite ---
+warehouse_query_duration = _register(Histogram(
+    'warehouse_query_duration_seconds', 'Длительность операций с SQLite warehouse', ('operation',)))
+
+# --- HTTP API ---
+http_requests = _register(Counter(
+    'http_requests_total', 'Запросы к API дашборда', ('method', 'route', 'status')))
+http_request_duration = _register(Histogram(
+    'http_request_duration_seconds', 'Длительность обработки запросов API', ('method', 'route')))
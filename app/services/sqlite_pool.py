@@ -0,0 +1,114 @@
+"""Пул соединений aiosqlite для warehouse
+
+Одно соединение-писатель (запись сериализуется блокировкой) и несколько
+читателей, открытых на все время работы приложения. База в режиме WAL:
+читатели не ждут писателя, а писатель не получает "database is locked"
+от долгих чтений.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import logging
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Общие настройки каждого соединения
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class SQLitePool:
+    def __init__(self, db_path: str, readers: int = None):
+        self.db_path = db_path
+        self.readers_count = max(1, readers or int(os.getenv("WAREHOUSE_DB_READERS", "4")))
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle_readers: Optional[asyncio.Queue] = None
+        self._open_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def open(self):
+        """Открывает писателя (он же включает WAL) и читателей"""
+        async with self._open_lock:
+            if self.is_open:
+                return
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+
+            writer = await self._connect()
+            cursor = await writer.execute("PRAGMA journal_mode=WAL")
+            journal_mode = (await cursor.fetchone())[0]
+
+            idle_readers = asyncio.Queue()
+            for _ in range(self.readers_count):
+                reader = await self._connect()
+                await reader.execute("PRAGMA query_only=ON")
+                self._readers.append(reader)
+                idle_readers.put_nowait(reader)
+
+            self._idle_readers = idle_readers
+            self._writer = writer
+            logger.info(f"🗄️ SQLite pool opened: {self.db_path}, journal={journal_mode}, readers={self.readers_count}")
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_path)
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    async def close(self):
+        """Закрывает все соединения (после завершения фоновых задач)"""
+        async with self._open_lock:
+            if not self.is_open:
+                return
+            async with self._write_lock:
+                await self._writer.close()
+                self._writer = None
+            for reader in self._readers:
+                await reader.close()
+            self._readers = []
+            self._idle_readers = None
+            logger.info("🗄️ SQLite pool closed")
+
+    @asynccontextmanager
+    async def write(self):
+        """Соединение-писатель в монопольном пользовании
+
+        Незакоммиченная транзакция фиксируется на выходе из блока,
+        при исключении - откатывается.
+        """
+        if not self.is_open:
+            await self.open()
+        async with self._write_lock:
+            db = self._writer
+            try:
+                yield db
+            except BaseException:
+                if db.in_transaction:
+                    await db.rollback()
+                raise
+            if db.in_transaction:
+                await db.commit()
+
+    @asynccontextmanager
+    async def read(self):
+        """Свободное соединение-читатель (только SELECT)"""
+        if not self.is_open:
+            await self.open()
+        idle_readers = self._idle_readers
+        db = await idle_readers.get()
+        try:
+            yield db
+        finally:
+            idle_readers.put_nowait(db)
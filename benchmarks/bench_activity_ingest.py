@@ -0,0 +1,130 @@
+"""Бенчмарк записи активностей в кэш warehouse
+
+Запуск:
+    python -m benchmarks.bench_activity_ingest                   # 10k, 100k, 1M
+    python -m benchmarks.bench_activity_ingest 10000 50000       # свои размеры
+    python -m benchmarks.bench_activity_ingest --legacy-max 0    # без построчного варианта
+
+Сравнивает DataWarehouseService.cache_activities (колоночная таблица
+activities, executemany, транзакции по ingest_chunk_size, ON CONFLICT DO UPDATE)
+с прежней построчной записью в activities_cache (execute на каждую активность,
+raw_data JSON). Каждый прогон - новая база во временном каталоге, WAL и
+pragmas как в пуле; кроме скорости печатается размер файла на активность.
+"""
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from app.services.data_warehouse_service import DataWarehouseService
+from app.services.sqlite_pool import SQLitePool
+
+
+def synthetic_activities(count: int):
+    rnd = random.Random(42)
+    for activity_id in range(1, count + 1):
+        yield {
+            'ID': str(activity_id),
+            'AUTHOR_ID': str(rnd.choice([8860, 8988, 17087, 17919, 17395, 18065])),
+            'RESPONSIBLE_ID': str(rnd.choice([8860, 8988, 17087])),
+            'TYPE_ID': str(rnd.choice([1, 2, 4, 6])),
+            'CREATED': f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T{rnd.randint(8, 19):02d}:{rnd.randint(0, 59):02d}:00+03:00",
+            'LAST_UPDATED': "2024-12-28T12:00:00+03:00",
+            'COMPLETED': 'Y',
+            'DIRECTION': '2',
+            'OWNER_ID': str(rnd.randint(1, 50000)),
+            'OWNER_TYPE_ID': '2',
+            'SUBJECT': 'Звонок клиенту по коммерческому предложению',
+            'DESCRIPTION': 'Обсудили условия внедрения, ' * rnd.randint(1, 10),
+        }
+
+
+LEGACY_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS activities_cache (
+        id INTEGER PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        created TEXT NOT NULL,
+        type_id TEXT NOT NULL,
+        description TEXT,
+        subject TEXT,
+        raw_data TEXT,
+        cached_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        data_date TEXT NOT NULL
+    )
+'''
+
+
+async def legacy_cache_activities(warehouse: DataWarehouseService, activities):
+    """Прежняя реализация: INSERT OR REPLACE построчно, один commit в конце"""
+    async with warehouse.pool.write() as db:
+        await db.execute(LEGACY_SCHEMA)
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_activities_user_date ON activities_cache(user_id, created)')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_activities_data_date ON activities_cache(data_date)')
+        for activity in activities:
+            created_str = activity.get('CREATED', '')
+            try:
+                activity_date = datetime.fromisoformat(created_str.replace('Z', '+00:00'))
+                data_date = activity_date.strftime("%Y-%m-%d")
+            except ValueError:
+                data_date = datetime.now().strftime("%Y-%m-%d")
+            await db.execute(
+                '''INSERT OR REPLACE INTO activities_cache
+                   (id, user_id, created, type_id, description, subject, raw_data, data_date)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                (
+                    activity.get('ID'), activity.get('AUTHOR_ID'), created_str, activity.get('TYPE_ID'),
+                    activity.get('DESCRIPTION', ''), activity.get('SUBJECT', ''), json.dumps(activity), data_date
+                )
+            )
+        await db.commit()
+
+
+async def run(name: str, ingest, table: str, activities, directory: Path) -> float:
+    warehouse = DataWarehouseService(bitrix_service=None)
+    warehouse.db_path = str(directory / f"{name}_{len(activities)}.db")
+    warehouse.pool = SQLitePool(warehouse.db_path)
+    await warehouse.initialize()
+
+    started = time.perf_counter()
+    await ingest(warehouse, activities)
+    elapsed = time.perf_counter() - started
+
+    async with warehouse.pool.read() as db:
+        stored = (await (await db.execute(f"SELECT COUNT(*) FROM {table}")).fetchone())[0]
+    async with warehouse.pool.write() as db:
+        await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    await warehouse.close()
+    size = Path(warehouse.db_path).stat().st_size
+
+    assert stored == len(activities), f"{name}: stored {stored} of {len(activities)}"
+    print(
+        f"{name:<8} {len(activities):>9,} rows  {elapsed:8.2f} s  {len(activities) / elapsed:>10,.0f} rows/s"
+        f"  {size / 1024 / 1024:8.1f} MB  {size / len(activities):6.0f} B/row"
+    )
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sizes', nargs='*', type=int, default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--legacy-max', type=int, default=100_000,
+                        help='построчный вариант только для размеров не больше этого')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        for size in args.sizes:
+            activities = list(synthetic_activities(size))
+            bulk = await run('bulk', lambda w, a: w.cache_activities(a), 'activities', activities, directory)
+            if size <= args.legacy_max:
+                legacy = await run('legacy', legacy_cache_activities, 'activities_cache', activities, directory)
+                print(f"{'':<8} x{legacy / bulk:.1f} faster")
+            print()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
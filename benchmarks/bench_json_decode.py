@@ -0,0 +1,95 @@
+"""Микробенчмарк декодирования страниц crm.activity.list
+
+Запуск:
+    python -m benchmarks.bench_json_decode                 # синтетические страницы
+    python -m benchmarks.bench_json_decode path/to/pages   # записанные ответы Bitrix (*.json)
+
+Сравнивает stdlib json, orjson, msgspec и типизированный режим msgspec,
+который материализует только поля статистики (ID, AUTHOR_ID, TYPE_ID, CREATED).
+"""
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+from app.services import json_codec
+
+STATS_FIELDS = ['ID', 'AUTHOR_ID', 'TYPE_ID', 'CREATED']
+
+
+def synthetic_pages(count: int = 200, page_size: int = 50):
+    """Страницы, похожие на реальные: длинные DESCRIPTION, привязки, коммуникации"""
+    rnd = random.Random(42)
+    pages = []
+    activity_id = 100000
+    for _ in range(count):
+        rows = []
+        for _ in range(page_size):
+            activity_id += 1
+            rows.append({
+                'ID': str(activity_id),
+                'OWNER_ID': str(rnd.randint(1, 50000)),
+                'OWNER_TYPE_ID': '2',
+                'TYPE_ID': str(rnd.choice([1, 2, 4, 6])),
+                'AUTHOR_ID': str(rnd.choice([8860, 8988, 17087, 17919, 17395, 18065])),
+                'RESPONSIBLE_ID': str(rnd.choice([8860, 8988, 17087])),
+                'CREATED': f"2024-05-{rnd.randint(1, 28):02d}T{rnd.randint(8, 19):02d}:{rnd.randint(0, 59):02d}:00+03:00",
+                'LAST_UPDATED': "2024-05-28T12:00:00+03:00",
+                'SUBJECT': 'Звонок клиенту по коммерческому предложению',
+                'DESCRIPTION': 'Обсудили условия внедрения, ' * rnd.randint(5, 60),
+                'DESCRIPTION_TYPE': '1',
+                'COMPLETED': 'Y',
+                'DIRECTION': '2',
+                'BINDINGS': [{'OWNER_ID': str(rnd.randint(1, 50000)), 'OWNER_TYPE_ID': '2'}],
+                'COMMUNICATIONS': [{'TYPE': 'PHONE', 'VALUE': '+7900' + str(rnd.randint(1000000, 9999999))}],
+                'SETTINGS': {}, 'PROVIDER_ID': 'VOXIMPLANT_CALL', 'PROVIDER_TYPE_ID': 'CALL',
+            })
+        pages.append(json.dumps({
+            'result': rows, 'next': 50, 'total': 10000,
+            'time': {'start': 1.0, 'finish': 1.2, 'duration': 0.2, 'operating': 0.15}
+        }, ensure_ascii=False).encode())
+    return pages
+
+
+def recorded_pages(path: Path):
+    return [p.read_bytes() for p in sorted(path.glob('*.json'))]
+
+
+def bench(name, decode, pages, rounds: int = 5):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for body in pages:
+            decode(body)
+        best = min(best, time.perf_counter() - started)
+    total_mb = sum(len(p) for p in pages) / 1024 / 1024
+    print(f"{name:<22} {best * 1000:9.1f} ms  {total_mb / best:8.1f} MB/s")
+    return best
+
+
+def main():
+    pages = recorded_pages(Path(sys.argv[1])) if len(sys.argv) > 1 else synthetic_pages()
+    total_mb = sum(len(p) for p in pages) / 1024 / 1024
+    print(f"{len(pages)} pages, {total_mb:.1f} MB, default backend: {json_codec.JSON_BACKEND}\n")
+
+    baseline = bench('stdlib json', json.loads, pages)
+    results = {}
+    if json_codec.orjson is not None:
+        results['orjson'] = bench('orjson', json_codec.orjson.loads, pages)
+    if json_codec.msgspec is not None:
+        decoder = json_codec.msgspec.json.Decoder()
+        results['msgspec'] = bench('msgspec', decoder.decode, pages)
+        results['msgspec typed (stats)'] = bench(
+            'msgspec typed (stats)',
+            lambda body: json_codec.decode_bitrix_response(body, STATS_FIELDS),
+            pages
+        )
+
+    print()
+    for name, elapsed in results.items():
+        print(f"{name:<22} x{baseline / elapsed:.1f} vs stdlib")
+
+
+if __name__ == '__main__':
+    main()
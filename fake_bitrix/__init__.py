@@ -0,0 +1,10 @@
+"""Локальная имитация Bitrix24 REST для тестов и бенчмарков без портала
+
+    python -m fake_bitrix --users 2000 --activities 2000000 --latency 0.05 --rate 2
+    BITRIX_WEBHOOK_URL=http://127.0.0.1:8765/rest uvicorn main:app
+"""
+from fake_bitrix.dataset import SyntheticDataset
+from fake_bitrix.recording import FixtureStore, RecordingProxy, ReplayHandler
+from fake_bitrix.server import FakeBitrix, make_app
+
+__all__ = ['SyntheticDataset', 'FakeBitrix', 'make_app', 'FixtureStore', 'RecordingProxy', 'ReplayHandler']
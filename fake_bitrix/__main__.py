@@ -0,0 +1,63 @@
+"""Запуск имитации Bitrix24
+
+    python -m fake_bitrix                                   # синтетический портал
+    python -m fake_bitrix --record fixtures/ --upstream $BITRIX_WEBHOOK_URL
+    python -m fake_bitrix --replay fixtures/
+"""
+import argparse
+import logging
+
+from aiohttp import web
+
+from fake_bitrix.dataset import SyntheticDataset
+from fake_bitrix.recording import FixtureStore, RecordingProxy, ReplayHandler
+from fake_bitrix.server import FakeBitrix, make_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная имитация Bitrix24 REST")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--activities', type=int, default=100_000)
+    parser.add_argument('--deals', type=int, default=10_000)
+    parser.add_argument('--start', default='2024-01-01', help='начало периода данных')
+    parser.add_argument('--days', type=int, default=365, help='длина периода данных')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--rate', type=float, default=None, help='запросов в секунду (по умолчанию без лимита)')
+    parser.add_argument('--burst', type=int, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов INTERNAL_SERVER_ERROR')
+    parser.add_argument('--record', metavar='DIR', help='проксировать на --upstream и записывать фикстуры')
+    parser.add_argument('--upstream', help='вебхук настоящего портала для --record')
+    parser.add_argument('--replay', metavar='DIR', help='отдавать ответы из фикстур')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    fake = FakeBitrix(
+        SyntheticDataset(args.users, args.activities, args.deals, args.start, args.days, args.seed),
+        latency=args.latency,
+        jitter=args.jitter,
+        rate=args.rate,
+        burst=args.burst,
+        error_rate=args.error_rate
+    )
+
+    if args.record:
+        if not args.upstream:
+            parser.error('--record requires --upstream')
+        proxy = RecordingProxy(args.upstream, FixtureStore(args.record))
+        app = make_app(fake, proxy.handle)
+        app.on_cleanup.append(proxy.close)
+    elif args.replay:
+        app = make_app(fake, ReplayHandler(FixtureStore(args.replay)).handle)
+    else:
+        app = make_app(fake)
+
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
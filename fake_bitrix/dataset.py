@@ -0,0 +1,225 @@
+"""Синтетические данные портала: пользователи, активности, сделки, стадии
+
+Записи не хранятся, а вычисляются по ID детерминированной хеш-функцией,
+поэтому миллионы активностей не занимают памяти. CREATED активностей и
+DATE_CREATE сделок растут вместе с ID - фильтр по периоду превращается в
+диапазон ID без перебора.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from app.services.bitrix_service import PRESALES_USER_IDS
+
+PORTAL_TZ = timezone(timedelta(hours=3))
+
+ACTIVITY_TYPES = ['1', '2', '4', '6']
+DEAL_STAGES = [
+    ('NEW', 'Новая', '#39A8EF'),
+    ('PREPARATION', 'Подготовка документов', '#2FC6F6'),
+    ('PREPAYMENT_INVOICE', 'Счёт на предоплату', '#55D0E0'),
+    ('EXECUTING', 'В работе', '#47E4C2'),
+    ('FINAL_INVOICE', 'Финальный счёт', '#FFA900'),
+    ('WON', 'Сделка успешна', '#7BD500'),
+    ('LOSE', 'Сделка провалена', '#FF5752'),
+]
+DEAL_TYPES = [('SALE', 'Продажа'), ('COMPLEX', 'Комплексная продажа'), ('SERVICE', 'Сервисное обслуживание')]
+STATUSES = [('NEW', 'Не обработан'), ('IN_PROCESS', 'В работе'), ('CONVERTED', 'Сконвертирован'), ('JUNK', 'Некачественный')]
+STAGE_HISTORY_PER_DEAL = 3
+
+
+def _mix(value: int, salt: int) -> int:
+    """Дешевый детерминированный хеш (вариант murmur finalizer)"""
+    x = (value * 0x9E3779B1 + salt * 0x85EBCA77) & 0xFFFFFFFF
+    x ^= x >> 16
+    x = (x * 0x45D9F3B) & 0xFFFFFFFF
+    x ^= x >> 16
+    return x
+
+
+def _format(ts: float) -> str:
+    return datetime.fromtimestamp(ts, PORTAL_TZ).isoformat()
+
+
+class Collection:
+    """Виртуальная таблица: ID 1..size, поля вычисляются функциями от ID
+
+    monotonic_field - поле, которое не убывает с ID (для сужения диапазона).
+    candidates - необязательная функция фильтр -> отсортированные ID
+    (например, события истории по списку сделок).
+    id_is_index - поле ID совпадает с номером записи (иначе ID не сужает диапазон).
+    """
+
+    def __init__(
+        self,
+        size: int,
+        fields: Dict[str, Callable[[int], Any]],
+        monotonic_field: Optional[str] = None,
+        candidates: Optional[Callable[[Dict], Optional[List[int]]]] = None,
+        id_is_index: bool = True
+    ):
+        self.id_is_index = id_is_index
+        self.size = size
+        self.fields = fields
+        self.monotonic_field = monotonic_field
+        self.candidates = candidates
+
+    def value(self, entity_id: int, field: str):
+        getter = self.fields.get(field)
+        return getter(entity_id) if getter else None
+
+    def row(self, entity_id: int, select: Optional[List[str]] = None) -> Dict:
+        names = [f for f in select if f in self.fields] if select and '*' not in select else self.fields.keys()
+        return {name: self.fields[name](entity_id) for name in names}
+
+
+class SyntheticDataset:
+    def __init__(
+        self,
+        users: int = 50,
+        activities: int = 100_000,
+        deals: int = 10_000,
+        start: str = '2024-01-01',
+        days: int = 365,
+        seed: int = 42
+    ):
+        self.seed = seed
+        self.start_ts = datetime.fromisoformat(start).replace(tzinfo=PORTAL_TZ).timestamp()
+        self.span = days * 86400
+
+        self.user_ids = list(PRESALES_USER_IDS)
+        next_id = 1
+        while len(self.user_ids) < users:
+            if str(next_id) not in self.user_ids:
+                self.user_ids.append(str(next_id))
+            next_id += 1
+        self.user_ids = self.user_ids[:max(users, 1)]
+        self._user_index = {uid: n + 1 for n, uid in enumerate(self.user_ids)}
+
+        self.activities = self._activities(activities, max(deals, 1))
+        self.deals = self._deals(deals)
+        self.users = self._users()
+        self.stage_history = self._stage_history(deals)
+        self.statuses = self._statuses()
+
+    def _h(self, entity_id: int, salt: int) -> int:
+        return _mix(entity_id, salt * 1000 + self.seed)
+
+    def _spread(self, entity_id: int, size: int) -> float:
+        return self.start_ts + (entity_id - 1) * self.span / max(size, 1)
+
+    def _activities(self, size: int, deals: int) -> Collection:
+        users = self.user_ids
+        created = lambda i: self._spread(i, size)
+        author = lambda i: users[self._h(i, 1) % len(users)]
+        return Collection(size, {
+            'ID': str,
+            'OWNER_ID': lambda i: str(1 + self._h(i, 6) % deals),
+            'OWNER_TYPE_ID': lambda i: '2',
+            'TYPE_ID': lambda i: ACTIVITY_TYPES[self._h(i, 2) % len(ACTIVITY_TYPES)],
+            'AUTHOR_ID': author,
+            'RESPONSIBLE_ID': author,
+            'CREATED': lambda i: _format(created(i)),
+            'LAST_UPDATED': lambda i: _format(created(i) + self._h(i, 3) % 7200),
+            'COMPLETED': lambda i: 'N' if self._h(i, 4) % 10 == 0 else 'Y',
+            'DIRECTION': lambda i: str(1 + self._h(i, 5) % 2),
+            'SUBJECT': lambda i: f"Активность {i}",
+            'DESCRIPTION': lambda i: 'Обсудили условия внедрения. ' * (1 + self._h(i, 7) % 40),
+            'PROVIDER_ID': lambda i: 'CRM_TODO',
+        }, monotonic_field='CREATED')
+
+    def _deals(self, size: int) -> Collection:
+        users = self.user_ids
+        created = lambda i: self._spread(i, size)
+        return Collection(size, {
+            'ID': str,
+            'TITLE': lambda i: f"Сделка #{i}",
+            'STAGE_ID': lambda i: DEAL_STAGES[self._h(i, 11) % len(DEAL_STAGES)][0],
+            'TYPE_ID': lambda i: DEAL_TYPES[self._h(i, 12) % len(DEAL_TYPES)][0],
+            'ASSIGNED_BY_ID': lambda i: users[self._h(i, 13) % len(users)],
+            'DATE_CREATE': lambda i: _format(created(i)),
+            'DATE_MODIFY': lambda i: _format(created(i) + self._h(i, 14) % (30 * 86400)),
+            'OPPORTUNITY': lambda i: f"{(self._h(i, 15) % 500000):.2f}",
+            'CURRENCY_ID': lambda i: 'RUB',
+        }, monotonic_field='DATE_CREATE')
+
+    def _users(self) -> Collection:
+        ids = self.user_ids
+
+        def candidates(filters: Dict) -> Optional[List[int]]:
+            wanted = filters.get(('=', 'ID'))
+            if wanted is None:
+                return None
+            wanted = wanted if isinstance(wanted, list) else [wanted]
+            return sorted(self._user_index[str(w)] for w in wanted if str(w) in self._user_index)
+
+        return Collection(len(ids), {
+            'ID': lambda i: ids[i - 1],
+            'ACTIVE': lambda i: True,
+            'NAME': lambda i: f"Имя{ids[i - 1]}",
+            'LAST_NAME': lambda i: f"Фамилия{ids[i - 1]}",
+            'EMAIL': lambda i: f"user{ids[i - 1]}@example.com",
+            'WORK_POSITION': lambda i: 'Пресейл' if ids[i - 1] in PRESALES_USER_IDS else 'Менеджер',
+            'TIMESTAMP_X': lambda i: _format(self.start_ts + self._h(i, 21) % self.span),
+        }, candidates=candidates, id_is_index=False)
+
+    def _stage_history(self, deals: int) -> Collection:
+        per_deal = STAGE_HISTORY_PER_DEAL
+        owner = lambda i: (i - 1) // per_deal + 1
+        step = lambda i: (i - 1) % per_deal
+
+        def candidates(filters: Dict) -> Optional[List[int]]:
+            owners = filters.get(('=', 'OWNER_ID'))
+            if owners is None:
+                return None
+            owners = owners if isinstance(owners, list) else [owners]
+            ids = []
+            for deal_id in sorted({int(o) for o in owners if str(o).isdigit() and 0 < int(o) <= deals}):
+                first = (deal_id - 1) * per_deal + 1
+                ids.extend(range(first, first + per_deal))
+            return ids
+
+        return Collection(deals * per_deal, {
+            'ID': str,
+            'TYPE_ID': lambda i: 1 if step(i) == 0 else 2,
+            'OWNER_ID': lambda i: owner(i),
+            'CREATED_TIME': lambda i: _format(self._spread(owner(i), deals) + step(i) * 86400),
+            'CATEGORY_ID': lambda i: 0,
+            'STAGE_SEMANTIC_ID': lambda i: 'P',
+            'STAGE_ID': lambda i: DEAL_STAGES[min(step(i) * 3, len(DEAL_STAGES) - 1)][0],
+        }, candidates=candidates)
+
+    def _statuses(self) -> Dict[str, List[Dict]]:
+        return {
+            'DEAL_STAGE': [
+                {'ID': str(n + 1), 'ENTITY_ID': 'DEAL_STAGE', 'STATUS_ID': code, 'NAME': name, 'SORT': str((n + 1) * 10), 'COLOR': color}
+                for n, (code, name, color) in enumerate(DEAL_STAGES)
+            ],
+            'DEAL_TYPE': [
+                {'ID': str(100 + n), 'ENTITY_ID': 'DEAL_TYPE', 'STATUS_ID': code, 'NAME': name, 'SORT': str((n + 1) * 10)}
+                for n, (code, name) in enumerate(DEAL_TYPES)
+            ],
+            'STATUS': [
+                {'ID': str(200 + n), 'ENTITY_ID': 'STATUS', 'STATUS_ID': code, 'NAME': name, 'SORT': str((n + 1) * 10)}
+                for n, (code, name) in enumerate(STATUSES)
+            ],
+        }
+
+    def timeline(self, deal_id: int) -> List[Dict]:
+        """Записи crm.timeline.list о смене стадий сделки"""
+        if not 0 < deal_id <= self.deals.size:
+            return []
+        names = {code: name for code, name, _ in DEAL_STAGES}
+        first = (deal_id - 1) * STAGE_HISTORY_PER_DEAL + 1
+        entries = []
+        for event_id in range(first, first + STAGE_HISTORY_PER_DEAL):
+            stage_id = self.stage_history.value(event_id, 'STAGE_ID')
+            entries.append({
+                'ID': str(event_id),
+                'TYPE_ID': '1',
+                'TYPE_CATEGORY_ID': '1',
+                'ENTITY_ID': str(deal_id),
+                'ENTITY_TYPE': 'deal',
+                'CREATED': self.stage_history.value(event_id, 'CREATED_TIME'),
+                'DATA': {'STAGE_ID': stage_id, 'STAGE_NAME': names.get(stage_id, stage_id)},
+            })
+        return entries
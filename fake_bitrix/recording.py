@@ -0,0 +1,97 @@
+"""Запись реального трафика Bitrix24 в фикстуры и воспроизведение
+
+Запись: сервер проксирует запросы на настоящий вебхук и сохраняет ответы.
+Воспроизведение: на тот же запрос (метод + параметры без учета порядка)
+отдается сохраненный ответ, на незнакомый - ошибка FIXTURE_NOT_FOUND.
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import List, Optional, Tuple
+import logging
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+def fixture_key(method: str, items: List[Tuple[str, str]]) -> str:
+    """Ключ фикстуры: метод + отсортированные пары параметров"""
+    canonical = json.dumps([method.lower(), sorted(items)], ensure_ascii=False)
+    return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+class FixtureStore:
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+
+    def _path(self, method: str, items: List[Tuple[str, str]]) -> Path:
+        return self.directory / method.lower() / f"{fixture_key(method, items)}.json"
+
+    def save(self, method: str, items: List[Tuple[str, str]], status: int, body: bytes):
+        path = self._path(method, items)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({
+            'method': method,
+            'params': items,
+            'status': status,
+            'body': body.decode('utf-8', errors='replace'),
+        }, ensure_ascii=False, indent=1), encoding='utf-8')
+
+    def load(self, method: str, items: List[Tuple[str, str]]) -> Optional[dict]:
+        path = self._path(method, items)
+        if not path.exists():
+            return None
+        return json.loads(path.read_text(encoding='utf-8'))
+
+
+async def _request_items(request: web.Request) -> List[Tuple[str, str]]:
+    items = list(request.query.items())
+    if request.method == 'POST':
+        items.extend((await request.post()).items())
+    return items
+
+
+class RecordingProxy:
+    """Проксирует /rest/{method} на upstream (вебхук портала) и пишет фикстуры"""
+
+    def __init__(self, upstream: str, store: FixtureStore):
+        self.upstream = upstream.rstrip('/')
+        self.store = store
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        method = request.match_info['method']
+        items = await _request_items(request)
+
+        async with self.session.post(f"{self.upstream}/{method}", data=items) as response:
+            body = await response.read()
+            status = response.status
+
+        self.store.save(method, items, status, body)
+        logger.info(f"📼 Recorded {method} ({status}, {len(body)} bytes)")
+        return web.Response(body=body, status=status, content_type='application/json')
+
+    async def close(self, app=None):
+        if self.session:
+            await self.session.close()
+
+
+class ReplayHandler:
+    """Отдает ответы из фикстур"""
+
+    def __init__(self, store: FixtureStore):
+        self.store = store
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        fixture = self.store.load(method, await _request_items(request))
+        if fixture is None:
+            return web.json_response(
+                {'error': 'FIXTURE_NOT_FOUND', 'error_description': f"No recorded response for {method}"},
+                status=404
+            )
+        return web.Response(body=fixture['body'].encode(), status=fixture['status'], content_type='application/json')
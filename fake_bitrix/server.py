@@ -0,0 +1,363 @@
+"""Имитация REST API Bitrix24 (вебхук) на aiohttp
+
+Поддерживаются crm.activity.list, crm.deal.list, user.get, crm.status.list,
+crm.timeline.list, crm.stagehistory.list, server.time и batch: фильтры
+filter[<op>FIELD] и массивы filter[FIELD][], select[], order, постраничность
+start=N (с total/next) и start=-1 (без подсчета total).
+
+Задержка, лимит запросов (QUERY_LIMIT_EXCEEDED) и доля случайных ошибок
+настраиваются. Статистика обращений - GET /_stats, сброс - POST /_stats/reset.
+"""
+import asyncio
+import random
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+import logging
+
+from aiohttp import web
+
+from app.services import json_codec
+from fake_bitrix.dataset import Collection, SyntheticDataset, PORTAL_TZ
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+_FILTER_KEY = re.compile(r'^filter\[(>=|<=|!=|>|<|=|!|@)?([A-Z_]+)\](\[\])?$', re.IGNORECASE)
+_ORDER_KEY = re.compile(r'^order\[([A-Z_]+)\]$', re.IGNORECASE)
+_CMD_KEY = re.compile(r'^cmd\[(.+)\]$')
+
+
+class BitrixApiError(Exception):
+    def __init__(self, code: str, description: str, http_status: int = 400):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.http_status = http_status
+
+
+def parse_params(items: List[Tuple[str, str]]):
+    """Пары запроса -> (фильтры {(op, поле): значение|список}, select, order, прочее)"""
+    filters, order, other = {}, {}, {}
+    select = []
+    for key, value in items:
+        match = _FILTER_KEY.match(key)
+        if match:
+            op = match.group(1) or '='
+            op = {'@': '=', '!': '!='}.get(op, op)
+            field = match.group(2).upper()
+            if match.group(3):
+                filters.setdefault((op, field), []).append(value)
+            else:
+                filters[(op, field)] = value
+            continue
+        match = _ORDER_KEY.match(key)
+        if match:
+            order[match.group(1).upper()] = value.upper()
+            continue
+        if key in ('select[]', 'SELECT[]'):
+            select.append(value)
+            continue
+        other[key] = value
+    return filters, select, order, other
+
+
+def _normalize(value) -> str:
+    """Приводит даты к сравнимому виду: '2024-05-01 10:00' и ISO с T/таймзоной"""
+    return str(value).replace(' ', 'T')[:19]
+
+
+def _compare(field: str, actual, expected) -> int:
+    if actual is None:
+        return -1
+    if str(actual).lstrip('-').isdigit() and str(expected).lstrip('-').isdigit():
+        a, b = int(actual), int(expected)
+        return (a > b) - (a < b)
+    a, b = _normalize(actual), _normalize(expected)
+    return (a > b) - (a < b)
+
+
+def _matches(collection: Collection, entity_id: int, filters: Dict) -> bool:
+    for (op, field), expected in filters.items():
+        actual = collection.value(entity_id, field)
+        if isinstance(expected, list):
+            hit = str(actual) in expected
+            if hit == (op == '!='):
+                return False
+            continue
+        if isinstance(actual, bool):
+            actual = 'Y' if actual else 'N'
+        cmp = _compare(field, actual, expected)
+        if op == '=' and cmp != 0 or op == '!=' and cmp == 0:
+            return False
+        if op == '>' and cmp <= 0 or op == '>=' and cmp < 0:
+            return False
+        if op == '<' and cmp >= 0 or op == '<=' and cmp > 0:
+            return False
+    return True
+
+
+def _id_range(collection: Collection, filters: Dict) -> Tuple[int, int]:
+    """Диапазон ID, который могут дать фильтры по ID и монотонному полю"""
+    lo, hi = 1, collection.size
+    if collection.id_is_index:
+        for (op, field), value in filters.items():
+            if field != 'ID' or isinstance(value, list):
+                continue
+            value = int(value)
+            if op == '>':
+                lo = max(lo, value + 1)
+            elif op == '>=':
+                lo = max(lo, value)
+            elif op == '<':
+                hi = min(hi, value - 1)
+            elif op == '<=':
+                hi = min(hi, value)
+            elif op == '=':
+                lo, hi = max(lo, value), min(hi, value)
+
+    field = collection.monotonic_field
+    if field:
+        for (op, f), value in filters.items():
+            if f != field or isinstance(value, list):
+                continue
+            if op in ('>', '>='):
+                lo = max(lo, _bisect(collection, field, value, lo, hi, strict=op == '>'))
+            elif op in ('<', '<='):
+                hi = min(hi, _bisect(collection, field, value, lo, hi, strict=op == '<=') - 1)
+    return lo, hi
+
+
+def _bisect(collection: Collection, field: str, value, lo: int, hi: int, strict: bool) -> int:
+    """Первый ID в [lo, hi+1], у которого поле > value (strict) или >= value"""
+    target = _normalize(value)
+    left, right = lo, hi + 1
+    while left < right:
+        mid = (left + right) // 2
+        current = _normalize(collection.value(mid, field))
+        if current > target or (not strict and current == target):
+            right = mid
+        else:
+            left = mid + 1
+    return left
+
+
+class FakeBitrix:
+    def __init__(
+        self,
+        dataset: SyntheticDataset = None,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate: Optional[float] = None,
+        burst: int = 50,
+        error_rate: float = 0.0,
+        seed: int = 1
+    ):
+        self.dataset = dataset or SyntheticDataset()
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.burst = burst
+        self.error_rate = error_rate
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._random = random.Random(seed)
+        # Найденные ID для выборок с start=N, чтобы глубокие страницы не пересчитывались
+        self._match_cache: "OrderedDict[tuple, List[int]]" = OrderedDict()
+        self.stats = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'by_method': {}}
+
+    # --- ограничения ---
+
+    def _take_token(self) -> bool:
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    # --- методы ---
+
+    def call(self, method: str, items: List[Tuple[str, str]]):
+        """Выполняет метод; возвращает (result, total, next)"""
+        method = method.lower()
+        self.stats['by_method'][method] = self.stats['by_method'].get(method, 0) + 1
+        filters, select, order, other = parse_params(items)
+        ds = self.dataset
+
+        if method == 'server.time':
+            return datetime.now(PORTAL_TZ).isoformat(), None, None
+        if method == 'crm.activity.list':
+            return self._list(ds.activities, filters, select, order, other)
+        if method == 'crm.deal.list':
+            return self._list(ds.deals, filters, select, order, other)
+        if method == 'user.get':
+            user_filters, _, _, _ = parse_params([(k.replace('FILTER[', 'filter['), v) for k, v in items])
+            if 'ID' in other:
+                user_filters[('=', 'ID')] = other['ID']
+            return self._list(ds.users, user_filters, [], {}, other, default_start=0)
+        if method == 'crm.status.list':
+            entity = filters.get(('=', 'ENTITY_ID'))
+            if entity:
+                return list(ds.statuses.get(entity, [])), None, None
+            return [s for group in ds.statuses.values() for s in group], None, None
+        if method == 'crm.stagehistory.list':
+            rows, total, nxt = self._list(ds.stage_history, filters, select, order, other)
+            return {'items': rows}, total, nxt
+        if method == 'crm.timeline.list':
+            entity_id = filters.get(('=', 'ENTITY_ID'))
+            rows = ds.timeline(int(entity_id)) if entity_id and str(entity_id).isdigit() else []
+            start = int(other.get('start', 0) or 0)
+            return rows[start:start + PAGE_SIZE], len(rows), None
+        raise BitrixApiError('ERROR_METHOD_NOT_FOUND', f"Method '{method}' not found", 404)
+
+    def _list(self, collection: Collection, filters: Dict, select: List[str], order: Dict, other: Dict, default_start: int = 0):
+        descending = any(direction == 'DESC' for direction in order.values())
+        start = int(other.get('start', default_start) or 0)
+
+        candidates = collection.candidates(filters) if collection.candidates else None
+        if candidates is not None:
+            ids = candidates
+        else:
+            lo, hi = _id_range(collection, filters)
+            ids = range(lo, hi + 1)
+        if descending:
+            ids = reversed(ids)
+
+        if start == -1:
+            # Без подсчета total: идем по ID до первой полной страницы
+            page = []
+            for entity_id in ids:
+                if _matches(collection, entity_id, filters):
+                    page.append(collection.row(entity_id, select))
+                    if len(page) == PAGE_SIZE:
+                        break
+            return page, None, None
+
+        key = (id(collection), tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in filters.items())), descending)
+        matched = self._match_cache.get(key)
+        if matched is None:
+            matched = [entity_id for entity_id in ids if _matches(collection, entity_id, filters)]
+            self._match_cache[key] = matched
+            if len(self._match_cache) > 64:
+                self._match_cache.popitem(last=False)
+        else:
+            self._match_cache.move_to_end(key)
+
+        page = [collection.row(entity_id, select) for entity_id in matched[start:start + PAGE_SIZE]]
+        nxt = start + PAGE_SIZE if start + PAGE_SIZE < len(matched) else None
+        return page, len(matched), nxt
+
+    def call_batch(self, items: List[Tuple[str, str]]) -> Dict:
+        halt = False
+        commands = []
+        for key, value in items:
+            match = _CMD_KEY.match(key)
+            if match:
+                commands.append((match.group(1), value))
+            elif key == 'halt':
+                halt = value not in ('0', '', 'false')
+
+        result, errors, totals, nexts, times = {}, {}, {}, {}, {}
+        for name, command in commands:
+            method, _, query = command.partition('?')
+            try:
+                started = time.monotonic()
+                value, total, nxt = self.call(method, parse_qsl(query, keep_blank_values=True))
+                result[name] = value
+                if total is not None:
+                    totals[name] = total
+                if nxt is not None:
+                    nexts[name] = nxt
+                times[name] = {'duration': time.monotonic() - started}
+            except BitrixApiError as e:
+                errors[name] = {'error': e.code, 'error_description': e.description}
+                if halt:
+                    break
+
+        # PHP отдает пустые ассоциативные массивы как []
+        return {
+            'result': result or [],
+            'result_error': errors or [],
+            'result_total': totals or [],
+            'result_next': nexts or [],
+            'result_time': times or [],
+        }
+
+    # --- HTTP ---
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        if method.endswith('.json'):
+            method = method[:-5]
+        items = list(request.query.items())
+        if request.method == 'POST':
+            items.extend((await request.post()).items())
+
+        self.stats['requests'] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._random.uniform(0, self.jitter))
+
+        if not self._take_token():
+            self.stats['rate_limited'] += 1
+            return _error_response('QUERY_LIMIT_EXCEEDED', 'Too many requests', 503)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return _error_response('INTERNAL_SERVER_ERROR', 'Injected failure', 500)
+
+        started = time.monotonic()
+        try:
+            if method.lower() == 'batch':
+                self.stats['by_method']['batch'] = self.stats['by_method'].get('batch', 0) + 1
+                body = {'result': self.call_batch(items)}
+            else:
+                result, total, nxt = self.call(method, items)
+                body = {'result': result}
+                if total is not None:
+                    body['total'] = total
+                if nxt is not None:
+                    body['next'] = nxt
+        except BitrixApiError as e:
+            return _error_response(e.code, e.description, e.http_status)
+
+        duration = time.monotonic() - started
+        body['time'] = {
+            'start': started,
+            'finish': started + duration,
+            'duration': duration,
+            'processing': duration,
+            'operating': duration,
+        }
+        return web.Response(body=json_codec.dumps(body).encode(), content_type='application/json')
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    async def handle_stats_reset(self, request: web.Request) -> web.Response:
+        self.stats = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'by_method': {}}
+        return web.json_response({'success': True})
+
+
+def _error_response(code: str, description: str, http_status: int) -> web.Response:
+    return web.json_response({'error': code, 'error_description': description}, status=http_status)
+
+
+def make_app(fake: FakeBitrix = None, handler=None) -> web.Application:
+    """aiohttp-приложение с маршрутом /rest/{method}
+
+    Вебхук для BitrixService: BITRIX_WEBHOOK_URL=http://host:port/rest
+    handler подменяет обработчик методов (запись/воспроизведение).
+    """
+    fake = fake or FakeBitrix()
+    app = web.Application()
+    app['fake'] = fake
+    app.router.add_get('/_stats', fake.handle_stats)
+    app.router.add_post('/_stats/reset', fake.handle_stats_reset)
+    app.router.add_route('*', '/rest/{method}', handler or fake.handle)
+    return app
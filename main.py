@@ -1,9 +1,12 @@
-from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, Depends, HTTPException, Request, status
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from datetime import datetime, timedelta
-from app.services.bitrix_service import BitrixService
+from app.services.bitrix_service import BitrixService, bitrix_offline
 from app.services.data_warehouse_service import DataWarehouseService
+from app.services.deal_stage_service import DealStageService
+from app.services.bitrix_event_service import BitrixEventService
+from app.services import metrics
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from fastapi.security import HTTPBearer
@@ -13,9 +16,11 @@ from app.dependencies import get_current_user, get_current_admin
 import os
 import logging
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
 from typing import List, Optional, Dict, Any
 import asyncio
+import functools
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,15 +30,41 @@ load_dotenv()
 # Инициализация сервисов
 bitrix_service = BitrixService()
 warehouse_service = DataWarehouseService(bitrix_service)
+stage_service = DealStageService(bitrix_service, warehouse_service)
+bitrix_service.stage_service = stage_service
+bitrix_service.stage_history_store = warehouse_service
+event_service = BitrixEventService(bitrix_service, warehouse_service)
+
+# Фоновые записи в warehouse: ссылки держим, чтобы задачи не собрал GC, и дожидаемся их при остановке
+background_tasks = set()
+
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     await warehouse_service.initialize()
     logger.info("✅ Warehouse service started")
+    await stage_service.initialize()
+    await bitrix_service.open_session()
+    await bitrix_service.warm_up()
+    run_in_background(warehouse_service.refresh_user_directory())
+    await warehouse_service.start_background_sync()
+    event_service.start()
     yield
     # Shutdown
+    if background_tasks:
+        logger.info(f"⏳ Waiting for {len(background_tasks)} background writes")
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await event_service.stop()
+    await warehouse_service.stop_background_sync()
     await bitrix_service.close_session()
+    await warehouse_service.close()
 
 app = FastAPI(
     title="Bitrix24 Analytics Dashboard", 
@@ -49,6 +80,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Длительность и статус каждого запроса API для /metrics"""
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Шаблон маршрута (/api/deals/{deal_id}/...), чтобы не плодить метки по ID
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", "unmatched")
+        metrics.http_requests.inc(method=request.method, route=route_path, status=status_code)
+        metrics.http_request_duration.observe(time.perf_counter() - started, method=request.method, route=route_path)
+
+
+def cache_only(endpoint):
+    """Эндпоинт отвечает только из кэша: любой запрос к Bitrix24 внутри него - ошибка"""
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        with bitrix_offline():
+            return await endpoint(*args, **kwargs)
+    return wrapper
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    limiter = bitrix_service.rate_limiter
+    metrics.bitrix_limiter_rate.set(limiter.rate)
+    metrics.bitrix_limiter_in_flight.set(limiter.in_flight)
+    metrics.bitrix_limiter_queue_depth.set(limiter.queue_depth)
+    metrics.bitrix_circuit_open.set(1 if bitrix_service.circuit_breaker.is_open else 0)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Остальной код остается без изменений...
 current_dir = os.path.dirname(os.path.abspath(__file__))
 static_dir = os.path.join(current_dir, "app", "static")
@@ -64,7 +131,7 @@ async def read_root():
 @app.get("/api/users-list")
 async def get_users_list():
     try:
-        users = await bitrix_service.get_presales_users()
+        users = await warehouse_service.get_presales_users()
         if not users:
             return {"users": []}
         formatted = [{"ID": str(u['ID']), "NAME": u.get('NAME', ''), "LAST_NAME": u.get('LAST_NAME', '')} for u in users]
@@ -81,6 +148,7 @@ async def get_main_stats(
     activity_type: str = None,
     include_statistics: bool = True,
     force_refresh: bool = False,
+    use_batch: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     try:
@@ -100,7 +168,7 @@ async def get_main_stats(
 
         user_ids_list = user_ids.split(',') if user_ids else []
         activity_types = [activity_type] if activity_type else None
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         if not presales_users:
             return {"success": False, "error": "Список сотрудников пуст"}
 
@@ -110,8 +178,11 @@ async def get_main_stats(
         logger.info(f"🔍 Main stats: {start_date} to {end_date}, users: {len(target_user_ids)}, days: {total_days}, optimized: {use_optimized}")
 
         cache_used = False
+        degraded = False
         activities = []
+        cached_activities = []
         completeness = 0
+        gaps = {}
 
         # 🔥 ЕСЛИ НЕ ПРИНУДИТЕЛЬНОЕ ОБНОВЛЕНИЕ - проверяем кэш
         if not force_refresh:
@@ -121,39 +192,72 @@ async def get_main_stats(
 
             cached_activities = cache_analysis["activities"]
             completeness = cache_analysis["completeness"]
+            gaps = cache_analysis.get("gaps") or {}
 
-            if completeness >= 95.0:
+            # Полнота по журналу покрытия: все дни периода загружены из Bitrix
+            if cache_analysis["is_complete"]:
                 activities = cached_activities
                 cache_used = True
-                logger.info(f"✅ Using cached data: {completeness:.1f}% complete, {len(activities)} activities")
+                logger.info(f"✅ Using cached data: period fully covered, {len(activities)} activities")
+
+        # 🔥 BITRIX ДЕГРАДИРОВАЛ - не долбим портал, отдаем то, что есть в кэше
+        if not activities and cached_activities and bitrix_service.circuit_breaker.is_open:
+            logger.warning(f"⚠️ Bitrix circuit open, serving cached data ({completeness:.1f}% complete)")
+            activities = cached_activities
+            cache_used = True
+            degraded = True
 
         # 🔥 ЕСЛИ ДАННЫХ НЕТ В КЭШЕ ИЛИ ПРИНУДИТЕЛЬНОЕ ОБНОВЛЕНИЕ - грузим из Bitrix
-        if not activities:
+        if not cache_used:
             if force_refresh:
                 logger.info(f"🔄 Force refresh requested, loading from Bitrix...")
             else:
                 logger.info(f"🔄 No complete cache found ({completeness:.1f}%), loading from Bitrix...")
             
+            fetched_at = datetime.now()
+
             # 🔥 ВЫБИРАЕМ МЕТОД В ЗАВИСИМОСТИ ОТ ПЕРИОДА
-            if use_optimized:
+            if gaps:
+                # Кэш покрывает часть периода - догружаем только непокрытые дни
+                activities = await warehouse_service.fill_coverage_gaps(
+                    cached_activities, gaps, activity_types, use_batch
+                )
+            elif use_optimized:
                 logger.info(f"📅 Using OPTIMIZED loading for {total_days} days")
                 activities = await bitrix_service.get_activities_optimized(
                     start_date=start_date,
                     end_date=end_date,
                     user_ids=target_user_ids,
                     activity_types=activity_types,
-                    chunk_size_days=7  # Недельные chunks
+                    chunk_size_days=7,  # Недельные chunks
+                    use_batch=use_batch
                 )
             else:
                 activities = await bitrix_service.get_activities(
                     start_date=start_date,
                     end_date=end_date,
                     user_ids=target_user_ids,
-                    activity_types=activity_types
+                    activity_types=activity_types,
+                    use_batch=use_batch
                 )
             
-            if activities:
-                asyncio.create_task(warehouse_service.cache_activities(activities))
+            if activities is None:
+                # Загрузка не удалась целиком - неполные данные в кэш не пишем
+                logger.warning(f"⚠️ Bitrix load failed, falling back to cached data ({completeness:.1f}% complete)")
+                activities = cached_activities
+                cache_used = bool(cached_activities)
+                degraded = True
+            elif gaps:
+                logger.info(f"✅ Filled coverage gaps for period {start_date} to {end_date}: {len(activities)} activities")
+            elif not activity_types:
+                # Полная загрузка периода - пишем активности и отмечаем покрытие
+                run_in_background(warehouse_service.store_fetched_period(
+                    activities, target_user_ids, start_date, end_date, fetched_at
+                ))
+                logger.info(f"✅ Cached {len(activities)} activities for period {start_date} to {end_date}")
+            elif activities:
+                # С фильтром по типам загружена только часть активностей - покрытие не отмечаем
+                run_in_background(warehouse_service.cache_activities(activities))
                 logger.info(f"✅ Cached {len(activities)} activities for period {start_date} to {end_date}")
 
         # 🔥 СОХРАНЯЕМ СНАПШОТЫ ДЛЯ КАЖДОГО ДНЯ В ПЕРИОДЕ
@@ -180,7 +284,7 @@ async def get_main_stats(
                     
                     # Создаем снапшот только если есть активности за этот день
                     if daily_activities:
-                        asyncio.create_task(warehouse_service.save_daily_snapshot_from_activities(
+                        run_in_background(warehouse_service.save_daily_snapshot_from_activities(
                             daily_activities, target_user_ids, date_str
                         ))
                     
@@ -237,16 +341,15 @@ async def get_main_stats(
             "activities_count": len(activities),
             "start_date": start_date,
             "end_date": end_date,
-            "optimized_loading": use_optimized  # 🔥 Добавляем информацию о методе загрузки
+            "optimized_loading": use_optimized,  # 🔥 Добавляем информацию о методе загрузки
+            "degraded": degraded
         }
 
         if include_statistics:
-            statistics = await bitrix_service.get_activity_statistics(
-                start_date=start_date,
-                end_date=end_date,
-                user_ids=target_user_ids
+            # Графики строятся по уже загруженным активностям, без второго похода в Bitrix
+            result["statistics"] = await bitrix_service.get_activity_statistics_from_activities(
+                activities, start_date, end_date
             )
-            result["statistics"] = statistics
 
         return result
         
@@ -264,6 +367,44 @@ async def test_connection():
         logger.error(f"Connection test error: {str(e)}")
         return {"connected": False, "error": str(e)}
 
+@app.get("/api/debug/bitrix-limiter")
+async def debug_bitrix_limiter():
+    """Текущий темп и очередь лимитера запросов к Bitrix, состояние circuit breaker"""
+    return {
+        "success": True,
+        "limiter": bitrix_service.rate_limiter.get_status(),
+        "circuit": bitrix_service.circuit_breaker.get_status(),
+        "inflight_requests": len(bitrix_service._inflight),
+        "coalesced_requests": bitrix_service.coalesced_requests
+    }
+
+@app.get("/api/sync/status")
+async def get_sync_status(current_user: dict = Depends(get_current_user)):
+    """Состояние фоновой синхронизации активностей: последний запуск, отставание, отметки"""
+    return {
+        "success": True,
+        "sync": warehouse_service.get_sync_status()
+    }
+
+@app.post("/api/bitrix/events")
+async def receive_bitrix_event(request: Request):
+    """Прием исходящих событий Bitrix24 (ONCRMACTIVITY*/ONCRMDEAL*)
+
+    Bitrix шлет form-urlencoded: event, data[FIELDS][ID], auth[application_token].
+    Записанное событие можно повторить локально:
+    curl -d "event=ONCRMACTIVITYUPDATE&data[FIELDS][ID]=123&auth[application_token]=$BITRIX_APP_TOKEN" \\
+         http://localhost:8000/api/bitrix/events
+    """
+    form = await request.form()
+    if not event_service.handle_event(dict(form)):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid application token")
+    return {"success": True}
+
+@app.get("/api/bitrix/events/status")
+async def bitrix_events_status(current_user: dict = Depends(get_current_user)):
+    """Очередь и счетчики обработки событий Bitrix24"""
+    return {"success": True, "events": event_service.get_status()}
+
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
     return FileResponse(os.path.join(os.path.dirname(__file__), "favicon.ico"))
@@ -271,7 +412,7 @@ async def favicon():
 @app.get("/api/debug/presales-users")
 async def debug_presales_users():
     try:
-        users = await bitrix_service.get_presales_users()
+        users = await warehouse_service.get_presales_users()
         return {"users": [{"ID": u['ID'], "NAME": u.get('NAME'), "LAST_NAME": u.get('LAST_NAME')} for u in users]}
     except Exception as e:
         return {"error": str(e)}
@@ -283,7 +424,7 @@ async def clear_cache(current_user: dict = Depends(get_current_user)):
 
 @app.get("/api/user-activities/{user_id}")
 async def get_user_activities(user_id: str, start_date: str = None, end_date: str = None):
-    activities = await bitrix_service.get_activities(start_date=start_date, end_date=end_date, user_ids=[user_id])
+    activities = await bitrix_service.get_activities(start_date=start_date, end_date=end_date, user_ids=[user_id], fields='detail')
     formatted = []
     if activities:
         for act in activities[:200]:
@@ -352,7 +493,7 @@ async def remove_allowed_email(request: EmailRequest, current_user: dict = Depen
 @app.get("/api/admin/users-count")
 async def get_users_count(current_user: dict = Depends(get_current_admin)):
     try:
-        users = await bitrix_service.get_presales_users()
+        users = await warehouse_service.get_presales_users()
         count = len(users) if users else 0
         return {"success": True, "count": count}
     except Exception as e:
@@ -373,7 +514,7 @@ async def refresh_cache(
     """Принудительное обновление кэша"""
     try:
         user_ids_list = user_ids.split(',') if user_ids else []
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         if not presales_users:
             return {"success": False, "error": "Список сотрудников пуст"}
 
@@ -386,15 +527,19 @@ async def refresh_cache(
             end_date = today
 
         # Получаем свежие данные
+        fetched_at = datetime.now()
         activities = await bitrix_service.get_activities(
             start_date=start_date,
             end_date=end_date,
             user_ids=target_user_ids
         )
+
+        # Период загружен целиком (в том числе без активностей) - отмечаем покрытие
+        if activities is not None:
+            await warehouse_service.store_fetched_period(activities, target_user_ids, start_date, end_date, fetched_at)
         
         # Очищаем старый кэш и сохраняем новый
         if activities:
-            await warehouse_service.cache_activities(activities)
             
             # Создаем снапшоты для каждого дня периода
             start = datetime.fromisoformat(start_date)
@@ -449,67 +594,50 @@ async def refresh_period_cache(
     """Принудительное обновление кэша за период"""
     try:
         user_ids_list = user_ids.split(',') if user_ids else []
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         if not presales_users:
             return {"success": False, "error": "Список сотрудников пуст"}
 
         target_user_ids = user_ids_list if user_ids_list else [str(u['ID']) for u in presales_users]
 
-        # Получаем свежие данные
-        activities = await bitrix_service.get_activities(
+        # Страницы пишутся в кэш по мере получения - память не зависит от длины периода
+        fetched_at = datetime.now()
+        cached_count = await warehouse_service.cache_activity_stream(bitrix_service.iter_activities(
             start_date=start_date,
             end_date=end_date,
             user_ids=target_user_ids
-        )
-        
-        # Сохраняем в кэш
-        if activities:
-            await warehouse_service.cache_activities(activities)
-            
-            # Создаем снапшоты для каждого дня периода
-            start = datetime.fromisoformat(start_date)
-            end = datetime.fromisoformat(end_date)
-            current = start
-            
-            snapshots_created = 0
-            while current <= end:
-                date_str = current.strftime("%Y-%m-%d")
-                
-                # Фильтруем активности за текущий день
-                daily_activities = []
-                for activity in activities:
-                    try:
-                        created_str = activity.get('CREATED', '').replace('Z', '+00:00')
-                        activity_date = datetime.fromisoformat(created_str).strftime('%Y-%m-%d')
-                        if activity_date == date_str:
-                            daily_activities.append(activity)
-                    except Exception:
-                        continue
-                
-                # Создаем снапшот только если есть активности за этот день
-                if daily_activities:
-                    await warehouse_service.save_daily_snapshot_from_activities(
-                        daily_activities, target_user_ids, date_str
-                    )
-                    snapshots_created += 1
-                
-                current += timedelta(days=1)
-            
-            return {
-                "success": True, 
-                "message": f"Cache refreshed with {len(activities)} activities",
-                "period": f"{start_date} to {end_date}",
-                "snapshots_created": snapshots_created,
-                "activities_count": len(activities)
-            }
-        else:
+        ))
+        if cached_count is None:
+            return {"success": False, "error": "Не удалось сохранить активности в кэш"}
+
+        # Период загружен целиком (в том числе без активностей) - отмечаем покрытие
+        await warehouse_service.record_coverage(target_user_ids, start_date, end_date, fetched_at)
+
+        # Снапшоты всех дней периода пересчитываются по activities
+        days = []
+        current = datetime.fromisoformat(start_date)
+        while current <= datetime.fromisoformat(end_date):
+            days.append(current.strftime("%Y-%m-%d"))
+            current += timedelta(days=1)
+        await warehouse_service.refresh_snapshots(days)
+
+        if not cached_count:
             return {"success": False, "error": "No activities found"}
+
+        return {
+            "success": True, 
+            "message": f"Cache refreshed with {cached_count} activities",
+            "period": f"{start_date} to {end_date}",
+            "snapshots_created": len(days),
+            "activities_count": cached_count
+        }
             
     except Exception as e:
         logger.error(f"Error refreshing period cache: {e}")
         return {"success": False, "error": str(e)}
 
 @app.get("/api/cache-status")
+@cache_only
 async def get_cache_status(
     start_date: str,
     end_date: str,
@@ -519,26 +647,26 @@ async def get_cache_status(
     """Проверяет состояние кэша для периода"""
     try:
         user_ids_list = user_ids.split(',') if user_ids else []
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         if not presales_users:
             return {"success": False, "error": "Список сотрудников пуст"}
 
         target_user_ids = user_ids_list if user_ids_list else [str(u['ID']) for u in presales_users]
 
-        # Проверяем полноту кэша
-        is_cached = await warehouse_service.is_period_cached(target_user_ids, start_date, end_date)
+        # Проверяем полноту кэша по журналу покрытия
+        coverage = await warehouse_service.get_coverage(target_user_ids, start_date, end_date)
         
         # Получаем информацию о днях в кэше
-        async with aiosqlite.connect(warehouse_service.db_path) as db:
+        async with warehouse_service.pool.read() as db:
             placeholders = ','.join('?' for _ in target_user_ids)
             query = f'''
-                SELECT DISTINCT data_date 
-                FROM activities_cache 
+                SELECT DISTINCT local_date 
+                FROM activities 
                 WHERE user_id IN ({placeholders}) 
-                AND data_date BETWEEN ? AND ?
-                ORDER BY data_date
+                AND local_date BETWEEN ? AND ?
+                ORDER BY local_date
             '''
-            params = target_user_ids + [start_date, end_date]
+            params = [int(uid) for uid in target_user_ids] + [start_date, end_date]
             cursor = await db.execute(query, params)
             cached_dates = [row[0] for row in await cursor.fetchall()]
 
@@ -551,9 +679,11 @@ async def get_cache_status(
             "period": f"{start_date} to {end_date}",
             "total_days": total_days,
             "cached_days": len(cached_dates),
-            "is_complete": is_cached,
+            "is_complete": coverage["is_complete"],
+            "completeness": coverage["completeness"],
             "cached_dates": cached_dates,
-            "missing_days": total_days - len(cached_dates)
+            "missing_days": len(coverage["missing_days"]),
+            "missing_dates": coverage["missing_days"]
         }
             
     except Exception as e:
@@ -570,7 +700,7 @@ async def load_large_period(
     """Постепенная загрузка большого периода с прогрессом"""
     try:
         user_ids_list = user_ids.split(',') if user_ids else []
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         if not presales_users:
             return {"success": False, "error": "Список сотрудников пуст"}
 
@@ -581,42 +711,34 @@ async def load_large_period(
         end = datetime.fromisoformat(end_date)
         total_days = (end - start).days + 1
 
-        # Разбиваем на недельные chunks
-        chunk_size = 7
-        current_start = start
-        all_activities = []
+        # Части грузятся параллельно, границы подбираются по плотности данных
+        activity_ids = set()
         chunks_processed = 0
+        chunks_failed = 0
+        fetched_at = datetime.now()
+
+        # aclosing: при исключении или обрыве запроса генератор отменит свои загрузки
+        async with aclosing(bitrix_service.iter_activity_chunks(start, end, target_user_ids)) as chunks:
+            async for chunk_start, chunk_end, chunk_activities in chunks:
+                chunks_processed += 1
+                if chunk_activities is None:
+                    chunks_failed += 1
+                    continue
 
-        while current_start <= end:
-            current_end = min(current_start + timedelta(days=chunk_size - 1), end)
-            chunk_start_str = current_start.strftime("%Y-%m-%d")
-            chunk_end_str = current_end.strftime("%Y-%m-%d")
-
-            logger.info(f"📅 Processing chunk {chunks_processed + 1}: {chunk_start_str} to {chunk_end_str}")
-
-            # Получаем данные для chunk
-            chunk_activities = await bitrix_service.get_activities(
-                start_date=chunk_start_str,
-                end_date=chunk_end_str,
-                user_ids=target_user_ids
-            )
-
-            if chunk_activities:
-                all_activities.extend(chunk_activities)
-                # Кэшируем каждый chunk
-                asyncio.create_task(warehouse_service.cache_activities(chunk_activities))
-
-            chunks_processed += 1
-            current_start = current_end + timedelta(days=1)
-
-            # Небольшая пауза между chunks
-            await asyncio.sleep(1)
+                logger.info(f"📅 Chunk {chunk_start} - {chunk_end}: {len(chunk_activities)} activities")
+                activity_ids.update(str(a.get('ID')) for a in chunk_activities)
+                # Кэшируем каждый chunk и отмечаем его покрытие (пустой тоже) до ответа клиенту
+                if not await warehouse_service.store_fetched_period(
+                    chunk_activities, target_user_ids, chunk_start, chunk_end, fetched_at
+                ):
+                    chunks_failed += 1
 
         return {
             "success": True,
             "message": f"Large period loaded: {total_days} days in {chunks_processed} chunks",
-            "activities_count": len(all_activities),
-            "chunks_processed": chunks_processed
+            "activities_count": len(activity_ids),
+            "chunks_processed": chunks_processed,
+            "chunks_failed": chunks_failed
         }
 
     except Exception as e:
@@ -624,6 +746,7 @@ async def load_large_period(
         return {"success": False, "error": str(e)}
 
 @app.get("/api/debug/cache-coverage")
+@cache_only
 async def debug_cache_coverage(
     start_date: str = None, 
     end_date: str = None,
@@ -636,7 +759,7 @@ async def debug_cache_coverage(
             end_date = datetime.now().strftime("%Y-%m-%d")
             start_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
         
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         target_user_ids = [str(u['ID']) for u in presales_users] if presales_users else []
         
         cache_info = await warehouse_service.get_cached_activities_optimized(
@@ -652,6 +775,7 @@ async def debug_cache_coverage(
         return {"success": False, "error": str(e)}
 
 @app.get("/api/stats/fast")
+@cache_only
 async def get_fast_stats(
     start_date: str,
     end_date: str,
@@ -664,7 +788,7 @@ async def get_fast_stats(
     try:
         user_ids_list = user_ids.split(',') if user_ids else []
         activity_types = [activity_type] if activity_type else None
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         if not presales_users:
             return {"success": False, "error": "Список сотрудников пуст"}
 
@@ -681,10 +805,10 @@ async def get_fast_stats(
         cached_activities = cache_analysis["activities"]
         completeness = cache_analysis["completeness"]
 
-        # 🔥 ТОЛЬКО если данные полностью в кэше (>95%)
-        if completeness >= 95.0:
+        # 🔥 ТОЛЬКО если период полностью покрыт журналом загрузок
+        if cache_analysis["is_complete"]:
             activities = cached_activities
-            logger.info(f"⚡ Using cached data for {len(target_user_ids)} users: {completeness:.1f}% complete (required: 95.0%)")
+            logger.info(f"⚡ Using cached data for {len(target_user_ids)} users: {completeness:.1f}% complete")
             
             # --- Логика подсчета статистики из активностей ---
             user_activities = {}
@@ -739,13 +863,10 @@ async def get_fast_stats(
             }
 
             if include_statistics:
-                # Используем существующий метод для статистики
-                statistics = await bitrix_service.get_activity_statistics(
-                    start_date=start_date,
-                    end_date=end_date,
-                    user_ids=target_user_ids
+                # Статистика для графиков - по тем же данным из кэша
+                result["statistics"] = await bitrix_service.get_activity_statistics_from_activities(
+                    activities, start_date, end_date
                 )
-                result["statistics"] = statistics
 
             return result
         else:
@@ -881,7 +1002,7 @@ async def get_deals(
 async def get_all_users(current_user: dict = Depends(get_current_user)):
     """Получение списка всех пользователей - ИСПОЛЬЗУЕТ КЭШ"""
     try:
-        users = await bitrix_service.get_all_users()  # 🔥 ЭТОТ МЕТОД УЖЕ КЭШИРУЕТ
+        users = await warehouse_service.get_all_users()  # 🔥 ЛОКАЛЬНЫЙ СПРАВОЧНИК
         if not users:
             return {"users": []}
         formatted = [{"ID": str(u['ID']), "NAME": u.get('NAME', ''), "LAST_NAME": u.get('LAST_NAME', '')} for u in users]
@@ -902,10 +1023,12 @@ async def get_deals_stats(
         logger.info(f"🔍 GET /api/deals/stats called with: start_date={start_date}, end_date={end_date}, user_ids={user_ids}")
         
         user_ids_list = user_ids.split(',') if user_ids else []
+        deals = await warehouse_service.get_deals(start_date, end_date, user_ids_list)
         stats = await bitrix_service.get_deals_statistics(
             start_date=start_date,
             end_date=end_date,
-            user_ids=user_ids_list
+            user_ids=user_ids_list,
+            deals=deals
         )
         
         logger.info(f"✅ GET /api/deals/stats returning stats: {stats.keys() if stats else 'empty'}")
@@ -922,7 +1045,7 @@ async def get_deals_stats(
 async def get_deals_stages(current_user: dict = Depends(get_current_user)):
     """Получение списка стадий сделок"""
     try:
-        stages = await bitrix_service.get_deal_stages()
+        stages = await stage_service.get_stages()
         return {
             "success": True,
             "stages": stages
@@ -936,7 +1059,7 @@ async def get_deals_stages(current_user: dict = Depends(get_current_user)):
 async def debug_deal_stages(current_user: dict = Depends(get_current_user)):
     """Отладочный эндпоинт для проверки стадий сделок"""
     try:
-        stages = await bitrix_service.get_deal_stages()
+        stages = await stage_service.get_stages()
         
         # Группируем по типам
         stages_by_type = {}
@@ -967,6 +1090,7 @@ async def get_deals_list(
     end_date: str = None,
     user_ids: str = None,
     limit: int = None,
+    use_batch: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     """Получение списка сделок БЕЗ ЖЕСТКИХ ОГРАНИЧЕНИЙ"""
@@ -975,13 +1099,22 @@ async def get_deals_list(
         
         user_ids_list = user_ids.split(',') if user_ids else []
         
-        # 🔥 ВАЖНО: Вызываем правильный метод БЕЗ ЛИМИТОВ
-        deals = await bitrix_service.get_deals(
+        # 🔥 Сделки из локальной таблицы (досинхронизируются по DATE_MODIFY)
+        deals = await warehouse_service.get_deals(
             start_date=start_date,
             end_date=end_date,
             user_ids=user_ids_list,
             limit=limit  # limit теперь опциональный
         )
+        if deals is None:
+            # Локальных данных нет и синхронизация не удалась - идем в Bitrix напрямую
+            deals = await bitrix_service.get_deals(
+                start_date=start_date,
+                end_date=end_date,
+                user_ids=user_ids_list,
+                limit=limit,
+                use_batch=use_batch
+            )
         
         logger.info(f"✅ GET /api/deals/list returning {len(deals) if deals else 0} deals")
         
@@ -1006,11 +1139,8 @@ async def get_user_all_deals(
         user_ids_list = user_ids.split(',')
         logger.info(f"🔍 GET /api/deals/user-all for users: {user_ids_list}")
         
-        # 🔥 БЕЗ ФИЛЬТРА ПО ДАТЕ И БЕЗ ЛИМИТА - все сделки сотрудников
-        deals = await bitrix_service.get_deals(
-            user_ids=user_ids_list
-            # limit параметр убран - загружаем ВСЕ
-        )
+        # 🔥 БЕЗ ФИЛЬТРА ПО ДАТЕ И БЕЗ ЛИМИТА - вся история сделок из локальной таблицы
+        deals = await warehouse_service.get_deals(user_ids=user_ids_list)
         
         logger.info(f"✅ GET /api/deals/user-all returning {len(deals) if deals else 0} deals")
         
@@ -1027,6 +1157,7 @@ async def get_user_all_deals(
 
 
 @app.get("/api/stats/super-fast")
+@cache_only
 async def get_super_fast_stats(
     start_date: str,
     end_date: str,
@@ -1038,7 +1169,7 @@ async def get_super_fast_stats(
     try:
         user_ids_list = user_ids.split(',') if user_ids else []
         activity_types = [activity_type] if activity_type else None
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         if not presales_users:
             return {"success": False, "error": "Список сотрудников пуст"}
 
@@ -1142,7 +1273,7 @@ async def load_progressive(
     """Прогрессивная загрузка больших периодов"""
     try:
         user_ids_list = user_ids.split(',') if user_ids else []
-        presales_users = await bitrix_service.get_presales_users()
+        presales_users = await warehouse_service.get_presales_users()
         if not presales_users:
             return {"success": False, "error": "Список сотрудников пуст"}
 
@@ -1153,43 +1284,34 @@ async def load_progressive(
         end = datetime.fromisoformat(end_date)
         total_days = (end - start).days + 1
 
-        # Разбиваем на недельные chunks
-        chunk_size = 7
-        current_start = start
-        all_activities = []
+        # Части грузятся параллельно, границы подбираются по плотности данных
+        activity_ids = set()
         chunks_processed = 0
-        total_chunks = (total_days + chunk_size - 1) // chunk_size
-
-        while current_start <= end:
-            current_end = min(current_start + timedelta(days=chunk_size - 1), end)
-            chunk_start_str = current_start.strftime("%Y-%m-%d")
-            chunk_end_str = current_end.strftime("%Y-%m-%d")
-
-            logger.info(f"📅 Processing chunk {chunks_processed + 1}/{total_chunks}: {chunk_start_str} to {chunk_end_str}")
-
-            # Получаем данные для chunk
-            chunk_activities = await bitrix_service.get_activities(
-                start_date=chunk_start_str,
-                end_date=chunk_end_str,
-                user_ids=target_user_ids
-            )
-
-            if chunk_activities:
-                all_activities.extend(chunk_activities)
-                # Кэшируем каждый chunk
-                asyncio.create_task(warehouse_service.cache_activities(chunk_activities))
-
-            chunks_processed += 1
-            current_start = current_end + timedelta(days=1)
+        chunks_failed = 0
+        fetched_at = datetime.now()
+
+        # aclosing: при исключении или обрыве запроса генератор отменит свои загрузки
+        async with aclosing(bitrix_service.iter_activity_chunks(start, end, target_user_ids)) as chunks:
+            async for chunk_start, chunk_end, chunk_activities in chunks:
+                chunks_processed += 1
+                if chunk_activities is None:
+                    chunks_failed += 1
+                    continue
 
-            # Пауза между chunks
-            await asyncio.sleep(1)
+                logger.info(f"📅 Chunk {chunk_start} - {chunk_end}: {len(chunk_activities)} activities")
+                activity_ids.update(str(a.get('ID')) for a in chunk_activities)
+                # Кэшируем каждый chunk и отмечаем его покрытие (пустой тоже) до ответа клиенту
+                if not await warehouse_service.store_fetched_period(
+                    chunk_activities, target_user_ids, chunk_start, chunk_end, fetched_at
+                ):
+                    chunks_failed += 1
 
         return {
             "success": True,
             "message": f"Данные загружены: {total_days} дней в {chunks_processed} частях",
-            "activities_count": len(all_activities),
-            "chunks_processed": chunks_processed
+            "activities_count": len(activity_ids),
+            "chunks_processed": chunks_processed,
+            "chunks_failed": chunks_failed
         }
 
     except Exception as e:
@@ -1209,10 +1331,12 @@ async def get_enhanced_deals_stats(
         logger.info(f"🔍 GET /api/deals/enhanced-stats called")
         
         user_ids_list = user_ids.split(',') if user_ids else []
+        deals = await warehouse_service.get_deals(start_date, end_date, user_ids_list)
         stats = await bitrix_service.get_deals_statistics_enhanced(
             start_date=start_date,
             end_date=end_date,
-            user_ids=user_ids_list
+            user_ids=user_ids_list,
+            deals=deals
         )
         
         logger.info(f"✅ GET /api/deals/enhanced-stats returning stats")
@@ -1266,7 +1390,7 @@ async def debug_test_deals(
         )
         
         # Тест 2: Получение стадий
-        stages = await bitrix_service.get_deal_stages()
+        stages = await stage_service.get_stages()
         
         return {
             "success": True,
@@ -1310,7 +1434,7 @@ async def debug_deals_detailed(
         
         # Тест 3: Получение стадий
         logger.info("🔧 Step 3: Getting stages...")
-        stages = await bitrix_service.get_deal_stages()
+        stages = await stage_service.get_stages()
         
         # Тест 4: Статистика
         logger.info("🔧 Step 4: Getting statistics...")
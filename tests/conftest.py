@@ -0,0 +1,31 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.data_warehouse_service import DataWarehouseService  # noqa: E402
+from app.services.sqlite_pool import SQLitePool  # noqa: E402
+
+
+def run(coro):
+    """Выполняет корутину теста (pytest-asyncio в зависимостях нет)"""
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "warehouse.db")
+
+
+@pytest.fixture
+def make_warehouse(db_path):
+    """Фабрика warehouse на временной базе; initialize/close - внутри теста"""
+    def factory(bitrix_service=None) -> DataWarehouseService:
+        warehouse = DataWarehouseService(bitrix_service=bitrix_service)
+        warehouse.db_path = db_path
+        warehouse.pool = SQLitePool(db_path, readers=2)
+        return warehouse
+    return factory
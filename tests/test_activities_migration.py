@@ -0,0 +1,84 @@
+import json
+import sqlite3
+
+from tests.conftest import run
+
+# Схема и индексы activities_cache в том виде, в котором их создавала прежняя версия
+LEGACY_SCHEMA = '''
+    CREATE TABLE activities_cache (
+        id INTEGER PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        created TEXT NOT NULL,
+        type_id TEXT NOT NULL,
+        description TEXT,
+        subject TEXT,
+        raw_data TEXT,
+        cached_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        data_date TEXT NOT NULL
+    );
+    CREATE INDEX idx_activities_user_date ON activities_cache(user_id, created);
+    CREATE INDEX idx_activities_data_date ON activities_cache(data_date);
+'''
+
+LEGACY_ROWS = [
+    ('1', '17087', '2024-01-02T10:15:00+03:00', '2'),
+    ('2', '17087', '2024-01-02T23:30:00-05:00', '6'),
+    ('3', '8860', '2024-01-03T08:00:00+03:00', '4'),
+]
+
+
+def _create_legacy_db(path):
+    db = sqlite3.connect(path)
+    db.executescript(LEGACY_SCHEMA)
+    for activity_id, user_id, created, type_id in LEGACY_ROWS:
+        raw = {'ID': activity_id, 'AUTHOR_ID': user_id, 'CREATED': created, 'TYPE_ID': type_id}
+        db.execute(
+            '''INSERT INTO activities_cache (id, user_id, created, type_id, raw_data, data_date)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (activity_id, user_id, created, type_id, json.dumps(raw), created[:10])
+        )
+    db.commit()
+    db.close()
+
+
+def test_legacy_cache_is_migrated(db_path, make_warehouse):
+    _create_legacy_db(db_path)
+
+    async def scenario():
+        warehouse = make_warehouse()
+        await warehouse.initialize()
+        activities = await warehouse.get_cached_activities_direct(['17087', '8860'], '2024-01-01', '2024-01-05')
+        await warehouse.close()
+        return activities['activities']
+
+    activities = run(scenario())
+    assert sorted((a['ID'], a['AUTHOR_ID'], a['TYPE_ID'], a['CREATED']) for a in activities) == sorted(
+        (activity_id, user_id, type_id, created) for activity_id, user_id, created, type_id in LEGACY_ROWS
+    )
+
+    db = sqlite3.connect(db_path)
+    tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    db.close()
+    assert 'activities_cache' not in tables
+
+
+def test_user_date_index_survives_migration(db_path, make_warehouse):
+    _create_legacy_db(db_path)
+
+    async def scenario():
+        warehouse = make_warehouse()
+        await warehouse.initialize()
+        await warehouse.close()
+
+    run(scenario())
+
+    db = sqlite3.connect(db_path)
+    indexes = {row[0] for row in db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'activities'"
+    )}
+    plan = ' '.join(row[3] for row in db.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM activities WHERE user_id = 17087 AND local_date BETWEEN '2024-01-01' AND '2024-01-05'"
+    ))
+    db.close()
+    assert 'idx_activities_user_local_date' in indexes
+    assert 'idx_activities_user_local_date' in plan
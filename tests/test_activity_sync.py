@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+from tests.conftest import run
+
+
+def _activity(activity_id, user_id, created, updated):
+    return {'ID': str(activity_id), 'AUTHOR_ID': user_id, 'TYPE_ID': '2', 'CREATED': created, 'LAST_UPDATED': updated}
+
+
+class FakeBitrix:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    async def iter_activities_updated_since(self, user_ids, updated_since=None, created_since=None):
+        self.calls.append((list(user_ids), updated_since, created_since))
+        for page in self.pages:
+            yield [activity for activity in page if activity['AUTHOR_ID'] in user_ids]
+
+
+def _pages():
+    today = datetime.now().strftime("%Y-%m-%d")
+    return [
+        [_activity(1, '10', f'{today}T09:00:00+03:00', f'{today}T09:05:00+03:00')],
+        [_activity(2, '10', f'{today}T10:00:00+03:00', f'{today}T10:30:00+03:00'),
+         _activity(3, '20', f'{today}T11:00:00+03:00', f'{today}T11:00:00+03:00')],
+    ]
+
+
+def test_sync_saves_watermarks_and_coverage(make_warehouse):
+    bitrix = FakeBitrix(_pages())
+    today = datetime.now().strftime("%Y-%m-%d")
+    week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+
+    async def scenario():
+        warehouse = make_warehouse(bitrix)
+        await warehouse.initialize()
+        synced = await warehouse.sync_recent_data(['10', '20'])
+        state = dict(warehouse._activity_sync_state)
+        covered = await warehouse.is_period_covered(['10', '20'], week_ago, today)
+        bitrix.pages = []
+        await warehouse.sync_recent_data(['10', '20'])
+        await warehouse.close()
+        return synced, state, covered
+
+    synced, state, covered = run(scenario())
+    assert synced == 3
+    assert state['10']['last_updated'].endswith('10:30:00+03:00')
+    assert state['20']['last_updated'].endswith('11:00:00+03:00')
+    assert covered
+    # Второй запуск идет от наименьшей отметки, а не заново от backfill_from
+    assert bitrix.calls[1][1] == state['10']['last_updated']
+
+
+def test_failed_write_keeps_watermarks_and_coverage(make_warehouse):
+    bitrix = FakeBitrix(_pages())
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    async def scenario():
+        warehouse = make_warehouse(bitrix)
+        await warehouse.initialize()
+
+        async def failing_cache(activities):
+            return False
+
+        warehouse.cache_activities = failing_cache
+        await warehouse.sync_recent_data(['10', '20'])
+        async with warehouse.pool.read() as db:
+            cursor = await db.execute("SELECT COUNT(*) FROM activity_sync_state")
+            saved_state = (await cursor.fetchone())[0]
+        covered = await warehouse.is_period_covered(['10', '20'], today, today)
+        status = warehouse.get_sync_status()
+        await warehouse.close()
+        return warehouse._activity_sync_state, saved_state, covered, status
+
+    memory_state, saved_state, covered, status = run(scenario())
+    assert memory_state == {} and saved_state == 0
+    assert not covered
+    assert status['last_error']
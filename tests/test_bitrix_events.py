@@ -0,0 +1,135 @@
+import asyncio
+
+from app.services.bitrix_event_service import BitrixEventService
+from app.services.bitrix_service import BitrixAuthError, BitrixError, BitrixUnavailableError
+from tests.conftest import run
+
+TOKEN = 'app-token'
+
+
+class FakeBitrix:
+    def __init__(self, error=None):
+        self.error = error
+
+    async def get_deals_by_ids(self, ids):
+        if self.error:
+            raise self.error
+        return [{'ID': deal_id} for deal_id in ids]
+
+
+class FakeWarehouse:
+    def __init__(self):
+        self.upserted = []
+        self.deleted = []
+
+    async def upsert_deals(self, deals):
+        self.upserted.extend(deal['ID'] for deal in deals)
+
+    async def delete_deals(self, ids):
+        self.deleted.extend(ids)
+
+
+def _service(bitrix, warehouse, monkeypatch):
+    monkeypatch.setenv('BITRIX_APP_TOKEN', TOKEN)
+    monkeypatch.setenv('BITRIX_EVENTS_MAX_ATTEMPTS', '3')
+    return BitrixEventService(bitrix, warehouse)
+
+
+def _event(name, entity_id):
+    return {'event': name, 'data[FIELDS][ID]': entity_id, 'auth[application_token]': TOKEN}
+
+
+def test_events_are_coalesced_and_applied(monkeypatch):
+    warehouse = FakeWarehouse()
+    service = _service(FakeBitrix(), warehouse, monkeypatch)
+
+    assert service.handle_event(_event('ONCRMDEALUPDATE', '10'))
+    assert service.handle_event(_event('ONCRMDEALUPDATE', '10'))
+    assert service.handle_event(_event('ONCRMDEALDELETE', '11'))
+    assert not service.handle_event({**_event('ONCRMDEALUPDATE', '12'), 'auth[application_token]': 'wrong'})
+    run(service.flush())
+
+    assert warehouse.upserted == ['10']
+    assert warehouse.deleted == ['11']
+    assert service.get_status()['pending_deals'] == 0
+
+
+def test_non_numeric_id_is_ignored(monkeypatch):
+    service = _service(FakeBitrix(), FakeWarehouse(), monkeypatch)
+
+    assert service.handle_event(_event('ONCRMDEALUPDATE', 'abc'))
+    status = service.get_status()
+    assert status['ignored'] == 1 and status['pending_deals'] == 0
+
+
+def test_unappliable_batch_is_dropped_after_max_attempts(monkeypatch):
+    service = _service(FakeBitrix(error=ValueError('broken row')), FakeWarehouse(), monkeypatch)
+    service.handle_event(_event('ONCRMDEALUPDATE', '10'))
+
+    for _ in range(3):
+        run(service.flush())
+
+    status = service.get_status()
+    assert status['pending_deals'] == 0 and status['dropped'] == 1
+
+
+def test_bitrix_outage_keeps_events_queued(monkeypatch):
+    service = _service(FakeBitrix(error=BitrixUnavailableError('circuit open')), FakeWarehouse(), monkeypatch)
+    service.handle_event(_event('ONCRMDEALUPDATE', '10'))
+
+    for _ in range(5):
+        run(service.flush())
+
+    status = service.get_status()
+    assert status['pending_deals'] == 1 and status['dropped'] == 0
+
+
+def test_permanent_api_errors_are_counted(monkeypatch):
+    for error in (BitrixError('INVALID_REQUEST'), BitrixAuthError('expired_token')):
+        service = _service(FakeBitrix(error=error), FakeWarehouse(), monkeypatch)
+        service.handle_event(_event('ONCRMDEALUPDATE', '10'))
+
+        async def scenario():
+            for _ in range(3):
+                await service.flush()
+            await service.stop()
+
+        run(scenario())
+        assert service.get_status()['dropped'] == 1
+
+
+def test_failed_flush_schedules_retry_with_backoff(monkeypatch):
+    service = _service(FakeBitrix(error=BitrixUnavailableError('circuit open')), FakeWarehouse(), monkeypatch)
+    service.retry_max_delay = 0.05
+    service.flush_delay = 0.01
+
+    async def scenario():
+        service.handle_event(_event('ONCRMDEALUPDATE', '10'))
+        service._wakeup.clear()
+        await service.flush()
+        first_delay = service._retry_delay
+        assert not service._wakeup.is_set()
+        await asyncio.wait_for(service._wakeup.wait(), timeout=1)
+        await service.stop()
+        return first_delay
+
+    assert run(scenario()) == 0.05
+
+
+def test_backoff_grows_and_resets_after_success(monkeypatch):
+    bitrix = FakeBitrix(error=BitrixUnavailableError('circuit open'))
+    service = _service(bitrix, FakeWarehouse(), monkeypatch)
+
+    async def scenario():
+        service.handle_event(_event('ONCRMDEALUPDATE', '10'))
+        delays = []
+        for _ in range(3):
+            await service.flush()
+            delays.append(service._retry_delay)
+        bitrix.error = None
+        await service.flush()
+        await service.stop()
+        return delays
+
+    assert run(scenario()) == [1.0, 2.0, 4.0]
+    assert service._retry_delay == 0.0
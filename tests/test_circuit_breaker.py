@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from app.services.bitrix_service import (
+    BitrixAuthError,
+    BitrixError,
+    BitrixService,
+    BitrixTransientError,
+    BitrixUnavailableError,
+    CircuitBreaker,
+)
+from tests.conftest import run
+
+
+def test_opens_after_threshold_and_recovers_via_probe(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('app.services.bitrix_service.time.monotonic', lambda: clock[0])
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == 'open' and breaker.is_open
+    assert not breaker.allow()
+
+    clock[0] += 61
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    # Пока проба в работе, остальные запросы не пропускаются
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+def test_failed_probe_reopens(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('app.services.bitrix_service.time.monotonic', lambda: clock[0])
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+    clock[0] += 61
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+
+
+def _service(outcomes):
+    """BitrixService, у которого каждая попытка берет следующий исход из outcomes"""
+    service = BitrixService()
+    service.webhook_url = 'https://portal.example/rest/1/token'
+    service.max_retries = 0
+    service.circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+
+    async def no_session():
+        pass
+
+    async def send(method, url, params=None):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    service.ensure_session = no_session
+    service._send = send
+    return service
+
+
+def _open_circuit(service):
+    async def fail_twice():
+        for _ in range(2):
+            with pytest.raises(BitrixUnavailableError):
+                await service._request_with_retries('crm.activity.list')
+    run(fail_twice())
+    assert service.circuit_breaker.state == 'open'
+
+
+def test_unexpected_probe_error_does_not_stick_half_open():
+    service = _service([BitrixTransientError('503'), BitrixTransientError('503'), ValueError('garbled'), {'ok': 1}])
+    _open_circuit(service)
+
+    async def probe_then_retry():
+        with pytest.raises(ValueError):
+            await service._request_with_retries('crm.activity.list')
+        return await service._request_with_retries('crm.activity.list')
+
+    assert run(probe_then_retry()) == {'ok': 1}
+    assert service.circuit_breaker.state == 'closed'
+
+
+def test_cancelled_probe_frees_half_open_slot():
+    service = _service([BitrixTransientError('503'), BitrixTransientError('503')])
+    _open_circuit(service)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def hanging_send(method, url, params=None):
+            started.set()
+            await asyncio.sleep(3600)
+
+        service._send = hanging_send
+        probe = asyncio.create_task(service._request_with_retries('crm.activity.list'))
+        await started.wait()
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        return service.circuit_breaker.allow()
+
+    assert run(scenario())
+
+
+def test_auth_error_counts_as_failure_and_api_error_as_success():
+    service = _service([BitrixAuthError('expired_token'), BitrixAuthError('expired_token'), BitrixError('bad filter')])
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(BitrixAuthError):
+                await service._request_with_retries('crm.activity.list')
+        state_after_auth = service.circuit_breaker.state
+        with pytest.raises(BitrixError):
+            await service._request_with_retries('crm.activity.list')
+        return state_after_auth
+
+    assert run(scenario()) == 'open'
+    assert service.circuit_breaker.state == 'closed'
+
+
+class _FakeResponse:
+    status = 200
+
+    def __init__(self, body: bytes):
+        self._body = body
+
+    async def read(self):
+        return self._body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+@pytest.mark.parametrize('body', [b'<html>502 Bad Gateway</html>', b'{"result": [', b'[1, 2]'])
+def test_malformed_response_is_transient(body):
+    service = BitrixService()
+    with pytest.raises(BitrixTransientError):
+        run(service._read_response('crm.activity.list', 'url', {'select[]': ['ID']}, _FakeResponse(body)))
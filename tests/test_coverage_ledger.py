@@ -0,0 +1,171 @@
+from datetime import datetime, timedelta
+
+from app.services.data_warehouse_service import DataWarehouseService
+from tests.conftest import run
+
+PAST = datetime(2024, 3, 1, 12, 0)
+
+
+async def _intervals(warehouse, user_id):
+    async with warehouse.pool.read() as db:
+        cursor = await db.execute(
+            "SELECT start_date, end_date FROM fetch_coverage WHERE user_id = ? ORDER BY start_date", (user_id,)
+        )
+        return await cursor.fetchall()
+
+
+def test_overlapping_and_adjacent_final_intervals_merge(make_warehouse):
+    async def scenario():
+        warehouse = make_warehouse()
+        await warehouse.initialize()
+        await warehouse.record_coverage(['1'], '2024-01-01', '2024-01-10', PAST)
+        await warehouse.record_coverage(['1'], '2024-01-11', '2024-01-20', PAST)
+        await warehouse.record_coverage(['1'], '2024-01-05', '2024-01-15', PAST)
+        await warehouse.record_coverage(['1'], '2024-01-25', '2024-01-31', PAST)
+        intervals = await _intervals(warehouse, 1)
+        await warehouse.close()
+        return intervals
+
+    assert run(scenario()) == [('2024-01-01', '2024-01-20'), ('2024-01-25', '2024-01-31')]
+
+
+def test_gaps_and_completeness(make_warehouse):
+    async def scenario():
+        warehouse = make_warehouse()
+        await warehouse.initialize()
+        await warehouse.record_coverage(['1', '2'], '2024-01-01', '2024-01-10', PAST)
+        await warehouse.record_coverage(['1'], '2024-01-15', '2024-01-20', PAST)
+        gaps = await warehouse.get_coverage_gaps(['1', '2'], '2024-01-01', '2024-01-20')
+        coverage = await warehouse.get_coverage(['1', '2'], '2024-01-01', '2024-01-20')
+        covered = await warehouse.is_period_covered(['1'], '2024-01-02', '2024-01-09')
+        not_covered = await warehouse.is_period_covered(['1', '2'], '2024-01-02', '2024-01-12')
+        await warehouse.close()
+        return gaps, coverage, covered, not_covered
+
+    gaps, coverage, covered, not_covered = run(scenario())
+    assert gaps == {'1': [('2024-01-11', '2024-01-14')], '2': [('2024-01-11', '2024-01-20')]}
+    assert coverage['completeness'] == 26 / 40 * 100
+    assert not coverage['is_complete']
+    assert coverage['missing_days'][0] == '2024-01-11' and coverage['missing_days'][-1] == '2024-01-20'
+    assert covered and not not_covered
+
+
+def test_fetch_day_is_covered_only_while_fresh(make_warehouse):
+    now = datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    async def scenario():
+        warehouse = make_warehouse()
+        await warehouse.initialize()
+        await warehouse.record_coverage(['1'], yesterday, today, now - timedelta(hours=1))
+        stale = (
+            await warehouse.is_period_covered(['1'], yesterday, yesterday),
+            await warehouse.is_period_covered(['1'], yesterday, today)
+        )
+        await warehouse.record_coverage(['1'], today, today, now)
+        fresh = await warehouse.is_period_covered(['1'], yesterday, today)
+        await warehouse.close()
+        return stale, fresh
+
+    stale, fresh = run(scenario())
+    assert stale == (True, False)
+    assert fresh
+
+
+def test_adjacent_interval_after_unfinished_day_is_not_merged(make_warehouse):
+    async def scenario():
+        warehouse = make_warehouse()
+        await warehouse.initialize()
+        # 2024-01-10 загружен в тот же день - он не окончательный
+        await warehouse.record_coverage(['1'], '2024-01-01', '2024-01-10', datetime(2024, 1, 10, 9, 0))
+        await warehouse.record_coverage(['1'], '2024-01-11', '2024-01-20', PAST)
+        intervals = await _intervals(warehouse, 1)
+        gaps = await warehouse.get_coverage_gaps(['1'], '2024-01-01', '2024-01-20')
+        await warehouse.close()
+        return intervals, gaps
+
+    intervals, gaps = run(scenario())
+    assert intervals == [('2024-01-01', '2024-01-10'), ('2024-01-11', '2024-01-20')]
+    assert gaps == {'1': [('2024-01-10', '2024-01-10')]}
+
+
+def test_coverage_end_is_clipped_to_fetch_date(make_warehouse):
+    async def scenario():
+        warehouse = make_warehouse()
+        await warehouse.initialize()
+        await warehouse.record_coverage(['1'], '2024-02-25', '2024-03-10', PAST)
+        intervals = await _intervals(warehouse, 1)
+        await warehouse.close()
+        return intervals
+
+    assert run(scenario()) == [('2024-02-25', '2024-03-01')]
+
+
+def test_plan_gap_fetches_groups_users_with_same_range():
+    plan = DataWarehouseService.plan_gap_fetches({
+        '1': [('2024-01-31', '2024-01-31')],
+        '2': [('2024-01-31', '2024-01-31')],
+        '3': [('2024-01-01', '2024-01-05'), ('2024-01-31', '2024-01-31')],
+        '4': []
+    })
+    assert plan == [
+        ('2024-01-01', '2024-01-05', ['3']),
+        ('2024-01-31', '2024-01-31', ['1', '2', '3'])
+    ]
+
+
+class FakeBitrix:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    async def get_activities_optimized(self, start_date, end_date, user_ids=None, use_batch=False, **kwargs):
+        self.calls.append((start_date, end_date, list(user_ids)))
+        if self.fail:
+            return None
+        return [
+            {'ID': f'9{user_id}', 'AUTHOR_ID': user_id, 'TYPE_ID': '2', 'CREATED': f'{start_date}T10:00:00+03:00'}
+            for user_id in user_ids
+        ]
+
+
+def test_fill_coverage_gaps_loads_only_missing_days(make_warehouse):
+    bitrix = FakeBitrix()
+
+    async def scenario():
+        warehouse = make_warehouse(bitrix)
+        await warehouse.initialize()
+        cached = [
+            {'ID': str(day), 'AUTHOR_ID': '1', 'TYPE_ID': '2', 'CREATED': f'2024-01-{day:02d}T10:00:00+03:00'}
+            for day in range(1, 31)
+        ]
+        await warehouse.store_fetched_period(cached, ['1', '2'], '2024-01-01', '2024-01-30', PAST)
+        # Строка за непокрытый день (например, от события) заменяется загруженными
+        await warehouse.cache_activities([
+            {'ID': '500', 'AUTHOR_ID': '1', 'TYPE_ID': '2', 'CREATED': '2024-01-31T09:00:00+03:00'}
+        ])
+
+        analysis = await warehouse.get_cached_activities_for_selected_users(['1', '2'], '2024-01-01', '2024-01-31')
+        merged = await warehouse.fill_coverage_gaps(analysis['activities'], analysis['gaps'])
+        after = await warehouse.is_period_covered(['1', '2'], '2024-01-01', '2024-01-31')
+        await warehouse.close()
+        return merged, after
+
+    merged, after = run(scenario())
+    assert bitrix.calls == [('2024-01-31', '2024-01-31', ['1', '2'])]
+    ids = {activity['ID'] for activity in merged}
+    assert '500' not in ids and {'91', '92'} <= ids and len(ids) == 32
+    assert after
+
+
+def test_fill_coverage_gaps_returns_none_on_failure(make_warehouse):
+    async def scenario():
+        warehouse = make_warehouse(FakeBitrix(fail=True))
+        await warehouse.initialize()
+        result = await warehouse.fill_coverage_gaps([], {'1': [('2024-01-01', '2024-01-02')]})
+        covered = await warehouse.is_period_covered(['1'], '2024-01-01', '2024-01-02')
+        await warehouse.close()
+        return result, covered
+
+    assert run(scenario()) == (None, False)
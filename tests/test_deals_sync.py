@@ -0,0 +1,99 @@
+from tests.conftest import run
+
+
+def _deal(deal_id, assigned, modified):
+    return {
+        'ID': str(deal_id), 'TITLE': f'Deal {deal_id}', 'STAGE_ID': 'NEW', 'ASSIGNED_BY_ID': assigned,
+        'DATE_CREATE': '2024-01-01T10:00:00+03:00', 'DATE_MODIFY': modified, 'OPPORTUNITY': '100'
+    }
+
+
+class FakePortal:
+    """crm.deal.list с фильтрами ASSIGNED_BY_ID и >=DATE_MODIFY"""
+
+    def __init__(self, deals):
+        self.deals = {deal['ID']: deal for deal in deals}
+        self.calls = []
+
+    async def iter_deals_modified_since(self, modified_since=None, user_ids=None):
+        self.calls.append((modified_since, list(user_ids) if user_ids else None))
+        page = [
+            deal for deal in self.deals.values()
+            if (not user_ids or deal['ASSIGNED_BY_ID'] in user_ids)
+            and (not modified_since or deal['DATE_MODIFY'] >= modified_since)
+        ]
+        if page:
+            yield page
+
+
+async def _owners(warehouse):
+    async with warehouse.pool.read() as db:
+        cursor = await db.execute("SELECT id, assigned_by_id FROM deals ORDER BY id")
+        return {str(row[0]): row[1] for row in await cursor.fetchall()}
+
+
+async def _watermarks(warehouse):
+    async with warehouse.pool.read() as db:
+        cursor = await db.execute("SELECT scope, last_modified FROM deals_sync_state")
+        return dict(await cursor.fetchall())
+
+
+def test_first_sync_loads_by_assignee_and_sets_watermarks(make_warehouse):
+    portal = FakePortal([
+        _deal(1, '10', '2024-02-01T10:00:00+03:00'),
+        _deal(2, '20', '2024-02-03T10:00:00+03:00'),
+        _deal(3, '99', '2024-02-05T10:00:00+03:00'),
+    ])
+
+    async def scenario():
+        warehouse = make_warehouse(portal)
+        await warehouse.initialize()
+        assert await warehouse.sync_deals(['10', '20'])
+        owners = await _owners(warehouse)
+        watermarks = await _watermarks(warehouse)
+        await warehouse.close()
+        return owners, watermarks
+
+    owners, watermarks = run(scenario())
+    assert portal.calls == [(None, ['10', '20'])]
+    assert owners == {'1': '10', '2': '20'}
+    assert watermarks == {'10': '2024-02-01T10:00:00+03:00', '20': '2024-02-03T10:00:00+03:00'}
+
+
+def test_incremental_sync_picks_up_deal_reassigned_to_untracked_user(make_warehouse):
+    portal = FakePortal([
+        _deal(1, '10', '2024-02-01T10:00:00+03:00'),
+        _deal(2, '20', '2024-02-03T10:00:00+03:00'),
+    ])
+
+    async def scenario():
+        warehouse = make_warehouse(portal)
+        await warehouse.initialize()
+        await warehouse.sync_deals(['10', '20'])
+
+        portal.deals['1'] = _deal(1, '99', '2024-02-10T10:00:00+03:00')
+        assert await warehouse.sync_deals(['10', '20'], force=True)
+        owners = await _owners(warehouse)
+        watermarks = await _watermarks(warehouse)
+        await warehouse.close()
+        return owners, watermarks
+
+    owners, watermarks = run(scenario())
+    # Повторная синхронизация - без фильтра по ответственному, с наименьшей отметки
+    assert portal.calls[1] == ('2024-02-01T10:00:00+03:00', None)
+    assert owners['1'] == '99'
+    assert watermarks == {'10': '2024-02-10T10:00:00+03:00', '20': '2024-02-10T10:00:00+03:00'}
+
+
+def test_sync_is_throttled_per_scope(make_warehouse):
+    portal = FakePortal([_deal(1, '10', '2024-02-01T10:00:00+03:00')])
+
+    async def scenario():
+        warehouse = make_warehouse(portal)
+        await warehouse.initialize()
+        await warehouse.sync_deals(['10'])
+        await warehouse.sync_deals(['10'])
+        await warehouse.close()
+
+    run(scenario())
+    assert len(portal.calls) == 1
@@ -0,0 +1,59 @@
+from app.services.bitrix_service import BitrixService
+from tests.conftest import run
+
+
+def _service(total_records):
+    """BitrixService, у которого crm.*.list отдает записи 1..total_records по 50 штук"""
+    service = BitrixService()
+    service.calls = []
+
+    async def request(method, params=None):
+        service.calls.append(dict(params))
+        after = params['filter[>ID]']
+        ids = [record_id for record_id in range(1, total_records + 1) if record_id > after][:50]
+        return [{'ID': str(record_id)} for record_id in ids]
+
+    service._request = request
+    return service
+
+
+async def _collect(service, params=None, limit=None):
+    pages = []
+    async for page in service.iter_list_by_id('crm.deal.list', params, limit=limit):
+        pages.append([int(record['ID']) for record in page])
+    return pages
+
+
+def test_cursor_advances_by_last_id():
+    service = _service(120)
+    pages = run(_collect(service, {'select[]': ['TITLE'], 'order[DATE_CREATE]': 'DESC', 'start': 100}))
+
+    assert [len(page) for page in pages] == [50, 50, 20]
+    assert sum(pages, []) == list(range(1, 121))
+    assert [call['filter[>ID]'] for call in service.calls] == [0, 50, 100]
+    first = service.calls[0]
+    assert first['start'] == -1 and first['order[ID]'] == 'ASC'
+    assert 'order[DATE_CREATE]' not in first
+    assert first['select[]'] == ['ID', 'TITLE']
+
+
+def test_full_last_page_ends_on_empty_page():
+    service = _service(100)
+    pages = run(_collect(service))
+
+    assert [len(page) for page in pages] == [50, 50]
+    assert len(service.calls) == 3
+
+
+def test_limit_and_initial_cursor():
+    service = _service(200)
+    pages = run(_collect(service, {'filter[>ID]': 20}, limit=60))
+
+    assert sum(pages, []) == list(range(21, 81))
+    assert len(service.calls) == 2
+
+
+def test_empty_result_stops_immediately():
+    service = _service(0)
+    assert run(_collect(service)) == []
+    assert len(service.calls) == 1
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from app.services.bitrix_service import BitrixService
+from tests.conftest import run
+
+
+def _service():
+    """BitrixService, у которого каждый запрос к порталу ждет release и считается"""
+    service = BitrixService()
+    service.sent = []
+    service.release = asyncio.Event()
+
+    async def request_with_retries(method, params=None):
+        service.sent.append(method)
+        await service.release.wait()
+        return [{'ID': str(len(service.sent))}]
+
+    service._request_with_retries = request_with_retries
+    return service
+
+
+def test_identical_reads_share_one_request():
+    async def scenario():
+        service = _service()
+        params = {'filter[ASSIGNED_BY_ID]': ['1', '2'], 'select[]': ['ID']}
+        same_params_other_order = {'select[]': ['ID'], 'filter[ASSIGNED_BY_ID]': ['1', '2']}
+        first = asyncio.create_task(service._request('crm.deal.list', params))
+        second = asyncio.create_task(service._request('crm.deal.list', same_params_other_order))
+        other = asyncio.create_task(service._request('crm.deal.list', {'filter[ASSIGNED_BY_ID]': ['3']}))
+        await asyncio.sleep(0)
+        service.release.set()
+        results = await asyncio.gather(first, second, other)
+        return service, results
+
+    service, (first, second, other) = run(scenario())
+    assert service.sent == ['crm.deal.list', 'crm.deal.list']
+    assert first == second and first is second
+    assert service.coalesced_requests == 1
+    assert not service._inflight
+
+
+def test_writes_are_not_coalesced():
+    async def scenario():
+        service = _service()
+        params = {'fields[SUBJECT]': 'Звонок'}
+        service.release.set()
+        await asyncio.gather(
+            service._request('crm.activity.add', params),
+            service._request('crm.activity.add', params)
+        )
+        return service
+
+    assert run(scenario()).sent == ['crm.activity.add', 'crm.activity.add']
+
+
+def test_cancelled_waiter_does_not_cancel_shared_request():
+    async def scenario():
+        service = _service()
+        first = asyncio.create_task(service._request('crm.deal.list', {'start': 0}))
+        second = asyncio.create_task(service._request('crm.deal.list', {'start': 0}))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        service.release.set()
+        result = await second
+        # После завершения одинаковый запрос снова идет в портал
+        again = await service._request('crm.deal.list', {'start': 0})
+        return service, result, again
+
+    service, result, again = run(scenario())
+    assert result == [{'ID': '1'}]
+    assert again == [{'ID': '2'}]
+    assert service.sent == ['crm.deal.list', 'crm.deal.list']
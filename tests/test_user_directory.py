@@ -0,0 +1,60 @@
+from tests.conftest import run
+
+PORTAL_USERS = [
+    {'ID': str(user_id), 'NAME': f'User {user_id}', 'LAST_NAME': '', 'TIMESTAMP_X': '2024-01-01T10:00:00+03:00'}
+    for user_id in range(1, 61)
+]
+
+
+class FakeBitrix:
+    def __init__(self):
+        self.full_loads = 0
+        self.modified_since = []
+
+    async def get_users_by_ids(self, ids):
+        return [user for user in PORTAL_USERS if user['ID'] in ids]
+
+    async def get_all_users(self):
+        self.full_loads += 1
+        return list(PORTAL_USERS)
+
+    async def get_users_modified_since(self, timestamp):
+        self.modified_since.append(timestamp)
+        # >=: пользователи с той же отметкой приходят повторно
+        return [user for user in PORTAL_USERS if user['TIMESTAMP_X'] >= timestamp] * 2
+
+
+def test_seeded_directory_is_still_loaded_in_full(make_warehouse):
+    bitrix = FakeBitrix()
+
+    async def scenario():
+        warehouse = make_warehouse(bitrix)
+        await warehouse.initialize()
+        await warehouse.get_users_by_ids(['1', '2', '3'])
+        users = await warehouse.get_all_users()
+        await warehouse.close()
+        return users
+
+    assert len(run(scenario())) == 60
+    assert bitrix.full_loads == 1
+
+
+def test_full_load_marker_survives_restart(make_warehouse):
+    bitrix = FakeBitrix()
+
+    async def scenario():
+        warehouse = make_warehouse(bitrix)
+        await warehouse.initialize()
+        await warehouse.refresh_user_directory()
+        await warehouse.close()
+
+        restarted = make_warehouse(bitrix)
+        await restarted.initialize()
+        await restarted.refresh_user_directory()
+        users = await restarted.get_all_users()
+        await restarted.close()
+        return users
+
+    assert len(run(scenario())) == 60
+    assert bitrix.full_loads == 1
+    assert bitrix.modified_since == ['2024-01-01T10:00:00+03:00']